@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tags sample files the way a rip does and then retags them with new,
+bigger cover art, once without padding and once with --tag-padding,
+and reports how long the retags took, how many of them had to rewrite
+the file and how much the files grew.
+
+FLAC and MP3 samples are generated, M4A (or any other) files can be
+given on the command line:
+
+    python benchmarks/bench_tag_padding.py --audio-size 8 song.m4a
+"""
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from spotify_ripper.utils import *
+from spotify_ripper.tags import new_tags, write_tags, TagStats
+
+# MPEG-1 layer III, 128 kbps, 44.1 kHz
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x64"
+MP3_FRAME_SIZE = 417
+
+sample_extensions = {".flac": "flac", ".mp3": "mp3", ".m4a": "m4a",
+                     ".ogg": "ogg", ".opus": "opus"}
+
+
+class BenchContext(object):
+    """Stands in for a TrackContext, the cover image is random data of
+    the given size"""
+
+    def __init__(self, cover_size):
+        self.image = os.urandom(cover_size)
+
+    def load(self):
+        pass
+
+    def tag_metadata(self):
+        return {
+            "album": "Album", "artists": ["Artist"],
+            "album_artist": "Artist", "title": "Title", "year": 2001,
+            "disc": 1, "index": 3, "num_discs": 1, "num_tracks": 10,
+        }
+
+    def genres(self, genre_type):
+        return None
+
+    def cover_image(self):
+        return self.image
+
+
+def write_flac(path, audio_size):
+    """a FLAC file with only a STREAMINFO block, like the in-process
+    encoder writes"""
+    stream_info = struct.pack(">HH", 4096, 4096) + b"\x00" * 6 + \
+        struct.pack(">Q", (44100 << 44) | (1 << 41) | (15 << 36)) + \
+        b"\x00" * 16
+    with open(path, "wb") as f:
+        f.write(b"fLaC" + struct.pack(">I", 0x80000000 | len(stream_info)))
+        f.write(stream_info)
+        f.write(b"\xff\xf8" + os.urandom(audio_size - 2))
+
+
+def write_mp3(path, audio_size):
+    frame = MP3_FRAME_HEADER + b"\x00" * (MP3_FRAME_SIZE - 4)
+    with open(path, "wb") as f:
+        for i in range(audio_size // MP3_FRAME_SIZE):
+            f.write(frame)
+
+
+def tag_file(audio_file, output_type, tag_padding, ctx):
+    args = argparse.Namespace(
+        all_artists=False, ascii=False, ascii_path_only=False, cbr=False,
+        comment=None, cover_file=None, cover_file_and_embed=None,
+        genres=None, grouping=None, id3_v23=False, output_type=output_type,
+        tag_override=None, tag_padding=tag_padding)
+    init_util_globals(args)
+    tags = new_tags(args, audio_file, ctx)
+    write_tags(args, audio_file, tags, replace=True)
+
+
+def bench_sample(args, sample, output_type, tag_padding, temp_dir):
+    audio_file = os.path.join(temp_dir, "bench" +
+                              os.path.splitext(sample)[1])
+    shutil.copyfile(sample, audio_file)
+    size_before = os.path.getsize(audio_file)
+
+    # the tags written when the file is ripped
+    tag_file(audio_file, output_type, tag_padding,
+             BenchContext(args.cover_size * KB_BYTES))
+    size_tagged = os.path.getsize(audio_file)
+
+    # retags with new, bigger cover art
+    stats = TagStats()
+    start = time.time()
+    for i in range(args.retags):
+        size = os.path.getsize(audio_file)
+        tag_file(audio_file, output_type, tag_padding,
+                 BenchContext(args.retag_cover_size * KB_BYTES))
+        stats.record(size, os.path.getsize(audio_file))
+    elapsed = time.time() - start
+
+    print("%-5s padding %4d KB: retags %7.2fms each, %s, "
+          "tagged +%s, retagged +%s" %
+          (output_type, tag_padding, elapsed * 1000.0 / args.retags,
+           stats.stats_str(), format_size(size_tagged - size_before),
+           format_size(os.path.getsize(audio_file) - size_tagged)))
+    os.remove(audio_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark retagging with and without tag padding')
+    parser.add_argument(
+        'samples', nargs='*',
+        help='Extra sample files to retag (e.g. M4A files)')
+    parser.add_argument(
+        '--audio-size', type=int, default=8,
+        help='Size in MB of the generated FLAC and MP3 samples '
+             '[Default=8]')
+    parser.add_argument(
+        '--cover-size', type=int, default=30,
+        help='Size in KB of the cover art written when ripping '
+             '[Default=30]')
+    parser.add_argument(
+        '--retag-cover-size', type=int, default=50,
+        help='Size in KB of the cover art written when retagging '
+             '[Default=50]')
+    parser.add_argument(
+        '--retags', type=int, default=10,
+        help='Number of retags per file [Default=10]')
+    parser.add_argument(
+        '--tag-padding', type=int, default=64,
+        help='Padding in KB compared against no padding [Default=64]')
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp(prefix="bench-tag-padding-")
+    try:
+        audio_size = args.audio_size * 1024 * KB_BYTES
+        samples = [(os.path.join(temp_dir, "sample.flac"), "flac"),
+                   (os.path.join(temp_dir, "sample.mp3"), "mp3")]
+        write_flac(samples[0][0], audio_size)
+        write_mp3(samples[1][0], audio_size)
+
+        for sample in args.samples:
+            ext = os.path.splitext(sample)[1].lower()
+            if ext not in sample_extensions:
+                print(Fore.YELLOW + "Skipping " + sample +
+                      ", unknown file type" + Fore.RESET)
+                continue
+            samples.append((sample, sample_extensions[ext]))
+
+        for sample, output_type in samples:
+            for tag_padding in (0, args.tag_padding):
+                bench_sample(args, sample, output_type, tag_padding,
+                             temp_dir)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Feeds synthetic PCM through the encoder writes the way the ripper does,
+once writing each delivered chunk directly and once through the buffered
+EncoderWriter thread, and reports how long the delivering thread was
+held up.
+
+    python benchmarks/bench_writer.py --seconds 300 --write-delay 0.5
+"""
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from spotify_ripper.utils import *
+from spotify_ripper.writer import EncoderWriter
+
+# 44.1 kHz, 16 bit stereo as delivered by libspotify
+SAMPLE_RATE = 44100
+FRAME_SIZE = 4
+
+
+class SlowFile(object):
+    """An output file that stands in for an encoder pipe, every write
+    blocks for write_delay ms like a busy encoder would"""
+
+    def __init__(self, path, write_delay):
+        self.f = open(path, "wb")
+        self.write_delay = write_delay / 1000.0
+
+    def write(self, data):
+        if self.write_delay > 0:
+            time.sleep(self.write_delay)
+        self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+
+class Timings(object):
+
+    def __init__(self):
+        self.total = 0.0
+        self.max = 0.0
+        self.calls = 0
+
+    def record(self, elapsed):
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.calls += 1
+
+
+def synthetic_chunks(seconds, chunk_frames):
+    """chunks of the size libspotify hands to music_delivery"""
+    chunk = os.urandom(chunk_frames * FRAME_SIZE)
+    num_chunks = int(seconds * SAMPLE_RATE / chunk_frames)
+    for i in range(num_chunks):
+        yield chunk
+
+
+def run_direct(args, outputs):
+    timings = Timings()
+    start = time.time()
+    for chunk in synthetic_chunks(args.seconds, args.chunk_frames):
+        write_start = time.time()
+        for output in outputs:
+            output.write(chunk)
+        timings.record(time.time() - write_start)
+    return timings, time.time() - start
+
+
+def run_buffered(args, outputs):
+    writer = EncoderWriter(args, None)
+    writer.start()
+    writer.begin_track([output.write for output in outputs])
+
+    timings = Timings()
+    start = time.time()
+    for chunk in synthetic_chunks(args.seconds, args.chunk_frames):
+        write_start = time.time()
+        writer.write(chunk)
+        timings.record(time.time() - write_start)
+    writer.end_track()
+    elapsed = time.time() - start
+
+    writer.stats.log()
+    writer.stop()
+    writer.join()
+    return timings, elapsed
+
+
+def report(name, timings, elapsed, num_bytes):
+    print("%-8s %8.2fs total, delivering thread blocked %.2fs "
+          "(max %.2fms per chunk), %s/s" %
+          (name, elapsed, timings.total, timings.max * 1000.0,
+           format_size(num_bytes / elapsed)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark direct vs buffered encoder writes')
+    parser.add_argument(
+        '--seconds', type=float, default=120,
+        help='Seconds of audio to write [Default=120]')
+    parser.add_argument(
+        '--chunk-frames', type=int, default=2048,
+        help='Frames per delivered chunk [Default=2048]')
+    parser.add_argument(
+        '--outputs', type=int, default=1,
+        help='Number of output files written [Default=1]')
+    parser.add_argument(
+        '--write-delay', type=float, default=0.0,
+        help='Milliseconds every write to an output blocks for, to '
+             'emulate a busy encoder [Default=0]')
+    parser.add_argument(
+        '--writer-buffer', type=int, default=16,
+        help='Writer queue depth in buffers [Default=16]')
+    parser.add_argument(
+        '--write-buffer-size', type=int, default=256,
+        help='Size of each writer buffer in KB [Default=256]')
+    args = parser.parse_args()
+    init_util_globals(args)
+
+    num_bytes = int(args.seconds * SAMPLE_RATE / args.chunk_frames) * \
+        args.chunk_frames * FRAME_SIZE * args.outputs
+    print("Writing " + format_size(num_bytes) + " to " +
+          str(args.outputs) + " output(s), " +
+          str(args.chunk_frames * FRAME_SIZE) + " byte chunks")
+
+    temp_dir = tempfile.mkdtemp(prefix="bench-writer-")
+    try:
+        for name, run in (("direct", run_direct),
+                          ("buffered", run_buffered)):
+            outputs = [SlowFile(os.path.join(temp_dir, name + str(i)),
+                                args.write_delay)
+                       for i in range(args.outputs)]
+            try:
+                timings, elapsed = run(args, outputs)
+            finally:
+                for output in outputs:
+                    output.close()
+            report(name, timings, elapsed, num_bytes)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from spotify_ripper.utils import *
+import collections
+import threading
+import time
+
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+
+class BufferPool(object):
+    """Fixed set of reusable, equally sized write buffers"""
+
+    def __init__(self, count, buffer_size):
+        self.buffer_size = buffer_size
+        self.free = queue.Queue()
+        for i in range(count):
+            self.free.put(bytearray(buffer_size))
+
+    def acquire(self, block=True):
+        try:
+            return self.free.get(block)
+        except queue.Empty:
+            return None
+
+    def release(self, buf):
+        self.free.put(buf)
+
+
+class DeliveryBuffer(object):
+    """Memory-capped buffer between libspotify's music delivery callback
+    and the ripper thread.  A put that would go over the cap is refused so
+    the callback can report zero consumed frames and libspotify will
+    deliver the same data again later"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = collections.deque()
+        self.size = 0
+        self.cond = threading.Condition(threading.Lock())
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.backpressure_count = 0
+        self.peak_size = 0
+
+    # executes on libspotify's thread, must not block
+    def put(self, item, num_bytes):
+        with self.cond:
+            # always accept something if the buffer is empty, otherwise a
+            # single oversized chunk could stall playback forever
+            if self.items and self.size + num_bytes > self.max_bytes:
+                self.backpressure_count += 1
+                return False
+
+            self.items.append((item, num_bytes))
+            self.size += num_bytes
+            self.peak_size = max(self.peak_size, self.size)
+            self.cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        with self.cond:
+            end_time = time.time() + timeout if timeout is not None else None
+            while not self.items:
+                if end_time is None:
+                    self.cond.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.cond.wait(remaining)
+
+            item, num_bytes = self.items.popleft()
+            self.size -= num_bytes
+            return item
+
+    def empty(self):
+        with self.cond:
+            return not self.items
+
+    def clear(self):
+        with self.cond:
+            self.items.clear()
+            self.size = 0
+
+    def log_stats(self):
+        print("Delivery buffer: peak " + format_size(self.peak_size) +
+              " of " + format_size(self.max_bytes) + ", backpressure " +
+              str(self.backpressure_count) + " times")
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import collections
+import threading
+import spotify
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache with hit/miss counters"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # move to the most recently used end
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def remove(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats_str(self):
+        return str(self.hits) + " hits, " + str(self.misses) + " misses"
+
+
+ALBUM_BROWSER_CACHE_SIZE = 128
+'''Number of loaded album browsers kept around'''
+
+album_browser_cache = LRUCache(ALBUM_BROWSER_CACHE_SIZE)
+album_index_cache = LRUCache(ALBUM_BROWSER_CACHE_SIZE)
+
+
+class AlbumIndex(object):
+    """Disc and track counts of an album, built once from its browser so
+    the totals for each track are simple lookups"""
+
+    def __init__(self, album_browser):
+        self.tracks_per_disc = {}
+        self.max_index = {}
+
+        for track in album_browser.tracks:
+            disc = track.disc
+            self.tracks_per_disc[disc] = \
+                self.tracks_per_disc.get(disc, 0) + 1
+            if track.index > self.max_index.get(disc, 0):
+                self.max_index[disc] = track.index
+
+        self.num_discs = max(self.tracks_per_disc) \
+            if self.tracks_per_disc else 0
+
+    def num_tracks(self, disc, index):
+        # the highest index on the disc if it comes after the track
+        max_index = self.max_index.get(disc, 0)
+        return max_index if max_index > index else 0
+
+    def smart_track_num(self, disc, index):
+        if self.num_discs >= 2:
+            return (disc * 100) + index
+        return index
+
+
+PLAYLIST_INDEX_CACHE_SIZE = 16
+'''Number of playlist indexes kept around'''
+
+playlist_index_cache = LRUCache(PLAYLIST_INDEX_CACHE_SIZE)
+watched_playlists = set()
+
+# any of these make a playlist index stale
+playlist_change_events = (
+    spotify.PlaylistEvent.TRACKS_ADDED,
+    spotify.PlaylistEvent.TRACKS_REMOVED,
+    spotify.PlaylistEvent.TRACKS_MOVED,
+    spotify.PlaylistEvent.TRACK_CREATED_CHANGED,
+)
+
+
+class PlaylistIndex(object):
+    """Track URIs of a playlist mapped to when and by whom they were
+    added, built from a single pass over the playlist"""
+
+    def __init__(self, playlist):
+        self.added = {}
+        for pl_track in playlist.tracks_with_metadata:
+            uri = pl_track.track.link.uri
+            # a track listed twice counts as added the first time
+            if uri not in self.added:
+                self.added[uri] = (pl_track.create_time, pl_track.creator)
+
+    def get(self, track):
+        """returns the (create_time, creator) pair of the track"""
+        return self.added.get(track.link.uri)
+
+
+def get_playlist_index(playlist):
+    key = playlist.link.uri
+    playlist_index = playlist_index_cache.get(key)
+    if playlist_index is None:
+        playlist_index = PlaylistIndex(playlist)
+        playlist_index_cache.put(key, playlist_index)
+
+        # drop the index as soon as the playlist changes
+        if key not in watched_playlists:
+            watched_playlists.add(key)
+
+            def invalidate(*args):
+                playlist_index_cache.remove(key)
+
+            for event in playlist_change_events:
+                playlist.on(event, invalidate)
+    return playlist_index
+
+
+def get_album_browser(album, timeout):
+    """returns a loaded browser for the album, shared by every track on
+    the album instead of browsing it again for each one"""
+    key = album.link.uri
+    album_browser = album_browser_cache.get(key)
+    if album_browser is None:
+        album_browser = album.browse()
+        album_browser.load(timeout)
+        album_browser_cache.put(key, album_browser)
+    return album_browser
+
+
+def get_album_index(album, timeout):
+    key = album.link.uri
+    album_index = album_index_cache.get(key)
+    if album_index is None:
+        album_index = AlbumIndex(get_album_browser(album, timeout))
+        album_index_cache.put(key, album_index)
+    return album_index
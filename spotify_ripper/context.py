@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from spotify_ripper.utils import *
+from spotify_ripper.cache import get_album_browser, get_album_index, \
+    get_playlist_index
+from datetime import datetime
+import hashlib
+import re
+
+label_regex = re.compile(r"^[0-9]+\s+")
+
+
+class TrackContext(object):
+    """A track along with the playlist, album or chart it is ripped from.
+    Its metadata is loaded once and shared by path formatting, tagging,
+    sync and the post actions, each value is only computed (and loaded
+    from Spotify) when something asks for it"""
+
+    __slots__ = ("args", "ripper", "idx", "track", "playlist", "album",
+                 "chart", "loaded", "values")
+
+    def __init__(self, ripper, idx, track, playlist=None, album=None,
+                 chart=None):
+        self.args = get_args()
+        self.ripper = ripper
+        self.idx = idx
+        self.track = track
+        self.playlist = playlist
+        self.album = album
+        self.chart = chart
+        self.loaded = False
+        self.values = {}
+
+    def load(self):
+        if self.loaded:
+            return
+        args = self.args
+        track = self.track
+
+        # this fixes the track.disc
+        if not track.is_loaded:
+            track.load(args.timeout)
+        if not track.album.is_loaded:
+            track.album.load(args.timeout)
+        if self.album is None:
+            self.album = track.album
+        self.loaded = True
+
+    def get(self, field):
+        value = self.values.get(field)
+        if value is None:
+            self.load()
+            value = getattr(self, "field_" + field)()
+            self.values[field] = value
+        return value
+
+    def tag_metadata(self):
+        """the metadata the tags are made from"""
+        self.load()
+        track = self.track
+        album_index = self.album_index
+        return {
+            "album": track.album.name,
+            "artists": [artist.name for artist in track.artists],
+            "album_artist": track.album.artist.name,
+            "title": track.name,
+            "year": track.album.year,
+            "disc": track.disc,
+            "index": track.index,
+            "num_discs": album_index.num_discs,
+            "num_tracks": album_index.num_tracks(track.disc, track.index),
+            "artist_uri": track.artists[0].link.uri,
+            "album_uri": track.album.link.uri,
+        }
+
+    def genres(self, genre_type):
+        return self.ripper.web.get_genres(genre_type, self.track)
+
+    def cover_image(self):
+        return self.ripper.covers.get_cover(self.track)
+
+    def snapshot(self):
+        """the metadata and format fields of the track, kept in the
+        manifest so the files can be retagged without Spotify"""
+        snapshot = self.tag_metadata()
+
+        # only the fields the path and tag templates used, retagging
+        # with a template that needs any other field skips the file
+        snapshot["fields"] = dict(self.values)
+
+        # genres that were already looked up
+        web = self.ripper.web
+        snapshot["genres"] = {}
+        for genre_type in ("artist", "album"):
+            genres = web.get_cached_result(
+                "genres", snapshot[genre_type + "_uri"])
+            if genres is not None:
+                snapshot["genres"][genre_type] = genres
+
+        image = self.cover_image()
+        snapshot["cover"] = hashlib.sha1(image).hexdigest() \
+            if image is not None else None
+        return snapshot
+
+    @property
+    def album_browser(self):
+        return get_album_browser(self.track.album, self.args.timeout)
+
+    @property
+    def album_index(self):
+        return get_album_index(self.track.album, self.args.timeout)
+
+    def field_artist(self):
+        return to_ascii(escape_filename_part(self.track.artists[0].name))
+
+    def field_artists(self):
+        return to_ascii(escape_filename_part(", ".join(
+            [artist.name for artist in self.track.artists])))
+
+    def field_feat_artists(self):
+        if len(self.track.artists) > 1:
+            return to_ascii(escape_filename_part(", ".join(
+                [artist.name for artist in self.track.artists[1:]])))
+        return ""
+
+    def field_album_artist(self):
+        return to_ascii(escape_filename_part(self.album.artist.name))
+
+    def field_album_artists_web(self):
+        artist_array = \
+            self.ripper.web.get_artists_on_album(self.album.link.uri)
+        if artist_array is not None:
+            return to_ascii(escape_filename_part(", ".join(artist_array)))
+        return self.get("artists")
+
+    def field_album(self):
+        return to_ascii(escape_filename_part(self.track.album.name))
+
+    def field_track_name(self):
+        return to_ascii(escape_filename_part(self.track.name))
+
+    def field_year(self):
+        return str(self.track.album.year)
+
+    def field_idx(self):
+        return str(self.idx + 1)
+
+    def field_track_num(self):
+        return str(self.track.index)
+
+    def field_disc_num(self):
+        return str(self.track.disc)
+
+    def field_smart_track_num(self):
+        return str(self.album_index.smart_track_num(
+            self.track.disc, self.track.index))
+
+    def field_playlist(self):
+        if self.playlist is not None:
+            return to_ascii(sanitize_playlist_name(self.playlist.name))
+        return "No Playlist"
+
+    def field_playlist_owner(self):
+        if self.playlist is not None:
+            return to_ascii(self.playlist.owner.display_name)
+        return "No Playlist Owner"
+
+    def field_user(self):
+        return self.ripper.session.user.display_name
+
+    def field_copyright(self):
+        album_browser = self.album_browser
+        if len(album_browser.copyrights) > 0:
+            return escape_filename_part(album_browser.copyrights[0])
+        return ""
+
+    def field_label(self):
+        return label_regex.sub("", self.get("copyright"))
+
+    def playlist_track_added(self):
+        if self.playlist is None:
+            return None
+        return get_playlist_index(self.playlist).get(self.track)
+
+    def field_track_add_time(self):
+        added = self.playlist_track_added()
+        if added is not None:
+            return datetime.fromtimestamp(
+                added[0]).strftime('%Y-%m-%d %H:%M:%S')
+        return ""
+
+    def field_track_add_user(self):
+        added = self.playlist_track_added()
+        if added is not None:
+            return added[1].display_name
+        return ""
+
+    def field_uri(self):
+        return self.track.link.uri
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.cache import LRUCache
+import errno
+import hashlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+COVER_MEMORY_CACHE_SIZE = 32
+'''Number of cover images kept in memory'''
+
+STALE_TEMP_FILE_AGE = 24 * 3600
+'''Seconds after which a temp file left by an interrupted write is removed'''
+
+
+def cover_store_path():
+    return os.path.join(settings_dir(), "covers")
+
+
+def can_resize():
+    return Image is not None
+
+
+def resize_image(data, max_size, quality):
+    """returns the image scaled down to fit in max_size pixels and
+    recompressed as a JPEG"""
+    image = Image.open(io.BytesIO(data))
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    resized = max(image.size) > max_size
+    if resized:
+        resample = getattr(Image, "LANCZOS", None) or Image.ANTIALIAS
+        image.thumbnail((max_size, max_size), resample)
+
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=quality, optimize=True)
+    result = output.getvalue()
+
+    # a small cover is only worth recompressing if it shrinks
+    return result if resized or len(result) < len(data) else data
+
+
+def write_file(path, data):
+    """writes the file through a uniquely named temp file in the same
+    directory, so concurrent writers never share a temp file"""
+    fd, temp_file = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX,
+                                     dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        finalize_file(temp_file, path)
+    except BaseException:
+        rm_file(temp_file)
+        raise
+
+
+written_cover_files = set()
+cover_files_lock = threading.Lock()
+
+
+def write_cover_file(cover_file, image):
+    """writes a cover sidecar file once per directory instead of once per
+    track"""
+    with cover_files_lock:
+        if cover_file in written_cover_files:
+            return
+        if not path_exists(cover_file):
+            write_file(cover_file, image)
+        # only once it is written, a failed write is tried again
+        written_cover_files.add(cover_file)
+
+
+class CoverStore(object):
+    """Cover art stored once on disk under the SHA-1 of its bytes, with
+    each album (and cover size) mapped to the image it uses.  Every track
+    on an album shares one image instead of downloading it again, and
+    albums with the same artwork share one file.  The store is trimmed to
+    --cover-cache-size by dropping the covers of the albums that were
+    used the longest time ago"""
+
+    schema = ("CREATE TABLE IF NOT EXISTS covers ("
+              "album_uri TEXT NOT NULL, "
+              "size TEXT NOT NULL, "
+              "digest TEXT NOT NULL, "
+              "used REAL NOT NULL DEFAULT 0, "
+              "PRIMARY KEY (album_uri, size))")
+
+    def __init__(self, args, web):
+        self.args = args
+        self.web = web
+        self.lock = threading.Lock()
+        self.memory = LRUCache(COVER_MEMORY_CACHE_SIZE)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        self.path = cover_store_path()
+        if not path_exists(self.path):
+            try:
+                os.makedirs(enc_str(self.path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        self.conn = sqlite3.connect(
+            enc_str(os.path.join(self.path, "index.db")),
+            check_same_thread=False)
+        with self.lock:
+            self.conn.execute(self.schema)
+            columns = [row[1] for row in
+                       self.conn.execute("PRAGMA table_info(covers)")]
+            if "used" not in columns:
+                self.conn.execute("ALTER TABLE covers ADD COLUMN "
+                                  "used REAL NOT NULL DEFAULT 0")
+            self.conn.commit()
+
+    def image_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest + ".jpg")
+
+    def read_image(self, digest):
+        data = self.memory.get(digest)
+        if data is not None:
+            return data
+
+        image_path = self.image_path(digest)
+        if not path_exists(image_path):
+            return None
+        with open(enc_str(image_path), "rb") as f:
+            data = f.read()
+        self.memory.put(digest, data)
+        return data
+
+    def digest(self, album_uri, size):
+        """returns the digest of the album's cover image or None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest FROM covers WHERE album_uri = ? AND size = ?",
+                (album_uri, size)).fetchone()
+            if row is not None:
+                # for pruning, committed with the next put or on close
+                self.conn.execute(
+                    "UPDATE covers SET used = ? "
+                    "WHERE album_uri = ? AND size = ?",
+                    (time.time(), album_uri, size))
+        return row[0] if row is not None else None
+
+    def size_key(self, size):
+        """the key of a cover size as it is embedded, with the resize
+        settings if covers are resized"""
+        args = self.args
+        if args.cover_size is None or not can_resize():
+            return size
+        return size + ":" + str(args.cover_size) + ":" + \
+            str(args.cover_quality)
+
+    def sizes(self):
+        return ["large", "normal"] if self.args.large_cover_art \
+            else ["normal"]
+
+    def prepare(self, album_uri, size, image):
+        """resizes the album's cover and stores the result"""
+        args = self.args
+        try:
+            image = resize_image(image, args.cover_size, args.cover_quality)
+        except Exception as e:
+            print(Fore.YELLOW + "Warning: could not resize cover art: " +
+                  str(e) + Fore.RESET)
+        self.put(album_uri, self.size_key(size), image)
+        return image
+
+    def get(self, album_uri, size):
+        """returns the cover image bytes of the album or None"""
+        digest = self.digest(album_uri, size)
+        return self.read_image(digest) if digest is not None else None
+
+    def put(self, album_uri, size, data):
+        digest = hashlib.sha1(data).hexdigest()
+        image_path = self.image_path(digest)
+
+        try:
+            # identical artwork is only stored once
+            if not path_exists(image_path):
+                image_dir = os.path.dirname(image_path)
+                try:
+                    os.makedirs(enc_str(image_dir))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                write_file(image_path, data)
+
+            with self.lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO covers VALUES (?, ?, ?, ?)",
+                    (album_uri, size, digest, time.time()))
+                self.conn.commit()
+        except (OSError, IOError, sqlite3.Error) as e:
+            print(Fore.YELLOW + "Warning: could not store cover art: " +
+                  str(e) + Fore.RESET)
+
+        self.memory.put(digest, data)
+
+    def fetch(self, track, size):
+        if size == "large":
+            return self.web.get_large_coverart(track.link.uri)
+
+        cover = track.album.cover()
+        if cover is None:
+            return None
+        cover.load(self.args.timeout)
+        return cover.data
+
+    def get_cover(self, track):
+        """returns the cover image of the track's album as it is
+        embedded, downloading and resizing it only if no track on the
+        album has done so before"""
+        album_uri = track.album.link.uri
+        image, downloaded = self.find_cover(track, album_uri)
+
+        # one hit or miss per lookup
+        with self.lock:
+            if image is None or downloaded:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += len(image)
+        return image
+
+    def find_cover(self, track, album_uri):
+        """returns (image, whether it was downloaded)"""
+        # if we fail, use regular cover size
+        for size in self.sizes():
+            key = self.size_key(size)
+            image = self.get(album_uri, key)
+            if image is not None:
+                return image, False
+
+            image = self.get(album_uri, size) if key != size else None
+            downloaded = image is None
+            if downloaded:
+                image = self.fetch(track, size)
+                if image is None:
+                    continue
+                self.put(album_uri, size, image)
+
+            if key != size:
+                image = self.prepare(album_uri, size, image)
+            return image, downloaded
+        return None, False
+
+    def stored_digest(self, album_uri):
+        """the digest of the cover get_cover would return, without
+        asking Spotify"""
+        for size in self.sizes():
+            key = self.size_key(size)
+            digest = self.digest(album_uri, key)
+            if digest is not None:
+                return digest
+
+            if key != size:
+                image = self.get(album_uri, size)
+                if image is not None:
+                    self.prepare(album_uri, size, image)
+                    return self.digest(album_uri, key)
+        return None
+
+    def stored_images(self):
+        """returns {digest: (path, size)} of the images on disk and
+        removes any temp file left by an interrupted write"""
+        images = {}
+        stale = time.time() - STALE_TEMP_FILE_AGE
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                if file_name.startswith(TEMP_FILE_PREFIX):
+                    if os.path.getmtime(file_path) < stale:
+                        rm_file(file_path)
+                    continue
+                digest, ext = os.path.splitext(file_name)
+                if ext == ".jpg":
+                    images[digest] = (file_path,
+                                      os.path.getsize(file_path))
+        return images
+
+    def info(self):
+        """returns (number of albums, number of images, total size)"""
+        with self.lock:
+            albums = self.conn.execute(
+                "SELECT COUNT(DISTINCT album_uri) FROM covers").fetchone()[0]
+        images = self.stored_images()
+        return albums, len(images), sum(size for _, size in images.values())
+
+    def remove_image(self, images, digest):
+        file_path, size = images.pop(digest)
+        rm_file(file_path)
+        self.memory.remove(digest)
+        return size
+
+    def prune(self, max_bytes):
+        """removes the images no album uses and then the covers of the
+        least recently used albums until the store fits in max_bytes,
+        returns the number of images removed"""
+        images = self.stored_images()
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT album_uri, size, digest FROM covers "
+                "ORDER BY used").fetchall()
+            refs = {}
+            for album_uri, size, digest in rows:
+                refs[digest] = refs.get(digest, 0) + 1
+
+            removed = 0
+            for digest in list(images):
+                if digest not in refs:
+                    self.remove_image(images, digest)
+                    removed += 1
+
+            total_size = sum(size for _, size in images.values())
+            for album_uri, size, digest in rows:
+                if total_size <= max_bytes:
+                    break
+                self.conn.execute(
+                    "DELETE FROM covers WHERE album_uri = ? AND size = ?",
+                    (album_uri, size))
+                refs[digest] -= 1
+                if refs[digest] == 0 and digest in images:
+                    total_size -= self.remove_image(images, digest)
+                    removed += 1
+            self.conn.commit()
+        return removed
+
+    def clear(self):
+        """removes every stored cover, returns the number of images"""
+        images = self.stored_images()
+        removed = len(images)
+        with self.lock:
+            self.conn.execute("DELETE FROM covers")
+            self.conn.commit()
+            for digest in list(images):
+                self.remove_image(images, digest)
+            self.conn.execute("VACUUM")
+        return removed
+
+    def stats_str(self):
+        return (str(self.hits) + " hits, " + str(self.misses) +
+                " misses, " + format_size(self.bytes_saved) + " saved")
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+def cover_store_command(args):
+    """the cover art part of 'spotify-ripper cache {info,prune,clear}'"""
+    path = cover_store_path()
+    if not path_exists(path):
+        print("Cover art store is empty (" + path + ")")
+        return
+
+    covers = CoverStore(args, None)
+    try:
+        if args.cache_command == "info":
+            albums, images, size = covers.info()
+            print("Cover art: " + path)
+            print("Total: " + str(images) + " images for " + str(albums) +
+                  " albums, " + format_size(size) + " (max " +
+                  format_size(args.cover_cache_size * MB_BYTES) + ")")
+        elif args.cache_command == "prune":
+            removed = covers.prune(args.cover_cache_size * MB_BYTES)
+            print("Removed " + str(removed) + " cover images, " +
+                  format_size(covers.info()[2]) + " left")
+        elif args.cache_command == "clear":
+            removed = covers.clear()
+            print("Removed " + str(removed) + " cover images")
+    finally:
+        covers.close()
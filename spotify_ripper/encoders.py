@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from subprocess import Popen, PIPE
+from spotify_ripper.utils import *
+from array import array
+import os
+import sys
+import wave
+
+PCM_READ_SIZE = 262144
+'''Number of bytes read at a time when encoding a raw PCM file'''
+
+try:
+    import aifc
+except ImportError:
+    aifc = None
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+
+class Encoder(object):
+    """Base class for encoder backends.  An encoder is created for every
+    output file, receives raw 16-bit stereo 44100Hz PCM frames through
+    write() and returns an exit code from close()"""
+
+    # (executable, package) needed by external encoders
+    dependency = None
+
+    def __init__(self, args, audio_file):
+        self.args = args
+        self.audio_file = audio_file
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def open(self):
+        raise NotImplementedError
+
+    def write(self, frame_bytes):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def abort(self):
+        try:
+            self.close()
+        except (IOError, OSError):
+            pass
+
+    def encode_file(self, pcm_file):
+        """encode a finished raw PCM file in one go (e.g. a spool file)"""
+        self.open()
+        try:
+            with open(enc_str(pcm_file), 'rb') as f:
+                while True:
+                    frame_bytes = f.read(PCM_READ_SIZE)
+                    if not frame_bytes:
+                        break
+                    self.write(frame_bytes)
+        except Exception:
+            self.abort()
+            raise
+        return self.close()
+
+
+class PipeEncoder(Encoder):
+    """Pipes frames to an external encoder process"""
+
+    proc = None
+
+    @classmethod
+    def is_available(cls):
+        return which(cls.dependency[0]) is not None
+
+    def command(self, audio_file_enc):
+        raise NotImplementedError
+
+    def popen_kwargs(self):
+        return {}
+
+    def open(self):
+        self.proc = Popen(self.command(enc_str(self.audio_file)),
+                          stdin=PIPE, **self.popen_kwargs())
+
+    def write(self, frame_bytes):
+        self.proc.stdin.write(frame_bytes)
+
+    def close(self):
+        self.proc.stdin.flush()
+        self.proc.stdin.close()
+
+        # wait for process to end before continuing
+        return self.proc.wait()
+
+    def abort(self):
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+
+    def encode_file(self, pcm_file):
+        # let the encoder read the file directly instead of piping it
+        with open(enc_str(pcm_file), 'rb') as f:
+            self.proc = Popen(self.command(enc_str(self.audio_file)),
+                              stdin=f, **self.popen_kwargs())
+            return self.proc.wait()
+
+
+class FlacPipeEncoder(PipeEncoder):
+    dependency = ("flac", "flac")
+
+    def command(self, audio_file_enc):
+        return ["flac", "-f", ("-" + str(self.args.comp)), "--silent",
+                "--endian", "little", "--channels", "2", "--bps", "16",
+                "--sample-rate", "44100", "--sign", "signed",
+                "--padding=" + str(self.args.tag_padding * KB_BYTES), "-o",
+                audio_file_enc, "-"]
+
+
+class SoxAiffEncoder(PipeEncoder):
+    dependency = ("sox", "sox")
+
+    def command(self, audio_file_enc):
+        return ["sox", "-q", "--endian",
+                "little", "--channels", "2", "--bits", "16", "--rate",
+                "44100", "--encoding", "unsigned-integer", "-t", "raw",
+                "-", audio_file_enc]
+
+
+class AlacEncoder(PipeEncoder):
+    dependency = ("avconv", "libav-tools")
+
+    def command(self, audio_file_enc):
+        return ["avconv", "-nostats", "-loglevel", "0", "-f", "s16le", "-ar",
+                "44100", "-ac", "2", "-channel_layout", "stereo", "-i", "-",
+                "-acodec", "alac", audio_file_enc]
+
+
+class OggEncoder(PipeEncoder):
+    dependency = ("oggenc", "vorbis-tools")
+
+    def command(self, audio_file_enc):
+        args = self.args
+        if args.cbr:
+            return ["oggenc", "--quiet", "--raw", "-b", args.bitrate, "-o",
+                    audio_file_enc, "-"]
+        else:
+            return ["oggenc", "--quiet", "--raw", "-q", args.vbr, "-o",
+                    audio_file_enc, "-"]
+
+
+class OpusEncoder(PipeEncoder):
+    dependency = ("opusenc", "opus-tools")
+
+    def command(self, audio_file_enc):
+        args = self.args
+        if args.cbr:
+            return ["opusenc", "--quiet", "--comp", args.comp, "--cvbr",
+                    "--bitrate", str(int(args.bitrate) / 2), "--raw",
+                    "--raw-rate", "44100", "-", audio_file_enc]
+        else:
+            return ["opusenc", "--quiet", "--comp", args.comp, "--vbr",
+                    "--bitrate", args.vbr, "--raw", "--raw-rate", "44100",
+                    "-", audio_file_enc]
+
+
+class AacEncoder(PipeEncoder):
+    dependency = ("faac", "faac")
+    dev_null = None
+
+    def command(self, audio_file_enc):
+        args = self.args
+        if args.cbr:
+            return ["faac", "-P", "-X", "-b", args.bitrate, "-o",
+                    audio_file_enc, "-"]
+        else:
+            return ["faac", "-P", "-X", "-q", args.vbr, "-o",
+                    audio_file_enc, "-"]
+
+    def popen_kwargs(self):
+        self.dev_null = open(os.devnull, 'wb')
+        return {"stdout": self.dev_null, "stderr": self.dev_null}
+
+    def close(self):
+        try:
+            return super(AacEncoder, self).close()
+        finally:
+            self.dev_null.close()
+
+    def encode_file(self, pcm_file):
+        try:
+            return super(AacEncoder, self).encode_file(pcm_file)
+        finally:
+            self.dev_null.close()
+
+
+class M4aEncoder(PipeEncoder):
+    dependency = ("fdkaac", "fdk-aac-encoder")
+
+    def command(self, audio_file_enc):
+        args = self.args
+        if args.cbr:
+            return ["fdkaac", "-S", "-R", "-b",
+                    args.bitrate, "-o", audio_file_enc, "-"]
+        else:
+            return ["fdkaac", "-S", "-R", "-m", args.vbr,
+                    "-o", audio_file_enc, "-"]
+
+
+class Mp3Encoder(PipeEncoder):
+    dependency = ("lame", "lame")
+
+    def command(self, audio_file_enc):
+        args = self.args
+        lame_args = ["lame", "--silent"]
+
+        if args.stereo_mode is not None:
+            lame_args.extend(["-m", args.stereo_mode])
+
+        if args.cbr:
+            lame_args.extend(["-cbr", "-b", args.bitrate])
+        else:
+            lame_args.extend(["-V", args.vbr])
+
+        # reserve room for the tags so they are written in place
+        if args.tag_padding > 0:
+            lame_args.extend(["--pad-id3v2-size",
+                              str(args.tag_padding * KB_BYTES)])
+
+        lame_args.extend(["-h", "-r", "-", audio_file_enc])
+        return lame_args
+
+
+class PcmEncoder(Encoder):
+    """Writes raw headerless PCM in-process"""
+
+    pcm_file = None
+
+    def open(self):
+        self.pcm_file = open(enc_str(self.audio_file), 'wb')
+
+    def write(self, frame_bytes):
+        self.pcm_file.write(frame_bytes)
+
+    def close(self):
+        self.pcm_file.flush()
+        os.fsync(self.pcm_file.fileno())
+        self.pcm_file.close()
+        return 0
+
+
+class WavEncoder(Encoder):
+    """Writes WAV files in-process"""
+
+    wav_file = None
+
+    def open(self):
+        wav_file = self.audio_file if sys.version_info >= (3, 0) \
+            else enc_str(self.audio_file)
+        self.wav_file = wave.open(wav_file, "wb")
+        self.wav_file.setparams((2, 2, 44100, 0, 'NONE', 'not compressed'))
+
+    def write(self, frame_bytes):
+        self.wav_file.writeframes(frame_bytes)
+
+    def close(self):
+        self.wav_file.close()
+        return 0
+
+
+class AiffEncoder(Encoder):
+    """Writes AIFF files in-process (AIFF samples are big-endian)"""
+
+    aiff_file = None
+
+    @classmethod
+    def is_available(cls):
+        return aifc is not None
+
+    def open(self):
+        aiff_file = self.audio_file if sys.version_info >= (3, 0) \
+            else enc_str(self.audio_file)
+        self.aiff_file = aifc.open(aiff_file, "wb")
+        self.aiff_file.setparams((2, 2, 44100, 0, b'NONE', b'not compressed'))
+
+    def write(self, frame_bytes):
+        if sys.byteorder == "little":
+            samples = array(str("h"))
+            if sys.version_info >= (3, 0):
+                samples.frombytes(frame_bytes)
+            else:
+                samples.fromstring(frame_bytes)
+            samples.byteswap()
+            frame_bytes = samples.tobytes() if sys.version_info >= (3, 0) \
+                else samples.tostring()
+        self.aiff_file.writeframes(frame_bytes)
+
+    def close(self):
+        self.aiff_file.close()
+        return 0
+
+
+class SoundFileFlacEncoder(Encoder):
+    """Writes FLAC files in-process through libFLAC (via pysoundfile)"""
+
+    flac_file = None
+
+    @classmethod
+    def is_available(cls):
+        return soundfile is not None and \
+            "FLAC" in soundfile.available_formats()
+
+    def open(self):
+        kwargs = {"mode": "w", "samplerate": 44100, "channels": 2,
+                  "subtype": "PCM_16", "format": "FLAC"}
+
+        # newer versions of pysoundfile take a compression level (0 to 1)
+        try:
+            self.flac_file = soundfile.SoundFile(
+                enc_str(self.audio_file),
+                compression_level=min(int(self.args.comp), 8) / 8.0,
+                **kwargs)
+        except TypeError:
+            self.flac_file = soundfile.SoundFile(
+                enc_str(self.audio_file), **kwargs)
+
+    def write(self, frame_bytes):
+        self.flac_file.buffer_write(frame_bytes, dtype="int16")
+
+    def close(self):
+        self.flac_file.close()
+        return 0
+
+
+# output types mapped to their backends in order of preference,
+# the first available backend is used
+encoder_registry = {
+    "wav": [WavEncoder],
+    "pcm": [PcmEncoder],
+    "aiff": [AiffEncoder, SoxAiffEncoder],
+    "flac": [SoundFileFlacEncoder, FlacPipeEncoder],
+    "alac.m4a": [AlacEncoder],
+    "ogg": [OggEncoder],
+    "opus": [OpusEncoder],
+    "aac": [AacEncoder],
+    "m4a": [M4aEncoder],
+    "mp3": [Mp3Encoder],
+}
+
+
+def register_encoder(output_type, encoder_class, preferred=True):
+    backends = encoder_registry.setdefault(output_type, [])
+    if preferred:
+        backends.insert(0, encoder_class)
+    else:
+        backends.append(encoder_class)
+
+
+def find_encoder(output_type):
+    for encoder_class in encoder_registry.get(output_type, []):
+        if encoder_class.is_available():
+            return encoder_class
+    return None
+
+
+def missing_dependency(output_type):
+    """returns the (executable, package) pair to install when no backend
+    is available for the output type"""
+    if find_encoder(output_type) is not None:
+        return None
+    for encoder_class in encoder_registry.get(output_type, []):
+        if encoder_class.dependency is not None:
+            return encoder_class.dependency
+    return None
+
+
+def new_encoder(args, output_type, audio_file):
+    encoder_class = find_encoder(output_type)
+    if encoder_class is None:
+        raise RuntimeError("No encoder available for " + output_type)
+    return encoder_class(args, audio_file)
+
+
+def create_encoder(args, output_type, audio_file):
+    encoder = new_encoder(args, output_type, audio_file)
+    encoder.open()
+    return encoder
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+WEB_API_RATE = 5.0
+'''Requests per second sent to Spotify's Web API, shared by all threads'''
+
+WEB_API_BURST = 5
+'''Requests that may be sent at once after being idle'''
+
+RETRY_BACKOFF = 1.0
+RETRY_BACKOFF_MAX = 30.0
+
+# responses worth asking for again
+retry_status_codes = {429, 500, 502, 503, 504}
+
+
+class TokenBucket(object):
+    """Limits the request rate across threads, a 429 response pauses
+    every request until its Retry-After has passed"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self.tokens = 0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(
+                        self.burst,
+                        self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class EndpointStats(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.latency = 0.0
+
+    def __str__(self):
+        avg = (self.latency / self.requests) if self.requests > 0 else 0
+        return (str(self.requests) + " requests, " +
+                "%.0f ms avg, " % (avg * 1000) +
+                str(self.retries) + " retries, " +
+                str(self.failures) + " failures")
+
+
+class HttpClient(object):
+    """One pooled session shared by every Web API call so connections
+    (and their TLS handshakes) are reused, with timeouts, retries with
+    jittered backoff and a shared rate limit"""
+
+    def __init__(self, args):
+        self.args = args
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.bucket = TokenBucket(WEB_API_RATE, WEB_API_BURST)
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def endpoint_stats(self, endpoint):
+        with self.stats_lock:
+            stats = self.stats.get(endpoint)
+            if stats is None:
+                stats = EndpointStats()
+                self.stats[endpoint] = stats
+            return stats
+
+    def retry_after(self, res):
+        value = res.headers.get("Retry-After")
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    def backoff(self, attempt):
+        delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.5)
+
+    def get(self, url, endpoint, headers=None):
+        """returns the last response, raises the connection error or
+        timeout if no response was received after all retries"""
+        args = self.args
+        stats = self.endpoint_stats(endpoint)
+        res = None
+        error = None
+
+        for attempt in range(args.web_retries + 1):
+            if attempt > 0:
+                stats.retries += 1
+
+            self.bucket.acquire()
+            start = time.time()
+            try:
+                res = self.session.get(url, headers=headers,
+                                       timeout=args.web_timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                res = None
+                error = e
+            else:
+                error = None
+            stats.requests += 1
+            stats.latency += time.time() - start
+
+            if res is not None and res.status_code not in retry_status_codes:
+                return res
+            if attempt == args.web_retries:
+                break
+
+            delay = None
+            if res is not None and res.status_code == 429:
+                delay = self.retry_after(res)
+                if delay is not None:
+                    # everyone waits, not just this request
+                    self.bucket.pause(delay)
+            if delay is None:
+                delay = self.backoff(attempt)
+
+            reason = str(error) if error is not None else \
+                "HTTP " + str(res.status_code)
+            print(Fore.YELLOW + "Web API request failed (" + reason +
+                  "), retrying in " + "%.1f" % delay + " seconds" +
+                  Fore.RESET)
+            time.sleep(delay)
+
+        stats.failures += 1
+        if res is None:
+            raise error
+        return res
+
+    def print_stats(self):
+        with self.stats_lock:
+            items = sorted(self.stats.items())
+        if len(items) > 0:
+            print("Web API requests:")
+        for endpoint, stats in items:
+            print("  " + Fore.YELLOW + endpoint.ljust(16) + Fore.RESET +
+                  str(stats))
+
+    def close(self):
+        self.session.close()
@@ -6,12 +6,14 @@ from __future__ import unicode_literals
 from colorama import init, Fore, AnsiToWin32
 from spotify_ripper.ripper import Ripper
 from spotify_ripper.utils import *
+from spotify_ripper.encoders import missing_dependency
+from spotify_ripper.covers import can_resize
 import os
 import sys
 import codecs
 import argparse
+import multiprocessing
 import pkg_resources
-import schedule
 import signal
 import select
 import tty
@@ -34,7 +36,7 @@ def load_config(defaults):
                 return defaults
             config_items = dict(config.items("main"))
 
-            to_array_options = ["replace", "tag_override"]
+            to_array_options = ["replace", "tag_override", "output"]
 
             # coerce boolean and none types
             config_items_new = {}
@@ -109,6 +111,82 @@ def partial_check_type(v):
         raise argparse.ArgumentTypeError("String '" + v +
             "' does not match none, weak, weak:<sec>, strict")
 
+output_type_names = {
+    "mp3": "mp3",
+    "flac": "flac",
+    "aiff": "aiff",
+    "alac": "alac.m4a",
+    "vorbis": "ogg",
+    "ogg": "ogg",
+    "opus": "opus",
+    "aac": "aac",
+    "mp4": "m4a",
+    "m4a": "m4a",
+    "wav": "wav",
+    "pcm": "pcm",
+}
+
+
+def parse_output_spec(v):
+    """parses an --output value such as "mp3,vbr=0" or
+    "opus,bitrate=128,format=Opus/{artist} - {track_name}.{ext}"
+    (format must come last since it can contain commas)"""
+    name, _, rest = v.strip().partition(",")
+    if name not in output_type_names:
+        raise ValueError("Unknown output type '" + name + "', choose from " +
+                         ", ".join(sorted(output_type_names.keys())))
+
+    spec = {"output_type": output_type_names[name]}
+    while rest:
+        if rest.startswith("format="):
+            spec["format"] = rest[len("format="):]
+            break
+
+        item, _, rest = rest.partition(",")
+        key, sep, value = item.partition("=")
+        if key not in {"vbr", "bitrate", "comp"} or not sep:
+            raise ValueError("Invalid output setting '" + item + "' in '" +
+                             v + "', use vbr, bitrate, comp or format")
+        spec[key] = value
+
+    # a bitrate implies CBR encoding and a VBR quality implies VBR
+    if "bitrate" in spec:
+        spec["cbr"] = True
+    if "vbr" in spec:
+        spec["cbr"] = False
+    return spec
+
+
+def set_encoding_defaults(args):
+    if args.output_type == "flac":
+        if args.comp == "10":
+            args.comp = "8"
+    elif args.output_type == "ogg":
+        if args.vbr == "0":
+            args.vbr = "9"
+    elif args.output_type == "opus":
+        if args.vbr == "0":
+            args.vbr = "320"
+    elif args.output_type == "aac":
+        if args.vbr == "0":
+            args.vbr = "500"
+    elif args.output_type == "m4a":
+        if args.vbr == "0":
+            args.vbr = "5"
+
+
+def extra_output_args(base_args, format_str, spec):
+    out_args = argparse.Namespace(**vars(base_args))
+    out_args.format = format_str
+    for key, value in spec.items():
+        setattr(out_args, key, value)
+    set_encoding_defaults(out_args)
+
+    out_args.is_extra_output = True
+    out_args.extra_outputs = []
+    return out_args
+
+
 def main(prog_args=sys.argv[1:]):
     # in case we changed the location of the settings directory where the
     # config file lives, we need to parse this argument before we parse
@@ -127,11 +205,58 @@ def main(prog_args=sys.argv[1:]):
         "bitrate": "320",
         "quality": "320",
         "comp": "10",
+        "cover_cache_size": "256",
+        "cover_quality": "90",
         "vbr": "0",
         "partial_check": "weak",
+        "writer_buffer": "16",
+        "write_buffer_size": "256",
+        "delivery_buffer": "16",
+        "transcode_workers": str(multiprocessing.cpu_count()),
+        "prefetch_tracks": "3",
+        "post_workers": "2",
+        "web_cache_size": "64",
+        "web_retries": "3",
+        "web_timeout": "10",
     }
     defaults = load_config(defaults)
 
+    # 'spotify-ripper cache {info,prune,clear}' manages the Web API cache
+    # and the cover art store
+    if len(remaining_argv) > 0 and remaining_argv[0] == "cache":
+        cache_parser = argparse.ArgumentParser(
+            prog='spotify-ripper cache',
+            description='Inspect or trim the on-disk Web API cache and '
+                        'cover art store',
+            parents=[settings_parser])
+        cache_parser.add_argument(
+            'cache_command', choices=['info', 'prune', 'clear'])
+        cache_parser.add_argument(
+            '--cover-cache-size', type=int,
+            default=int(defaults["cover_cache_size"]),
+            help='Max size in MB of the stored cover art [Default=256]')
+        cache_parser.add_argument(
+            '--web-cache-size', type=int,
+            default=int(defaults["web_cache_size"]),
+            help='Max size in MB of the on-disk Web API cache '
+                 '[Default=64]')
+        cache_args = cache_parser.parse_args(remaining_argv[1:])
+        cache_args.settings = args.settings
+        cache_args.ascii = False
+        cache_args.has_log = False
+        init_util_globals(cache_args)
+        init(strip=None)
+
+        from spotify_ripper.webcache import cache_command
+        cache_command(cache_args)
+        return
+
+    # 'spotify-ripper retag [options]' rewrites the tags of ripped files
+    # using the same options as a rip
+    is_retag = len(remaining_argv) > 0 and remaining_argv[0] == "retag"
+    if is_retag:
+        remaining_argv = remaining_argv[1:]
+
     parser = argparse.ArgumentParser(
         prog='spotify-ripper',
         description='Rips Spotify URIs to MP3s with ID3 tags and album covers',
@@ -143,6 +268,7 @@ def main(prog_args=sys.argv[1:]):
     rip a list of URIs: spotify-ripper -u user list_of_uris.txt
     rip tracks from Spotify's charts: spotify-ripper -l spotify:charts:regional:global:weekly:latest
     search for tracks to rip: spotify-ripper -l -Q 160 -o "album:Rumours track:'the chain'"
+    update the tags of ripped files: spotify-ripper retag --genres artist
     ''')
 
     # create group to prevent user from using both the -l and -u option
@@ -156,7 +282,7 @@ def main(prog_args=sys.argv[1:]):
         else:
             group = parser.add_mutually_exclusive_group(required=False)
     else:
-        group = parser.add_mutually_exclusive_group(required=True)
+        group = parser.add_mutually_exclusive_group(required=not is_retag)
 
     encoding_group = parser.add_mutually_exclusive_group(required=False)
 
@@ -205,6 +331,11 @@ def main(prog_args=sys.argv[1:]):
         '--comment',
         help='Set comment metadata tag to all songs. Can include '
              'same tags as --format.')
+    parser.add_argument(
+        '--cover-cache-size', type=int,
+        help='Max size in MB of the cover art kept between runs, the '
+             'covers of the albums used longest ago are removed first '
+             '[Default=256]')
     parser.add_argument(
         '--cover-file',
         help='Save album cover image to file name (e.g "cover.jpg") '
@@ -212,6 +343,19 @@ def main(prog_args=sys.argv[1:]):
     parser.add_argument(
         '--cover-file-and-embed', metavar="COVER_FILE",
         help='Same as --cover-file but embeds the cover image too')
+    parser.add_argument(
+        '--cover-quality', type=int,
+        help='JPEG quality of cover art resized with --cover-size '
+             '[Default=90]')
+    parser.add_argument(
+        '--cover-size', type=int,
+        help='Scale cover art down to fit in this many pixels, once per '
+             'album, before it is embedded or saved (requires Pillow) '
+             '[Default=original size]')
+    parser.add_argument(
+        '--delivery-buffer', type=int,
+        help='Maximum memory in MB for captured audio waiting to be '
+             'ripped before Spotify is asked to redeliver it [Default=16]')
     parser.add_argument(
         '-d', '--directory',
         help='Base directory where ripped MP3s are saved [Default=cwd]')
@@ -288,13 +432,20 @@ def main(prog_args=sys.argv[1:]):
     encoding_group.add_argument(
         '--opus', action='store_true',
         help='Rip songs to Opus encoding instead of MP3')
+    parser.add_argument(
+        '--output', nargs="+", required=False,
+        help='Also encode the ripped audio to these formats, each with '
+             'optional settings and its own format string (e.g. '
+             '\'flac\' \'mp3,vbr=0\' \'opus,bitrate=128,format=Opus/'
+             '{artist} - {track_name}.{ext}\')')
     parser.add_argument(
         '--partial-check', metavar="{none,weak,weak:<sec>,strict}", type=partial_check_type,
         help='Check for and overwrite partially ripped files. "weak" will '
              'err on the side of not re-ripping the file if it is unsure, '
              'whereas "strict" will re-rip the file.  You can override the '
              'number of seconds of wiggle-room for the "weak" check using '
-             '"weak:<sec>" [Default=weak:3]')
+             '"weak:<sec>".  Files the manifest has a matching record of '
+             'are checked without being parsed [Default=weak:3]')
     parser.add_argument(
         '--play-token-resume', metavar="RESUME_AFTER",
         help='If the \'play token\' is lost to a different device using '
@@ -322,6 +473,16 @@ def main(prog_args=sys.argv[1:]):
     parser.add_argument(
         '--plus-wav', action='store_true',
         help='Saves a .wav file in addition to the encoded file (e.g. mp3)')
+    parser.add_argument(
+        '--post-workers', type=int,
+        help='Number of threads tagging and finalizing ripped tracks '
+             'while the next track is ripped, 0 tags on the ripping '
+             'thread [Default=2]')
+    parser.add_argument(
+        '--prefetch-tracks', type=int,
+        help='Number of upcoming tracks whose metadata and cover art is '
+             'loaded while the current track is ripped, 0 disables '
+             'prefetching [Default=3]')
     parser.add_argument(
         '-q', '--vbr',
         help='VBR quality setting or target bitrate for Opus [Default=0]')
@@ -332,6 +493,10 @@ def main(prog_args=sys.argv[1:]):
         '--remove-offline-cache', action='store_true',
         help='Remove libspotify\'s offline cache directory after the rip'
              'is complete to save disk space')
+    parser.add_argument(
+        '--rerip-changed-settings', action='store_true',
+        help='Re-rip files the manifest shows were encoded with other '
+             'output settings (e.g. after changing --vbr) [Default=no]')
     parser.add_argument(
         '--resume-after',
         help='Resumes script after a certain amount of time has passed '
@@ -346,6 +511,14 @@ def main(prog_args=sys.argv[1:]):
     parser.add_argument(
         '-s', '--strip-colors', action='store_true',
         help='Strip coloring from output [Default=colors]')
+    parser.add_argument(
+        '--spool', action='store_true',
+        help='Capture raw PCM to a spool directory and transcode finished '
+             'tracks in parallel instead of encoding while ripping')
+    parser.add_argument(
+        '--spool-dir',
+        help='Directory for spooled PCM files, e.g. a tmpfs mount '
+             '[Default=Settings Directory/Spool]')
     parser.add_argument(
         '--stereo-mode', choices=['j', 's', 'f', 'd', 'm', 'l', 'r'],
         help='Advanced stereo settings for Lame MP3 encoder only')
@@ -354,12 +527,22 @@ def main(prog_args=sys.argv[1:]):
         help='Stops script after a certain amount of time has passed '
              '(e.g. 1h30m). Alternatively, accepts a specific time in 24hr '
              'format to stop after (e.g 03:30, 16:15)')
+    parser.add_argument(
+        '--tag-padding', type=int,
+        help='Space in KB reserved in MP3 and FLAC files so tags and '
+             'cover art are written without rewriting the file, 0 '
+             'disables it [Default=64, 320 with --large-cover-art, 8 with '
+             '--cover-file]')
     parser.add_argument(
         '--tag-override', nargs="+", required=False,
         help='Overrides a metadata tag with custom data (e.g. \'album={playlist}\')')
     parser.add_argument(
         '--timeout', type=int,
         help='Override the PySpotify timeout value in seconds (Default=10 seconds)')
+    parser.add_argument(
+        '--transcode-workers', type=int,
+        help='Number of processes transcoding spooled files when using '
+             '--spool [Default=number of CPU cores]')
     parser.add_argument(
         '-V', '--version', action='version', version=prog_version)
     encoding_group.add_argument(
@@ -369,6 +552,25 @@ def main(prog_args=sys.argv[1:]):
         '--windows-safe', action='store_true',
         help='Make filename safe for Windows file system '
              '(truncate filename to 255 characters)')
+    parser.add_argument(
+        '--web-cache-size', type=int,
+        help='Max size in MB of the on-disk Web API cache, 0 disables '
+             'the cache [Default=64]')
+    parser.add_argument(
+        '--web-retries', type=int,
+        help='Number of times a failed Web API request is retried '
+             '[Default=3]')
+    parser.add_argument(
+        '--web-timeout', type=float,
+        help='Timeout in seconds of Web API requests [Default=10]')
+    parser.add_argument(
+        '--write-buffer-size', type=int,
+        help='Size in KB of the buffers audio is collected into before '
+             'it is written to the encoder [Default=256]')
+    parser.add_argument(
+        '--writer-buffer', type=int,
+        help='Number of write buffers queued between the capture loop '
+             'and the encoder [Default=16]')
     encoding_group.add_argument(
         '--vorbis', action='store_true',
         help='Rip songs to Ogg Vorbis encoding instead of MP3')
@@ -378,7 +580,7 @@ def main(prog_args=sys.argv[1:]):
              'THEIR SERVERS] Delete tracks from playlist after successful '
              'ripping [Default=no]')
     parser.add_argument(
-        'uri', nargs="+",
+        'uri', nargs="*" if is_retag else "+",
         help='One or more Spotify URI(s) (either URI, a file of URIs or a '
              'search query)')
     args = parser.parse_args(remaining_argv)
@@ -428,101 +630,134 @@ def main(prog_args=sys.argv[1:]):
         print("YOU WILL NOT SEE ANY CHANGES TO YOUR PLAYLIST ON THE " +
               "OFFICIAL SPOTIFY DESKTOP OR WEB APP." + Fore.RESET)
 
+    if args.cover_size is not None and not can_resize():
+        print(Fore.YELLOW + "Warning: --cover-size requires Pillow, "
+              "cover art will not be resized" + Fore.RESET)
+
+    # room for the tags and the embedded cover art
+    if args.tag_padding is None:
+        if args.cover_file is not None:
+            args.tag_padding = 8
+        elif args.large_cover_art:
+            args.tag_padding = 320
+        else:
+            args.tag_padding = 64
+
+    # keep the user's encoder settings for any extra outputs
+    base_args = argparse.Namespace(**vars(args))
+
     if args.wav:
         args.output_type = "wav"
     elif args.pcm:
         args.output_type = "pcm"
     elif args.flac:
         args.output_type = "flac"
-        if args.comp == "10":
-            args.comp = "8"
     elif args.vorbis:
         args.output_type = "ogg"
-        if args.vbr == "0":
-            args.vbr = "9"
     elif args.opus:
         args.output_type = "opus"
-        if args.vbr == "0":
-            args.vbr = "320"
     elif args.aac:
         args.output_type = "aac"
-        if args.vbr == "0":
-            args.vbr = "500"
     elif args.mp4:
         args.output_type = "m4a"
-        if args.vbr == "0":
-            args.vbr = "5"
     elif args.alac:
         args.output_type = "alac.m4a"
     else:
         args.output_type = "mp3"
+    set_encoding_defaults(args)
+
+    # format string
+    if args.flat:
+        args.format = "{artist} - {track_name}.{ext}"
+    elif args.flat_with_index:
+        args.format = "{idx:3} - {artist} - {track_name}.{ext}"
+    elif args.format is None:
+        args.format = "{album_artist}/{album}/{artist} - {track_name}.{ext}"
+
+    # extra outputs encoded from the same rip
+    output_specs = args.output if args.output is not None else []
+    if args.plus_wav:
+        output_specs.append("wav")
+    if args.plus_pcm:
+        output_specs.append("pcm")
+
+    args.is_extra_output = False
+    args.extra_outputs = []
+    for output_spec in output_specs:
+        try:
+            spec = parse_output_spec(output_spec)
+        except ValueError as e:
+            parser.error(str(e))
+        if spec["output_type"] == args.output_type and \
+                spec.get("format", args.format) == args.format:
+            continue
+        args.extra_outputs.append(
+            extra_output_args(base_args, args.format, spec))
+
+    if is_retag:
+        # patch a bug when Python 3/MP4
+        if sys.version_info >= (3, 0):
+            patch_bug_in_mutagen()
+
+        from spotify_ripper.retag import retag_command
+        retag_command(args)
+        return
 
     # check that encoder tool is available
-    encoders = {
-        "flac": ("flac", "flac"),
-        "aiff": ("sox", "sox"),
-        "aac": ("faac", "faac"),
-        "ogg": ("oggenc", "vorbis-tools"),
-        "opus": ("opusenc", "opus-tools"),
-        "mp3": ("lame", "lame"),
-        "m4a": ("fdkaac", "fdk-aac-encoder"),
-        "alac.m4a": ("avconv", "libav-tools"),
-    }
-    if args.output_type in encoders.keys():
-        encoder = encoders[args.output_type][0]
-        if which(encoder) is None:
+    for out_args in [args] + args.extra_outputs:
+        dependency = missing_dependency(out_args.output_type)
+        if dependency is not None:
+            encoder = dependency[0]
             print(Fore.RED + "Missing dependency '" + encoder +
                   "'.  Please install and add to path..." + Fore.RESET)
             # assumes OS X or Ubuntu/Debian
             command_help = ("brew install " if sys.platform == "darwin"
                             else "sudo apt-get install ")
             print("...try " + Fore.YELLOW + command_help +
-                  encoders[args.output_type][1] + Fore.RESET)
+                  dependency[1] + Fore.RESET)
             sys.exit(1)
 
-    # format string
-    if args.flat:
-        args.format = "{artist} - {track_name}.{ext}"
-    elif args.flat_with_index:
-        args.format = "{idx:3} - {artist} - {track_name}.{ext}"
-    elif args.format is None:
-        args.format = "{album_artist}/{album}/{artist} - {track_name}.{ext}"
-
     # print some settings
     print(Fore.GREEN + "Spotify Ripper - v" + prog_version + Fore.RESET)
 
-    def encoding_output_str():
-        if args.output_type == "wav":
+    def encoding_output_str(out_args):
+        if out_args.output_type == "wav":
             return "WAV, Stereo 16bit 44100Hz"
-        elif args.output_type == "pcm":
+        elif out_args.output_type == "pcm":
             return "Raw Headerless PCM, Stereo 16bit 44100Hz"
         else:
-            if args.output_type == "flac":
-                return "FLAC, Compression Level: " + args.comp
-            elif args.output_type == "aiff":
+            if out_args.output_type == "flac":
+                return "FLAC, Compression Level: " + out_args.comp
+            elif out_args.output_type == "aiff":
                 return "AIFF"
-            elif args.output_type == "alac.m4a":
+            elif out_args.output_type == "alac.m4a":
                 return "Apple Lossless (ALAC)"
-            elif args.output_type == "ogg":
+            elif out_args.output_type == "ogg":
                 codec = "Ogg Vorbis"
-            elif args.output_type == "opus":
+            elif out_args.output_type == "opus":
                 codec = "Opus"
-            elif args.output_type == "mp3":
+            elif out_args.output_type == "mp3":
                 codec = "MP3"
-            elif args.output_type == "m4a":
+            elif out_args.output_type == "m4a":
                 codec = "MPEG4 AAC"
-            elif args.output_type == "aac":
+            elif out_args.output_type == "aac":
                 codec = "AAC"
             else:
                 codec = "Unknown"
 
-            if args.cbr:
-                return codec + ", CBR " + args.bitrate + " kbps"
+            if out_args.cbr:
+                return codec + ", CBR " + out_args.bitrate + " kbps"
             else:
-                return codec + ", VBR " + args.vbr
+                return codec + ", VBR " + out_args.vbr
 
     print(Fore.YELLOW + "  Encoding output:\t" +
-          Fore.RESET + encoding_output_str())
+          Fore.RESET + encoding_output_str(args))
+    for out_args in args.extra_outputs:
+        print(Fore.YELLOW + "  Extra output:\t\t" +
+              Fore.RESET + encoding_output_str(out_args))
+        if out_args.format != args.format:
+            print(Fore.YELLOW + "    Format String:\t" +
+                  Fore.RESET + out_args.format)
     print(Fore.YELLOW + "  Spotify bitrate:\t" +
           Fore.RESET + args.quality + " kbps")
 
@@ -561,7 +796,8 @@ def main(prog_args=sys.argv[1:]):
 
     # patch a bug when Python 3/MP4
     if sys.version_info >= (3, 0) and \
-            (args.output_type == "m4a" or args.output_type == "alac.m4a"):
+            any(out_args.output_type in {"m4a", "alac.m4a"}
+                for out_args in [args] + args.extra_outputs):
         patch_bug_in_mutagen()
 
     ripper = Ripper(args)
@@ -622,8 +858,6 @@ def main(prog_args=sys.argv[1:]):
             tty.setcbreak(sys.stdin.fileno())
 
         while ripper.isAlive():
-            schedule.run_pending()
-
             # check if the escape button was pressed
             if not args.has_log and hasStdinData():
                 c = sys.stdin.read(1)
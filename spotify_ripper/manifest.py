@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+import json
+import os
+import sqlite3
+import threading
+
+
+def encoder_settings(args):
+    """short description of the encoder settings an output was made with"""
+    if args.output_type in {"flac", "opus"}:
+        settings = "comp=" + str(args.comp)
+    else:
+        settings = ""
+
+    if args.output_type in {"ogg", "opus", "aac", "m4a", "mp3"}:
+        quality = "bitrate=" + str(args.bitrate) if args.cbr \
+            else "vbr=" + str(args.vbr)
+        settings = settings + "," + quality if settings else quality
+
+    if args.output_type == "mp3" and args.stereo_mode is not None:
+        settings += ",stereo_mode=" + args.stereo_mode
+    return settings
+
+
+class Manifest(object):
+    """Persistent record of every completed output so later runs can
+    decide whether a file is complete without parsing it"""
+
+    schema = ("CREATE TABLE IF NOT EXISTS outputs ("
+              "path TEXT PRIMARY KEY, "
+              "uri TEXT NOT NULL, "
+              "output_type TEXT, "
+              "settings TEXT, "
+              "samples INTEGER, "
+              "duration INTEGER, "
+              "size INTEGER, "
+              "mtime REAL, "
+              "metadata TEXT, "
+              "tag_hash TEXT)")
+
+    # columns added after the first version of the table
+    added_columns = [("metadata", "TEXT"), ("tag_hash", "TEXT")]
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+
+        _settings_dir = settings_dir()
+        if not path_exists(_settings_dir):
+            os.makedirs(enc_str(_settings_dir))
+        self.db_path = os.path.join(_settings_dir, "manifest.db")
+
+        # shared between the ripper thread and the main thread
+        self.conn = sqlite3.connect(
+            enc_str(self.db_path), check_same_thread=False)
+        with self.lock:
+            self.conn.execute(self.schema)
+            columns = [row[1] for row in self.conn.execute(
+                "PRAGMA table_info(outputs)")]
+            for name, column_type in self.added_columns:
+                if name not in columns:
+                    self.conn.execute("ALTER TABLE outputs ADD COLUMN " +
+                                      name + " " + column_type)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS outputs_uri "
+                              "ON outputs (uri)")
+            self.conn.commit()
+
+    def file_stat(self, audio_file):
+        try:
+            stat = os.stat(enc_str(audio_file))
+            return stat.st_size, stat.st_mtime
+        except OSError:
+            return None, None
+
+    def record(self, track, out_args, audio_file, samples, snapshot=None,
+               tag_hash=None):
+        size, mtime = self.file_stat(audio_file)
+        if size is None:
+            return
+
+        metadata = json.dumps(snapshot) if snapshot is not None else None
+        try:
+            with self.lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO outputs VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (audio_file, track.link.uri, out_args.output_type,
+                     encoder_settings(out_args), samples, track.duration,
+                     size, mtime, metadata, tag_hash))
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(Fore.YELLOW + "Warning: could not update manifest: " +
+                  str(e) + Fore.RESET)
+
+    def tagged_outputs(self):
+        """returns (path, output_type, metadata, tag_hash) of every
+        output that has a metadata snapshot"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path, output_type, metadata, tag_hash "
+                "FROM outputs WHERE metadata IS NOT NULL "
+                "ORDER BY path").fetchall()
+        return [(path, output_type, json.loads(metadata), tag_hash)
+                for path, output_type, metadata, tag_hash in rows]
+
+    def update_tag_hash(self, audio_file, tag_hash, output_type=None,
+                        snapshot=None):
+        """the file was retagged, the manifest keeps trusting it (the
+        change is committed on close).  A snapshot made from the tags of
+        a file the manifest had no metadata of is stored with it"""
+        size, mtime = self.file_stat(audio_file)
+        with self.lock:
+            if snapshot is not None:
+                # the track uri isn't known from the tags
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO outputs (path, uri, output_type) "
+                    "VALUES (?, '', ?)", (audio_file, output_type))
+                self.conn.execute(
+                    "UPDATE outputs SET metadata = ? WHERE path = ?",
+                    (json.dumps(snapshot), audio_file))
+            self.conn.execute(
+                "UPDATE outputs SET tag_hash = ?, size = ?, mtime = ? "
+                "WHERE path = ?", (tag_hash, size, mtime, audio_file))
+
+    def lookup(self, audio_file):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT uri, output_type, settings, samples, duration, "
+                "size, mtime FROM outputs WHERE path = ?",
+                (audio_file, )).fetchone()
+
+    def is_current(self, track, audio_file):
+        """whether the manifest's record of the file is for the track and
+        the file as it is on disk now"""
+        row = self.lookup(audio_file)
+        if row is None:
+            return False
+
+        uri, output_type, settings, samples, duration, size, mtime = row
+        return uri == track.link.uri and \
+            (size, mtime) == self.file_stat(audio_file)
+
+    def settings_changed(self, out_args, audio_file):
+        """whether the file was recorded with other encoder settings,
+        files the manifest doesn't know the settings of never are"""
+        row = self.lookup(audio_file)
+        if row is None or row[2] is None:
+            return False
+        return (row[1], row[2]) != \
+            (out_args.output_type, encoder_settings(out_args))
+
+    def adopt(self, track, audio_file, duration):
+        """the file was checked and is complete, remember it as it is on
+        disk now so later runs don't parse it again"""
+        size, mtime = self.file_stat(audio_file)
+        if size is None:
+            return
+
+        samples = int(round(duration * 44100))
+        try:
+            with self.lock:
+                cursor = self.conn.execute(
+                    "UPDATE outputs SET uri = ?, samples = ?, duration = ?, "
+                    "size = ?, mtime = ? WHERE path = ?",
+                    (track.link.uri, samples, track.duration, size, mtime,
+                     audio_file))
+                # the settings it was encoded with aren't known
+                if cursor.rowcount == 0:
+                    self.conn.execute(
+                        "INSERT INTO outputs (path, uri, samples, duration, "
+                        "size, mtime) VALUES (?, ?, ?, ?, ?, ?)",
+                        (audio_file, track.link.uri, samples,
+                         track.duration, size, mtime))
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(Fore.YELLOW + "Warning: could not update manifest: " +
+                  str(e) + Fore.RESET)
+
+    def rename(self, audio_file, new_audio_file):
+        """the file was moved, by a playlist sync"""
+        try:
+            with self.lock:
+                self.conn.execute(
+                    "UPDATE OR REPLACE outputs SET path = ? WHERE path = ?",
+                    (new_audio_file, audio_file))
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(Fore.YELLOW + "Warning: could not update manifest: " +
+                  str(e) + Fore.RESET)
+
+    def captured_duration(self, audio_file, track):
+        """seconds of audio captured into the file, or None if the
+        manifest has no record of the file as it is on disk now"""
+        row = self.lookup(audio_file)
+        if row is None:
+            return None
+
+        uri, output_type, settings, samples, duration, size, mtime = row
+        if uri != track.link.uri or samples is None:
+            return None
+
+        # the file was changed by something else, so don't trust it
+        if (size, mtime) != self.file_stat(audio_file):
+            return None
+
+        return samples / 44100.0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.context import TrackContext
+import threading
+import traceback
+import spotify
+
+
+class PlanEntry(object):
+    """A track to rip with its output path and skip decision"""
+
+    # one of "unavailable", "new", "outdated", "partial", "missing_outputs"
+    # or "complete", "error" if checking the track failed (the ripping
+    # loop tries again) and None if it hasn't been checked
+    status = None
+    audio_file = None
+    prefetched = False
+
+    def __init__(self, group, idx, track, ripper):
+        self.group = group
+        self.idx = idx
+        self.track = track
+
+        # the plan thread and the ripping loop can both check the entry
+        self.lock = threading.RLock()
+        self.track_context = TrackContext(
+            ripper, idx, track, group.playlist, group.album, group.chart)
+
+
+class PlanGroup(object):
+    """The tracks resolved from one URI along with the playlist, album
+    or chart they were loaded from"""
+
+    playlist = None
+    album = None
+    chart = None
+
+    # position in the plan's groups
+    pos = None
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.entries = []
+
+    @property
+    def context(self):
+        return (self.playlist, self.album, self.chart)
+
+
+class RipPlan(threading.Thread):
+    """Every URI is resolved exactly once into an ordered list of entries
+    that the totals, the ripping loop, sync and the playlist files share.
+
+    URIs are resolved and the skip decisions made on a background thread,
+    the ripping loop can start on a group as soon as it is resolved"""
+
+    name = 'SpotifyRipperPlanThread'
+
+    def __init__(self, args, ripper, uris):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.args = args
+        self.ripper = ripper
+        self.uris = uris
+        self.groups = []
+        self.resolved = False
+        self.cond = threading.Condition()
+
+    def single_track(self):
+        """whether the plan can only ever hold a single track"""
+        if len(self.uris) != 1:
+            return False
+        uri = self.uris[0]
+        if isinstance(uri, list):
+            return len(uri) <= 1
+        return uri.startswith("spotify:track:")
+
+    def run(self):
+        ripper = self.ripper
+        try:
+            # resolve all the URIs first so ripping can start early
+            for uri in self.uris:
+                if ripper.abort.is_set():
+                    break
+
+                group = PlanGroup(uri)
+                tracks = list(ripper.get_tracks_from_uri(uri, group))
+
+                # fill the Web API caches before the group is ripped
+                try:
+                    ripper.web.prefetch(tracks)
+                except Exception as e:
+                    print(Fore.YELLOW + "Warning: Web API prefetch "
+                          "failed: " + str(e) + Fore.RESET)
+
+                group.entries = [PlanEntry(group, idx, track, ripper)
+                                 for idx, track in enumerate(tracks)]
+
+                with self.cond:
+                    group.pos = len(self.groups)
+                    self.groups.append(group)
+                    self.cond.notify_all()
+        except Exception as e:
+            print(Fore.RED + "Error while resolving URIs: " + str(e) +
+                  Fore.RESET)
+            traceback.print_exc()
+        finally:
+            with self.cond:
+                self.resolved = True
+                self.cond.notify_all()
+
+        # then decide which tracks need ripping for the totals
+        try:
+            for entry in self.entries():
+                if ripper.abort.is_set():
+                    return
+                if entry.status is None:
+                    self.resolve_entry(entry)
+        finally:
+            ripper.progress.calc_total(self)
+
+    def iter_groups(self):
+        """yields groups in order as they are resolved"""
+        idx = 0
+        while True:
+            with self.cond:
+                while idx >= len(self.groups) and not self.resolved:
+                    self.cond.wait(1)
+                if idx >= len(self.groups):
+                    return
+                group = self.groups[idx]
+            yield group
+            idx += 1
+
+    def entries(self):
+        for group in self.groups:
+            for entry in group.entries:
+                yield entry
+
+    def upcoming(self, entry, count):
+        """the next count entries planned after the entry"""
+        group = entry.group
+        result = group.entries[entry.idx + 1:entry.idx + 1 + count]
+        pos = group.pos + 1
+        while len(result) < count and pos < len(self.groups):
+            result += self.groups[pos].entries[:count - len(result)]
+            pos += 1
+        return result
+
+    def __len__(self):
+        return sum(len(group.entries) for group in self.groups)
+
+    def resolve_entry(self, entry):
+        with entry.lock:
+            # the other thread may have got to it first
+            if entry.status is not None:
+                return
+            try:
+                if not entry.track.is_local:
+                    entry.track.load(self.args.timeout)
+                self.update_status(entry)
+            except (spotify.Error, Exception) as e:
+                print(Fore.RED + "Error while checking " +
+                      entry.track.link.uri + ": " + str(e) + Fore.RESET)
+                traceback.print_exc()
+                # the ripping loop tries again
+                entry.status = "error"
+
+    def update_status(self, entry):
+        """decide whether the entry needs to be ripped, the track needs
+        to be loaded"""
+        with entry.lock:
+            return self.check_entry(entry)
+
+    def check_entry(self, entry):
+        args = self.args
+        ripper = self.ripper
+        track = entry.track
+        track_context = entry.track_context
+
+        if track.is_local or track.availability != 1:
+            entry.status = "unavailable"
+            return entry.status
+
+        if entry.audio_file is None:
+            entry.audio_file = ripper.format_track_path(track_context)
+
+        outputs = [(out_args, audio_file, path_exists(audio_file))
+                   for out_args, audio_file in
+                   ripper.get_outputs(track_context, entry.audio_file)]
+
+        if args.overwrite or not path_exists(entry.audio_file):
+            entry.status = "new"
+        elif args.rerip_changed_settings and any(
+                ripper.manifest.settings_changed(out_args, audio_file)
+                for out_args, audio_file, exists in outputs if exists):
+            entry.status = "outdated"
+        elif is_partial(entry.audio_file, track, ripper.manifest):
+            entry.status = "partial"
+        else:
+            self.adopt_file(entry)
+            if not all(exists for _, _, exists in outputs):
+                entry.status = "missing_outputs"
+            else:
+                entry.status = "complete"
+        return entry.status
+
+    def adopt_file(self, entry):
+        """records a file the partial check found to be complete, so the
+        manifest answers for it next time"""
+        manifest = self.ripper.manifest
+        track = entry.track
+        if self.args.partial_check == "none" or \
+                manifest.is_current(track, entry.audio_file):
+            return
+
+        duration = audio_file_duration(entry.audio_file, track)
+        if duration is not None:
+            manifest.adopt(track, entry.audio_file, duration)
@@ -6,6 +6,7 @@ from colorama import Fore
 from spotify_ripper.utils import *
 import os
 import time
+import threading
 import spotify
 import codecs
 import shutil
@@ -21,6 +22,9 @@ class PostActions(object):
         self.args = args
         self.ripper = ripper
 
+        # tracks are completed on the post-processing threads
+        self.lock = threading.Lock()
+
         # create a log file for rip failures
         if args.fail_log is not None:
             _base_dir = base_dir()
@@ -33,12 +37,14 @@ class PostActions(object):
                 'w', encoding)
 
     def log_success(self, track):
-        self.success_tracks.append(track)
+        with self.lock:
+            self.success_tracks.append(track)
 
     def log_failure(self, track):
-        self.failure_tracks.append(track)
-        if self.fail_log_file is not None:
-            self.fail_log_file.write(track.link.uri + "\n")
+        with self.lock:
+            self.failure_tracks.append(track)
+            if self.fail_log_file is not None:
+                self.fail_log_file.write(track.link.uri + "\n")
 
     def end_failure_log(self):
         if self.fail_log_file is not None:
@@ -191,9 +197,8 @@ class PostActions(object):
         else:
             return os.path.relpath(_file, _base_dir)
 
-    def create_playlist_m3u(self, tracks):
+    def create_playlist_m3u(self, entries):
         args = self.args
-        ripper = self.ripper
 
         name = self.get_playlist_name()
         if name is not None and args.playlist_m3u:
@@ -209,16 +214,13 @@ class PostActions(object):
 
             encoding = "ascii" if args.ascii else "utf-8"
             with codecs.open(enc_str(playlist_path), 'w', encoding) as playlist:
-                for idx, track in enumerate(tracks):
-                    track.load(args.timeout)
-                    if track.is_local:
-                        continue
-                    _file = ripper.format_track_path(idx, track)
-                    if path_exists(_file):
+                for entry in entries:
+                    _file = entry.audio_file
+                    if _file is not None and path_exists(_file):
                         playlist.write(self.get_playlist_file_path(_file) +
                                 "\n")
 
-    def create_playlist_wpl(self, tracks):
+    def create_playlist_wpl(self, entries):
         args = self.args
         ripper = self.ripper
 
@@ -238,12 +240,9 @@ class PostActions(object):
             with codecs.open(enc_str(playlist_path), 'w', encoding) as playlist:
                 # to get an accurate track count
                 track_paths = []
-                for idx, track in enumerate(tracks):
-                    track.load(args.timeout)
-                    if track.is_local:
-                        continue
-                    _file = ripper.format_track_path(idx, track)
-                    if path_exists(_file):
+                for entry in entries:
+                    _file = entry.audio_file
+                    if _file is not None and path_exists(_file):
                         track_paths.append(_file)
 
                 playlist.write('<?wpl version="1.0"?>\n')
@@ -274,34 +273,35 @@ class PostActions(object):
     def clean_up_partial(self):
         ripper = self.ripper
 
-        if ripper.audio_file is not None and path_exists(ripper.audio_file):
-            print(Fore.YELLOW + "Deleting partially ripped file" + Fore.RESET)
-            rm_file(ripper.audio_file)
-
-            # check for any extra pcm or wav files
-            def delete_extra_file(ext):
-                audio_file = change_file_extension(ripper.audio_file, ext)
-                if path_exists(audio_file):
-                    rm_file(audio_file)
-
-            if self.args.plus_wav:
-                delete_extra_file("wav")
-
-            if self.args.plus_pcm:
-                delete_extra_file("pcm")
-
-    def queue_remove_from_playlist(self, idx):
+        if ripper.spool_file is not None:
+            rm_file(ripper.spool_file)
+            ripper.spool_file = None
+
+        # outputs only get their final name once complete, so there
+        # is never anything to remove at the real location
+        for out_args, audio_file in ripper.outputs:
+            temp_file = temp_file_path(audio_file)
+            if path_exists(temp_file):
+                if not out_args.is_extra_output:
+                    print(Fore.YELLOW + "Deleting partially ripped file" +
+                          Fore.RESET)
+                rm_file(temp_file)
+        ripper.outputs = []
+
+    def queue_remove_from_playlist(self, track_context):
         ripper = self.ripper
+        playlist = track_context.playlist
 
         if self.args.remove_from_playlist:
-            if ripper.current_playlist:
-                if ripper.current_playlist.owner.canonical_name == \
+            if playlist:
+                if playlist.owner.canonical_name == \
                         ripper.session.user.canonical_name:
-                    self.tracks_to_remove.append(idx)
+                    with self.lock:
+                        self.tracks_to_remove.append(track_context.idx)
                 else:
                     print(Fore.RED +
                           "This track will not be removed from playlist " +
-                          ripper.current_playlist.name + " since " +
+                          playlist.name + " since " +
                           ripper.session.user.canonical_name +
                           " is not the playlist owner..." + Fore.RESET)
             else:
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+import sys
+import threading
+import traceback
+import spotify
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+POST_QUEUE_SIZE = 8
+'''Finished tracks waiting to be tagged before the ripper thread blocks'''
+
+
+class WorkerStream(object):
+    """Stands in for stdout and stderr while the post workers run, what a
+    worker prints for a track is kept until the track is done and then
+    written in one piece, so the output of the workers never interleaves"""
+
+    local = threading.local()
+    lock = threading.Lock()
+
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+
+    def write(self, _str):
+        chunks = getattr(self.local, "chunks", None)
+        if chunks is None:
+            self.stream.write(_str)
+        else:
+            chunks.append((self.name, _str))
+
+    def flush(self):
+        if getattr(self.local, "chunks", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @classmethod
+    def begin_capture(cls):
+        cls.local.chunks = []
+
+    @classmethod
+    def end_capture(cls):
+        chunks = cls.local.chunks
+        cls.local.chunks = None
+        if not chunks:
+            return
+
+        # through whatever stands in for the streams now (e.g. the
+        # progress bars), one track at a time
+        with cls.lock:
+            for name, _str in chunks:
+                getattr(sys, name).write(_str)
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+
+class PostJob(object):
+
+    def __init__(self, track_context, outputs, samples, finished):
+        self.track_context = track_context
+        self.outputs = outputs
+        self.samples = samples
+        self.finished = finished
+
+    @property
+    def track(self):
+        return self.track_context.track
+
+
+class PostProcessor(object):
+    """Tags, embeds the cover art of and finalizes finished tracks on a
+    pool of threads so capture of the next track can start as soon as
+    the encoder is closed"""
+
+    def __init__(self, args, ripper):
+        self.args = args
+        self.ripper = ripper
+        self.queue = queue.Queue(POST_QUEUE_SIZE)
+        self.workers = []
+        self.stdout = None
+        self.stderr = None
+
+        if args.post_workers > 0:
+            self.stdout = sys.stdout
+            self.stderr = sys.stderr
+            sys.stdout = WorkerStream(self.stdout, "stdout")
+            sys.stderr = WorkerStream(self.stderr, "stderr")
+
+        for i in range(args.post_workers):
+            worker = threading.Thread(
+                target=self.run, name='SpotifyRipperPostThread-' + str(i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, track_context, outputs, samples, finished=True):
+        """finished is False if more outputs of the track are still to
+        come, the track is only logged as ripped with the last ones"""
+        job = PostJob(track_context, outputs, samples, finished)
+        if not self.workers:
+            self.process(job)
+        else:
+            # blocks while the workers are behind
+            self.queue.put(job)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                WorkerStream.begin_capture()
+                try:
+                    self.process(job)
+                finally:
+                    WorkerStream.end_capture()
+            finally:
+                self.queue.task_done()
+
+    def process(self, job):
+        ripper = self.ripper
+        try:
+            ripper.complete_track(job.track_context, job.outputs,
+                                  job.samples, job.finished)
+        except (spotify.Error, Exception) as e:
+            print(Fore.RED + "Error while tagging " +
+                  job.track.link.uri + Fore.RESET)
+            print(str(e))
+            traceback.print_exc()
+            for out_args, audio_file in job.outputs:
+                rm_file(temp_file_path(audio_file))
+            ripper.post.log_failure(job.track)
+        finally:
+            ripper.end_pending(job.track, job.outputs)
+
+    def wait_all(self):
+        self.queue.join()
+
+    def stop(self):
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+        if self.stdout is not None:
+            sys.stdout = self.stdout
+            sys.stderr = self.stderr
+            self.stdout = None
+            self.stderr = None
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from spotify_ripper.utils import *
+import threading
+import spotify
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Prefetcher(threading.Thread):
+    """Loads the metadata, album browser, cover art and genres of the
+    next few planned tracks while the current one is being captured, so
+    tagging them doesn't wait on Spotify"""
+
+    name = 'SpotifyRipperPrefetchThread'
+
+    def __init__(self, args, ripper):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.args = args
+        self.ripper = ripper
+        self.queue = queue.Queue()
+        self.stopped = threading.Event()
+        self.warmed = 0
+
+    def look_ahead(self, plan, entry):
+        """queues the tracks planned after the entry"""
+        for next_entry in plan.upcoming(entry, self.args.prefetch_tracks):
+            if not next_entry.prefetched:
+                next_entry.prefetched = True
+                self.queue.put(next_entry)
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None or self.stopped.is_set() or \
+                    self.ripper.abort.is_set():
+                return
+            try:
+                self.warm(entry)
+            except (spotify.Error, Exception):
+                # the ripping loop will load it again and report it
+                pass
+
+    def warm(self, entry):
+        args = self.args
+        track = entry.track
+        track_context = entry.track_context
+
+        if track.is_local or \
+                entry.status in {"unavailable", "complete", "error"}:
+            return
+
+        track_context.load()
+        if track.availability != 1:
+            return
+
+        # everything tagging asks for
+        track_context.album_index
+        track_context.cover_image()
+        if args.genres is not None:
+            track_context.genres(args.genres)
+        self.warmed += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.queue.put(None)
+        if self.is_alive():
+            self.join()
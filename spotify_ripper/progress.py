@@ -7,7 +7,7 @@ from spotify_ripper.utils import *
 import os
 import sys
 import time
-import schedule
+import threading
 import spotify
 
 try:
@@ -17,6 +17,31 @@ try:
 except ImportError:
     pass
 
+PROGRESS_FPS = 10
+'''Times per second the progress bars are redrawn'''
+
+ETA_INTERVAL = 2.0
+'''Seconds between updates of the remaining time'''
+
+
+class ProgressStream(object):
+    """Stands in for stdout and stderr while the progress bars are shown,
+    anything another thread prints clears the bars first and they are
+    drawn again below it"""
+
+    def __init__(self, progress, stream):
+        self.progress = progress
+        self.stream = stream
+
+    def write(self, _str):
+        self.progress.write_above(self.stream, _str)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
 
 class Progress(object):
     # song progress
@@ -26,6 +51,8 @@ class Progress(object):
 
     # total progress
     show_total = False
+    estimating = False
+    total_size_shown = False
     skipped_tracks = 0
     track_idx = 0
     total_tracks = 0
@@ -39,51 +66,130 @@ class Progress(object):
     song_eta = None
     total_eta = None
 
-    # flag for moving cursor
-    move_cursor = False
+    # lines on screen, None until the track's first frame is drawn
+    lines = None
+    active = False
+    line_start = True
     term_width = 120
 
+    # the real streams while the renderer runs
+    stdout = None
+    stderr = None
+
     def __init__(self, args, ripper):
         self.args = args
         self.ripper = ripper
-        if not self.args.has_log:
-            schedule.every(2).seconds.do(self.eta_calc)
-
-    def calc_total(self, track_pairs):
-        if len(track_pairs) <= 1:
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.renderer = None
+
+    def start(self):
+        """redraws the progress bars from their own thread so the audio
+        callback only has to add up the frames"""
+        if self.args.has_log or self.renderer is not None:
             return
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+        sys.stdout = ProgressStream(self, self.stdout)
+        sys.stderr = ProgressStream(self, self.stderr)
+        self.renderer = threading.Thread(
+            target=self.run, name='SpotifyRipperProgressThread')
+        self.renderer.daemon = True
+        self.renderer.start()
+
+    def run(self):
+        eta_time = time.time()
+        while not self.stopped.wait(1.0 / PROGRESS_FPS):
+            with self.lock:
+                if time.time() - eta_time >= ETA_INTERVAL:
+                    eta_time = time.time()
+                    self.eta_calc()
+                if self.active and not self.ripper.abort.is_set():
+                    self.render()
+
+    def stop(self):
+        self.stopped.set()
+        if self.renderer is not None:
+            self.renderer.join()
+            self.renderer = None
+            sys.stdout = self.stdout
+            sys.stderr = self.stderr
+            self.stdout = None
+            self.stderr = None
+
+    def write(self, output):
+        stream = self.stdout if self.stdout is not None else sys.stdout
+        stream.write(output)
+        stream.flush()
+        if output:
+            self.line_start = output.endswith("\n")
+
+    def clear(self):
+        """removes the bars from the screen, leaving the cursor where
+        they started"""
+        if self.lines is None:
+            return
+        output = ""
+        if len(self.lines) > 1:
+            output += Cursor.UP(len(self.lines) - 1)
+        self.write(output + "\r\033[J")
+        self.lines = None
+        self.line_start = True
+
+    def write_above(self, stream, _str):
+        with self.lock:
+            self.clear()
+            if stream is not self.stdout:
+                self.stdout.flush()
+            stream.write(_str)
+            if _str:
+                self.line_start = _str.endswith("\n")
+
+    def start_estimate(self, plan):
+        # totals are calculated while the first tracks are ripped
+        if not plan.single_track():
+            self.show_total = True
+            self.estimating = True
+
+    # executes on the plan thread
+    def calc_total(self, plan):
+        if not self.show_total:
+            return
+
+        total_tracks = 0
+        skipped_tracks = 0
+        total_duration = 0
+        total_size = 0
+
+        # the plan already decided which tracks will be skipped
+        for entry in plan.entries():
+            if entry.status is None or entry.status == "error":
+                continue
 
-        self.show_total = True
-        self.track_idx = 0
-        self.total_tracks = 0
-        self.total_duration = 0
-        self.total_size = 0
-
-        # some duplicate work here, maybe cache this info beforehand?
-        for pair in track_pairs:
-            try:
-                track = pair[0]
-                audio_file = pair[1]
-
-                track.load(self.args.timeout)
-                # check if we should skip track
-                if track.availability != 1 or track.is_local:
-                    self.skipped_tracks += 1
-                    continue
-
-                # check if we should overwrite existing file
-                if not self.args.overwrite and path_exists(audio_file) and \
-                        not is_partial(audio_file, track):
-                    self.skipped_tracks += 1
-                    continue
-
-                self.total_tracks += 1
-                self.total_duration += track.duration
-                file_size = calc_file_size(track)
-                self.total_size += file_size
-            except spotify.Error as e:
+            if entry.status in {"unavailable", "complete"}:
+                skipped_tracks += 1
                 continue
 
+            track = entry.track
+            total_tracks += 1
+            total_duration += track.duration
+            file_size = calc_file_size(track)
+            total_size += file_size
+
+        self.total_tracks = total_tracks
+        self.skipped_tracks = skipped_tracks
+        self.total_duration = total_duration
+        self.total_size = total_size
+        self.estimating = False
+
+    def show_total_size(self):
+        """true the first time it is asked once the totals are known"""
+        if self.show_total and not self.estimating and \
+                not self.total_size_shown:
+            self.total_size_shown = True
+            return self.total_size > 0
+        return False
+
     def eta_calc(self):
         # exponential moving average
         def calc_rate(rate, avg_rate, smoothing_factor):
@@ -102,7 +208,7 @@ class Progress(object):
                 return new_eta
             return old_eta
 
-        if self.ripper.ripping:
+        if self.ripper.ripping.is_set():
             if self.stat_prev is not None:
                 rate = (self.song_position - self.stat_prev[0]) / \
                        (time.time() - self.stat_prev[1])
@@ -117,7 +223,7 @@ class Progress(object):
                         self.ema_rate, self.song_eta)
 
                     # calc total eta
-                    if self.show_total:
+                    if self.show_total and not self.estimating:
                         total_position = (
                             self.total_position + self.song_position)
                         self.total_eta = calc(
@@ -142,35 +248,40 @@ class Progress(object):
         self.track_idx += 1
 
     def prepare_track(self, track):
-        self.song_position = 0
-        self.song_duration = track.duration
-        self.move_cursor = False
-        self.current_track = track
+        with self.lock:
+            self.song_position = 0
+            self.song_duration = track.duration
+            self.active = False
+            self.lines = None
+            self.current_track = track
 
     def end_track(self, show_end=True):
-        if show_end:
-            self.end_progress()
-        self.stat_prev = None
-        self.song_eta = None
-        self.total_eta = None
-        self.total_position += self.current_track.duration
-        self.current_track = None
-
+        with self.lock:
+            if show_end:
+                self.end_progress()
+            self.active = False
+            self.lines = None
+            self.stat_prev = None
+            self.song_eta = None
+            self.total_eta = None
+            self.total_position += self.current_track.duration
+            self.current_track = None
+
+    # executes on the audio delivery thread, keep it cheap
     def update_progress(self, num_frames, sample_rate):
-        if self.args.has_log:
-            return
+        if num_frames > 0 and sample_rate > 0:
+            self.song_position += (num_frames * 1000) / sample_rate
+        self.active = True
 
+    def progress_lines(self):
         # log output until we run out of space on this line
-        def output_what_fits(init, output_strings):
-            print_str(init)
-            w = 0
+        def what_fits(output_strings):
+            line = ""
             for _str in output_strings:
-                _len = len(_str)
-                if w + _len >= (self.term_width - 1):
-                    return
-
-                print_str(_str)
-                w += _len
+                if len(line) + len(_str) >= (self.term_width - 1):
+                    break
+                line += _str
+            return line
 
         # make progress bar width flexible
         if self.term_width < 70:
@@ -181,21 +292,13 @@ class Progress(object):
             prog_width = 40
 
         # song position/progress calculations
-        if num_frames > 0 and sample_rate > 0:
-            self.song_position += (num_frames * 1000) / sample_rate
-        pos_seconds = self.song_position // 1000
+        song_position = min(self.song_position, self.song_duration)
+        pos_seconds = song_position // 1000
         dur_seconds = self.song_duration // 1000
-        pct = int(self.song_position * 100 // self.song_duration) \
+        pct = int(song_position * 100 // self.song_duration) \
             if self.song_duration > 0 else 0
         x = int(pct * prog_width // 100)
 
-        # don't move cursor on first update
-        if self.show_total:
-            if self.move_cursor:
-                print(Cursor.UP(2))
-            else:
-                self.move_cursor = True
-
         # song output text
         output_strings = [
             "Progress:",
@@ -209,11 +312,11 @@ class Progress(object):
                    format_time(self.song_eta, short=True) + " remaining)"
             output_strings.append(_str)
 
-        output_what_fits("\r\033[2K", output_strings)
+        lines = [what_fits(output_strings)]
 
         if self.show_total:
             # total position/progress calculations
-            total_position = self.total_position + self.song_position
+            total_position = self.total_position + song_position
             total_pos_seconds = total_position // 1000
             total_dur_seconds = self.total_duration // 1000
             total_pct = int(total_position * 100 // self.total_duration) \
@@ -221,23 +324,79 @@ class Progress(object):
             total_x = int(total_pct * prog_width // 100)
 
             # total output text
-            output_strings = [
-                "Total:",
-                "    [" + ("=" * total_x) +
-                (" " * (prog_width - total_x)) + "]",
-                " " + format_time(total_pos_seconds, total_dur_seconds)
-            ]
-            if self.total_eta is not None:
+            if self.estimating:
+                output_strings = ["Total:", "    estimating..."]
+            else:
+                output_strings = [
+                    "Total:",
+                    "    [" + ("=" * total_x) +
+                    (" " * (prog_width - total_x)) + "]",
+                    " " + format_time(total_pos_seconds, total_dur_seconds)
+                ]
+            if self.total_eta is not None and not self.estimating:
                 _spaces = max(22 - len(output_strings[2]), 1) * " "
                 output_strings.append(_spaces)
                 _str = "(~" + format_time(self.total_eta, short=True) + \
                        " remaining)"
                 output_strings.append(_str)
 
-            output_what_fits("\n\033[2K", output_strings)
+            lines.append(what_fits(output_strings))
+        return lines
+
+    def render(self):
+        """draws the progress bars, only rewriting the end of each line
+        that changed since the last frame and with a single write"""
+        if self.args.has_log:
+            return
+
+        lines = self.progress_lines()
+        old_lines = self.lines
+        if lines == old_lines:
+            return
+        self.lines = lines
+
+        # first frame of the track or after something else was printed
+        if old_lines is None or len(old_lines) != len(lines):
+            output = "\r" if self.line_start else "\n"
+            self.write(output + "\033[2K" + "\n\033[2K".join(lines))
+            return
+
+        changed = [i for i in range(len(lines)) if lines[i] != old_lines[i]]
+        last = len(lines) - 1
+
+        # the cursor is on the last line
+        output = ""
+        if last > changed[0]:
+            output += Cursor.UP(last - changed[0])
+        for i in range(changed[0], last + 1):
+            if i > changed[0]:
+                output += "\n"
+            if lines[i] == old_lines[i]:
+                continue
+
+            # skip the part of the line that is already on screen
+            same = 0
+            for new_char, old_char in zip(lines[i], old_lines[i]):
+                if new_char != old_char:
+                    break
+                same += 1
+            output += "\r"
+            if same > 0:
+                output += Cursor.FORWARD(same)
+
+            # and the part after the change if the length didn't change
+            if len(lines[i]) == len(old_lines[i]):
+                end = len(lines[i])
+                while lines[i][end - 1] == old_lines[i][end - 1]:
+                    end -= 1
+                output += lines[i][same:end]
+            else:
+                output += lines[i][same:] + "\033[K"
+        self.write(output)
 
     def end_progress(self):
         self.song_position = self.song_duration
         self.eta_calc()
-        self.update_progress(0, None)
-        print_str("\n")
+        self.render()
+        if not self.args.has_log:
+            self.write("\n")
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.tags import new_tags, write_tags, TagStats
+from spotify_ripper.manifest import Manifest
+from spotify_ripper.covers import CoverStore
+from spotify_ripper.web import WebAPI
+from mutagen import flac
+import argparse
+import base64
+import multiprocessing
+import mutagen
+import os
+import re
+import shutil
+import signal
+import traceback
+
+RETAG_CHUNK_SIZE = 32
+'''Number of files handed to a retag worker at a time'''
+
+# files found in the library that can be retagged
+retag_extensions = {
+    ".mp3": "mp3",
+    ".flac": "flac",
+    ".ogg": "ogg",
+    ".opus": "opus",
+    ".m4a": "m4a",
+}
+
+
+class SnapshotContext(object):
+    """Stands in for a TrackContext when retagging, everything comes
+    from the metadata snapshot kept in the manifest"""
+
+    def __init__(self, snapshot, image):
+        self.snapshot = snapshot
+        self.image = image
+
+    def load(self):
+        pass
+
+    def get(self, field):
+        # a KeyError means the field wasn't known when the file was ripped
+        fields = self.snapshot["fields"]
+        if field not in fields:
+            raise KeyError(field)
+        return fields[field]
+
+    def tag_metadata(self):
+        return self.snapshot
+
+    def genres(self, genre_type):
+        return self.snapshot.get("genres", {}).get(genre_type)
+
+    def cover_image(self):
+        return self.image
+
+
+def tag_number(value):
+    """the number and total of a '3/12' style tag"""
+    match = re.match(r"^\s*(\d+)(?:\s*/\s*(\d+))?", value or "")
+    if match is None:
+        return 0, 0
+    return int(match.group(1)), int(match.group(2) or 0)
+
+
+def embedded_cover(audio_file):
+    """the front cover image embedded in the file, or None"""
+    audio = mutagen.File(audio_file)
+    if audio is None or audio.tags is None:
+        return None
+
+    if isinstance(audio, flac.FLAC):
+        return audio.pictures[0].data if audio.pictures else None
+    if hasattr(audio.tags, "getall"):
+        frames = audio.tags.getall("APIC")
+        return frames[0].data if frames else None
+    if "covr" in audio.tags:
+        return bytes(audio.tags["covr"][0])
+    if "metadata_block_picture" in audio.tags:
+        data = audio.tags["metadata_block_picture"][0]
+        return flac.Picture(base64.b64decode(data)).data
+    return None
+
+
+def snapshot_from_tags(audio_file):
+    """a snapshot made from the tags already in a file the manifest has
+    no metadata of, so existing libraries can be retagged too"""
+    audio = mutagen.File(audio_file, easy=True)
+    if audio is None or audio.tags is None:
+        raise KeyError("tags")
+
+    def tag(name):
+        values = audio.tags.get(name)
+        return values[0] if values else None
+
+    title = tag("title")
+    artist = tag("artist")
+    if title is None:
+        raise KeyError("title")
+    if artist is None:
+        raise KeyError("artist")
+
+    album = tag("album") or ""
+    album_artist = tag("albumartist") or artist
+    date = tag("date") or tag("year") or ""
+    year = int(date[:4]) if date[:4].isdigit() else 0
+    disc, num_discs = tag_number(tag("discnumber") or "1")
+    index, num_tracks = tag_number(tag("tracknumber"))
+    num_discs = num_discs or tag_number(tag("disctotal"))[0]
+    num_tracks = num_tracks or tag_number(tag("tracktotal"))[0]
+
+    def field_str(value):
+        return to_ascii(escape_filename_part(value))
+
+    genres = audio.tags.get("genre")
+    genres = [genre.strip() for genre in ", ".join(genres).split(",")] \
+        if genres else None
+
+    return {
+        "album": album,
+        "artists": [artist],
+        "album_artist": album_artist,
+        "title": title,
+        "year": year,
+        "disc": disc,
+        "index": index,
+        "num_discs": num_discs,
+        "num_tracks": num_tracks,
+        "artist_uri": None,
+        "album_uri": None,
+        # the genres already in the file stand in for either kind
+        "genres": {"artist": genres, "album": genres}
+        if genres is not None else {},
+        "fields": {
+            "artist": field_str(artist),
+            "artists": field_str(artist),
+            "album_artist": field_str(album_artist),
+            "album": field_str(album),
+            "track_name": field_str(title),
+            "year": str(year),
+            "track_num": str(index),
+            "disc_num": str(disc),
+        },
+        "cover": None,
+    }
+
+
+def init_retag_worker(args):
+    init_util_globals(args)
+    # the main process handles Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def retag_file(job):
+    """recomputes the tags of one file and rewrites them if they changed,
+    returns (audio_file, status, tag_hash, size_before, size_after,
+    snapshot) where snapshot is the one made from the file's tags"""
+    audio_file, output_type, snapshot, image_file, old_hash = job
+    args = argparse.Namespace(**vars(get_args()))
+    args.output_type = output_type
+    init_util_globals(args)
+    new_snapshot = None
+
+    try:
+        image = None
+        if snapshot is None:
+            snapshot = new_snapshot = snapshot_from_tags(audio_file)
+        if image_file is not None and path_exists(image_file):
+            with open(enc_str(image_file), "rb") as f:
+                image = f.read()
+        else:
+            # keep the cover of files that weren't ripped by us or whose
+            # cover was pruned from the store
+            image = embedded_cover(audio_file)
+
+        # the tags are written to a copy that replaces the file once
+        # saved, so an interrupted retag never leaves a broken file
+        temp_file = temp_file_path(audio_file)
+        tags = new_tags(args, temp_file, SnapshotContext(snapshot, image))
+        if tags is None:
+            return (audio_file, "skipped: can't tag " + output_type +
+                    " files", None, None, None, None)
+
+        tag_hash = tags.tag_hash()
+        if tag_hash == old_hash:
+            return (audio_file, "unchanged", None, None, None, None)
+
+        size_before = os.path.getsize(enc_str(audio_file))
+        shutil.copy2(enc_str(audio_file), enc_str(temp_file))
+        try:
+            write_tags(args, temp_file, tags, replace=True)
+            size_after = os.path.getsize(enc_str(temp_file))
+            finalize_file(temp_file, audio_file)
+        except BaseException:
+            rm_file(temp_file)
+            raise
+        return (audio_file, "retagged", tag_hash, size_before, size_after,
+                new_snapshot)
+    except KeyError as e:
+        return (audio_file, "skipped: no " + str(e.args[0]) +
+                " known for the file", None, None, None, None)
+    except Exception as e:
+        traceback.print_exc()
+        return (audio_file, "failed: " + str(e), None, None, None, None)
+
+
+def fill_genres(args, items):
+    """adds the genres the new tags need to the snapshots, from the
+    Web API cache where possible and with batched requests otherwise"""
+    genre_type = args.genres
+    uri_key = genre_type + "_uri"
+    missing = {}
+    for item in items:
+        snapshot = item[2]
+        if snapshot is None or snapshot[uri_key] is None:
+            continue
+        if genre_type not in snapshot.setdefault("genres", {}):
+            missing.setdefault(snapshot[uri_key], []).append(snapshot)
+    if not missing:
+        return
+
+    print("Looking up " + genre_type + " genres for " + str(len(missing)) +
+          " " + genre_type + "s...")
+    web = WebAPI(args, None)
+    try:
+        batch_size = 50 if genre_type == "artist" else 20
+        for item in web.request_batch(genre_type + "s", genre_type,
+                                      list(missing), batch_size):
+            for snapshot in missing.get(item["uri"], []):
+                snapshot["genres"][genre_type] = item["genres"]
+    finally:
+        web.close()
+
+
+def find_audio_files(path):
+    """the files under path that can be retagged"""
+    for dir_path, dir_names, file_names in os.walk(path):
+        for file_name in file_names:
+            if file_name.startswith(TEMP_FILE_PREFIX):
+                continue
+            ext = os.path.splitext(file_name)[1].lower()
+            if ext in retag_extensions:
+                yield (os.path.join(dir_path, file_name),
+                       retag_extensions[ext])
+
+
+def retag_command(args):
+    """handles 'spotify-ripper retag', rewrites the tags of every ripped
+    file whose tags would be different with the current options.  Files
+    the manifest has a metadata snapshot of are retagged from it, any
+    other file in the library from the tags it already has"""
+    manifest = Manifest(args)
+    covers = CoverStore(args, None)
+    _base_dir = base_dir()
+
+    items = []
+    output_types = {}
+    for audio_file, output_type, snapshot, tag_hash in \
+            manifest.tagged_outputs():
+        if args.directory is not None and \
+                not audio_file.startswith(_base_dir + os.sep):
+            continue
+        if not path_exists(audio_file):
+            continue
+        output_types[audio_file] = output_type
+        items.append((audio_file, output_type, snapshot, tag_hash))
+
+    for audio_file, output_type in find_audio_files(_base_dir):
+        if audio_file not in output_types:
+            output_types[audio_file] = output_type
+            items.append((audio_file, output_type, None, None))
+    print("Checking tags of " + str(len(items)) + " files...")
+
+    if args.genres is not None:
+        fill_genres(args, items)
+
+    def image_file(snapshot):
+        if snapshot is None:
+            return None
+        digest = covers.stored_digest(snapshot["album_uri"])
+        if digest is None:
+            digest = snapshot.get("cover")
+        return covers.image_path(digest) if digest is not None else None
+
+    jobs = [(audio_file, output_type, snapshot, image_file(snapshot),
+             tag_hash)
+            for audio_file, output_type, snapshot, tag_hash in items]
+    covers.close()
+
+    counts = {"retagged": 0, "unchanged": 0, "skipped": 0, "failed": 0}
+    stats = TagStats()
+    pool = multiprocessing.Pool(args.transcode_workers, init_retag_worker,
+                                (args, ))
+    try:
+        for audio_file, status, tag_hash, size_before, size_after, \
+                snapshot in pool.imap_unordered(retag_file, jobs,
+                                                RETAG_CHUNK_SIZE):
+            if status == "retagged":
+                print(Fore.GREEN + "Retagged " + Fore.RESET + audio_file)
+                manifest.update_tag_hash(audio_file, tag_hash,
+                                         output_types[audio_file], snapshot)
+                stats.record(size_before, size_after)
+                counts["retagged"] += 1
+            elif status.startswith("failed"):
+                print(Fore.RED + "Could not retag " + audio_file + ", " +
+                      status + Fore.RESET)
+                counts["failed"] += 1
+            elif status.startswith("skipped"):
+                print(Fore.YELLOW + "Skipped " + audio_file + ", " +
+                      status[len("skipped: "):] + Fore.RESET)
+                counts["skipped"] += 1
+            else:
+                counts[status] += 1
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print(Fore.YELLOW + "Retag interrupted" + Fore.RESET)
+    finally:
+        pool.join()
+        manifest.close()
+
+    print(str(counts["retagged"]) + " retagged, " +
+          str(counts["unchanged"]) + " unchanged, " +
+          str(counts["skipped"]) + " skipped, " +
+          str(counts["failed"]) + " failed")
+    print("Tags: " + stats.stats_str())
@@ -2,16 +2,27 @@
 
 from __future__ import unicode_literals
 
-from subprocess import Popen, PIPE
 from colorama import Fore, Style
 from spotify_ripper.utils import *
-from spotify_ripper.tags import set_metadata_tags
+from spotify_ripper.tags import set_metadata_tags, tag_stats
 from spotify_ripper.progress import Progress
 from spotify_ripper.post_actions import PostActions
 from spotify_ripper.web import WebAPI
 from spotify_ripper.sync import Sync
 from spotify_ripper.eventloop import EventLoop
+from spotify_ripper.writer import EncoderWriter
+from spotify_ripper.buffer import DeliveryBuffer
+from spotify_ripper.encoders import create_encoder
+from spotify_ripper.transcode import Transcoder
+from spotify_ripper.manifest import Manifest
+from spotify_ripper.covers import CoverStore
+from spotify_ripper.prefetch import Prefetcher
+from spotify_ripper.postprocess import PostProcessor
+from spotify_ripper.plan import RipPlan
+from spotify_ripper.cache import album_browser_cache, get_album_browser
+from spotify_ripper.template import format_track_string
 from datetime import datetime
+import errno
 import os
 import sys
 import time
@@ -19,7 +30,6 @@ import threading
 import spotify
 import getpass
 import itertools
-import wave
 import re
 import select
 import traceback
@@ -42,10 +52,11 @@ class Ripper(threading.Thread):
     name = 'SpotifyRipperThread'
 
     audio_file = None
-    pcm_file = None
-    wav_file = None
-    rip_proc = None
-    pipe = None
+    spool_file = None
+    samples_captured = 0
+    outputs = []
+    spooled_outputs = []
+    encoders = []
     current_playlist = None
     current_album = None
     current_chart = None
@@ -53,13 +64,15 @@ class Ripper(threading.Thread):
     login_success = False
     progress = None
     sync = None
+    plan = None
     post = None
     web = None
-    dev_null = None
+    writer = None
+    transcoder = None
     stop_time = None
     track_path_cache = {}
 
-    rip_queue = queue.Queue()
+    rip_queue = None
 
     # threading events
     logged_in = threading.Event()
@@ -88,6 +101,19 @@ class Ripper(threading.Thread):
 
         self.post = PostActions(args, self)
         self.web = WebAPI(args, self)
+        self.writer = EncoderWriter(args, self)
+        self.rip_queue = DeliveryBuffer(args.delivery_buffer * MB_BYTES)
+        self.transcoder = Transcoder(args, self)
+        self.post_processor = PostProcessor(args, self)
+        self.manifest = Manifest(args)
+        self.covers = CoverStore(args, self.web)
+        self.prefetcher = Prefetcher(args, self) \
+            if args.prefetch_tracks > 0 else None
+
+        # track URIs and output files still being written by a
+        # transcode or post-processing job
+        self.pending = {}
+        self.pending_cond = threading.Condition()
 
         proxy = os.environ.get('http_proxy')
         if proxy is not None:
@@ -179,83 +205,49 @@ class Ripper(threading.Thread):
     def run(self):
         args = self.args
 
-        # start event loop
+        # start event loop and encoder writer
         self.event_loop.start()
+        self.writer.start()
 
         # wait for main thread to login
         self.ripper_continue.wait()
         if self.abort.is_set():
             return
 
-        # list of spotify URIs
-        uris = args.uri
+        # resolve the URIs and calculate the totals in the background,
+        # ripping starts as soon as the first URI is resolved
+        self.plan = RipPlan(args, self, args.uri)
+        self.progress.start_estimate(self.plan)
+        self.progress.start()
+        self.plan.start()
+        if self.prefetcher is not None:
+            self.prefetcher.start()
 
-        def get_tracks_from_uri(uri):
-            self.current_playlist = None
-            self.current_album = None
-            self.current_chart = None
-
-            if isinstance(uri, list):
-                return uri
-            else:
-                if (uri.startswith("spotify:artist:") and
-                        (args.artist_album_type is not None or
-                         args.artist_album_market is not None)):
-                    album_uris = self.web.get_albums_with_filter(uri)
-                    return itertools.chain(
-                        *[self.load_link(album_uri) for
-                          album_uri in album_uris])
-                elif uri.startswith("spotify:charts:"):
-                    charts = self.web.get_charts(uri)
-                    if charts is not None:
-                        self.current_chart = charts
-                        chart_uris = charts["tracks"]
-                        return itertools.chain(
-                            *[self.load_link(chart_uri) for
-                              chart_uri in chart_uris])
-                    else:
-                        return iter([])
-                else:
-                    return self.load_link(uri)
-
-        # calculate total size and time
-        all_tracks = []
-        for uri in uris:
-            tracks = list(get_tracks_from_uri(uri))
-
-            # TODO: remove dependency on current_album, ...
-            for idx, track in enumerate(tracks):
-
-                # ignore local tracks
-                if track.is_local:
-                    continue
-
-                audio_file = self.format_track_path(idx, track)
-                all_tracks.append((track, audio_file))
-
-        self.progress.calc_total(all_tracks)
-
-        if self.progress.total_size > 0:
-            print(
-                "Total Download Size: " +
-                format_size(self.progress.total_size))
-
-        # create track iterator
-        for uri in uris:
+        for group in self.plan.iter_groups():
             if self.abort.is_set():
                 break
 
-            tracks = list(get_tracks_from_uri(uri))
+            # track paths depend on the playlist/album being ripped
+            self.current_playlist, self.current_album, \
+                self.current_chart = group.context
 
             if args.playlist_sync and self.current_playlist:
+                # sync needs the paths of every track in the playlist
+                for entry in group.entries:
+                    if entry.status is None:
+                        self.plan.resolve_entry(entry)
+
                 self.sync = Sync(args, self)
-                self.sync.sync_playlist(self.current_playlist)
+                self.sync.sync_playlist(self.current_playlist, group.entries)
 
             # ripping loop
-            for idx, track in enumerate(tracks):
+            for entry in group.entries:
+                idx, track = entry.idx, entry.track
+                track_context = entry.track_context
                 try:
                     self.check_stop_time()
                     self.skip.clear()
+                    self.transcoder.process_finished()
 
                     if self.abort.is_set():
                         break
@@ -264,31 +256,52 @@ class Ripper(threading.Thread):
                     self.progress.increment_track_idx()
 
                     print('Loading track...')
-                    track.load(args.timeout)
-                    if track.availability != 1 or track.is_local:
+                    if not track.is_local:
+                        track.load(args.timeout)
+
+                    # files can show up after the plan was made (e.g. by
+                    # a playlist sync or a track listed twice)
+                    if entry.status != "complete":
+                        self.plan.update_status(entry)
+
+                        # a track listed twice may still be finishing
+                        # in the background, it is skipped once done
+                        if entry.status != "unavailable" and \
+                                self.wait_for_pending(entry):
+                            self.plan.update_status(entry)
+
+                    if entry.status == "unavailable":
                         print(
                             Fore.RED + 'Track is not available, '
                                        'skipping...' + Fore.RESET)
                         self.post.log_failure(track)
                         continue
 
-                    self.audio_file = self.format_track_path(idx, track)
+                    self.audio_file = entry.audio_file
 
-                    if not args.overwrite and path_exists(self.audio_file):
-                        if is_partial(self.audio_file, track):
-                            print("Overwriting partial file")
-                        else:
-                            print(
-                                Fore.YELLOW + "Skipping " +
-                                track.link.uri + Fore.RESET)
-                            print(Fore.CYAN + self.audio_file + Fore.RESET)
-                            self.post.queue_remove_from_playlist(idx)
-                            continue
+                    if entry.status == "outdated":
+                        print("Overwriting file ripped with other "
+                              "settings")
+                    elif entry.status == "partial":
+                        print("Overwriting partial file")
+                    elif entry.status == "missing_outputs":
+                        print("Ripping missing extra outputs")
+                    elif entry.status == "complete":
+                        print(
+                            Fore.YELLOW + "Skipping " +
+                            track.link.uri + Fore.RESET)
+                        print(Fore.CYAN + self.audio_file + Fore.RESET)
+                        self.post.queue_remove_from_playlist(track_context)
+                        continue
 
                     self.session.player.load(track)
-                    self.prepare_rip(idx, track)
+                    self.prepare_rip(track_context)
                     self.session.player.play()
 
+                    # get the next tracks ready while this one plays
+                    if self.prefetcher is not None:
+                        self.prefetcher.look_ahead(self.plan, entry)
+
                     timeout_count = 0
                     while not self.end_of_track.is_set() or \
                             not self.rip_queue.empty():
@@ -310,38 +323,64 @@ class Ripper(threading.Thread):
                                                     "ripping track")
 
                     if self.skip.is_set():
+                        # stop redrawing before printing below the bars
+                        self.progress.end_track(show_end=False)
                         extra_line = "" if self.play_token_resume.is_set() \
                                         else "\n"
                         print(extra_line + Fore.YELLOW +
                             "User skipped track... " + Fore.RESET)
                         self.session.player.play(False)
+                        self.rip_queue.clear()
+                        self.writer.discard()
+                        self.abort_encoders()
                         self.post.clean_up_partial()
                         self.post.log_failure(track)
                         self.end_of_track.clear()
-                        self.progress.end_track(show_end=False)
                         self.ripping.clear()
                         continue
 
                     if self.abort.is_set():
                         self.session.player.play(False)
                         self.end_of_track.set()
+                        self.rip_queue.clear()
+                        self.writer.discard()
+                        self.abort_encoders()
                         self.post.clean_up_partial()
                         self.post.log_failure(track)
                         break
 
                     self.end_of_track.clear()
 
-                    self.finish_rip(track)
-
-                    # update id3v2 with metadata and embed front cover image
-                    set_metadata_tags(args, self.audio_file, idx, track, self)
+                    # a file at its final name is always a complete file
+                    if not self.finish_rip(track):
+                        self.post.clean_up_partial()
+                        self.post.log_failure(track)
+                        continue
 
-                    # make a note of the index and remove all the
-                    # tracks from the playlist when everything is done
-                    self.post.queue_remove_from_playlist(idx)
+                    if self.spool_file is not None:
+                        # tag the spooled outputs once they are transcoded,
+                        # the track is complete once they are done
+                        live_outputs = [output for output in self.outputs
+                                        if output not in self.spooled_outputs]
+                        if live_outputs:
+                            self.begin_pending(track, live_outputs)
+                            self.post_processor.submit(
+                                track_context, live_outputs,
+                                self.samples_captured, finished=False)
+                        self.begin_pending(track, self.spooled_outputs)
+                        self.transcoder.submit(
+                            track_context, self.spooled_outputs,
+                            self.spool_file, self.samples_captured)
+                        self.spool_file = None
+                    else:
+                        self.begin_pending(track, self.outputs)
+                        self.post_processor.submit(
+                            track_context, self.outputs,
+                            self.samples_captured)
 
-                    # finally log success
-                    self.post.log_success(track)
+                    # the outputs are done or owned by the transcoder now,
+                    # don't let a later error clean them up
+                    self.outputs = []
 
                 except (spotify.Error, Exception) as e:
                     if isinstance(e, Exception):
@@ -350,15 +389,24 @@ class Ripper(threading.Thread):
                     traceback.print_exc()
                     print("Skipping to next track...")
                     self.session.player.play(False)
+                    self.rip_queue.clear()
+                    self.writer.discard()
+                    self.abort_encoders()
                     self.post.clean_up_partial()
                     self.post.log_failure(track)
                     continue
 
+            # playlist files and removal need the transcoded files
+            if (args.playlist_m3u or args.playlist_wpl or
+                    args.remove_from_playlist):
+                self.transcoder.wait_all()
+                self.post_processor.wait_all()
+
             # create playlist m3u file if needed
-            self.post.create_playlist_m3u(tracks)
+            self.post.create_playlist_m3u(group.entries)
 
             # create playlist wpl file if needed
-            self.post.create_playlist_wpl(tracks)
+            self.post.create_playlist_wpl(group.entries)
 
             # actually removing the tracks from playlist
             self.post.remove_tracks_from_playlist()
@@ -366,13 +414,154 @@ class Ripper(threading.Thread):
             # remove libspotify's offline storage cache
             self.post.remove_offline_cache()
 
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        self.progress.stop()
+
+        # finish any outstanding transcodes
+        self.transcoder.stop(abort=self.abort.is_set())
+        self.post_processor.stop()
+        self.manifest.close()
+        self.covers.prune(self.args.cover_cache_size * MB_BYTES)
+        self.covers.close()
+        self.web.close()
+
         # logout, we are done
         self.post.end_failure_log()
         self.post.print_summary()
+        print("Album browser cache: " + album_browser_cache.stats_str())
+        print("Cover art cache: " + self.covers.stats_str())
+        print("Tags: " + tag_stats.stats_str())
+        self.web.http.print_stats()
+        if self.prefetcher is not None:
+            print("Prefetched " + str(self.prefetcher.warmed) + " tracks")
+        self.writer.stop()
         self.logout()
         self.stop_event_loop()
         self.finished.set()
 
+    def tag_outputs(self, track_context, outputs):
+        """returns the tag hash of each tagged output"""
+        tag_hashes = {}
+        for out_args, audio_file in outputs:
+            # extra wav and pcm files never get tagged
+            if out_args.is_extra_output and \
+                    out_args.output_type in {"wav", "pcm"}:
+                continue
+
+            # update id3v2 with metadata and embed front cover image
+            tag_hashes[audio_file] = set_metadata_tags(
+                out_args, temp_file_path(audio_file), track_context,
+                final_file=audio_file)
+        return tag_hashes
+
+    def finalize_outputs(self, track_context, outputs, samples, tag_hashes):
+        track = track_context.track
+
+        # kept so the outputs can be retagged later without Spotify
+        try:
+            snapshot = track_context.snapshot() if tag_hashes else None
+        except (spotify.Error, Exception) as e:
+            print(Fore.YELLOW + "Warning: could not keep the metadata of " +
+                  track.link.uri + " for retagging: " + str(e) + Fore.RESET)
+            snapshot = None
+
+        # an output only appears under its real name once it is
+        # encoded and tagged, so an existing file is a complete file
+        for out_args, audio_file in outputs:
+            finalize_file(temp_file_path(audio_file), audio_file)
+            tag_hash = tag_hashes.get(audio_file)
+            self.manifest.record(
+                track, out_args, audio_file, samples,
+                snapshot if tag_hash is not None else None, tag_hash)
+
+    def complete_track(self, track_context, outputs, samples,
+                       finished=True):
+        track = track_context.track
+        tag_hashes = self.tag_outputs(track_context, outputs)
+        self.finalize_outputs(track_context, outputs, samples, tag_hashes)
+
+        # more outputs of the track are still being transcoded
+        if not finished:
+            return
+
+        # make a note of the index and remove all the
+        # tracks from the playlist when everything is done
+        self.post.queue_remove_from_playlist(track_context)
+
+        # finally log success
+        self.post.log_success(track)
+
+    def finish_transcode(self, job):
+        try:
+            failed = [ret_code for ret_code in
+                      (result.get() for result in job.results)
+                      if ret_code != 0]
+            if failed:
+                print(Fore.RED + "Transcoding " + job.track.link.uri +
+                      " failed, encoder returned non-zero error code " +
+                      str(failed[0]) + Fore.RESET)
+                for out_args, audio_file in job.outputs:
+                    rm_file(temp_file_path(audio_file))
+                self.post.log_failure(job.track)
+                self.end_pending(job.track, job.outputs)
+                return
+            print(Fore.GREEN + "Transcode complete" + Fore.RESET)
+            self.post_processor.submit(
+                job.track_context, job.outputs, job.samples)
+        except (spotify.Error, Exception) as e:
+            print(Fore.RED + "Error while transcoding " +
+                  job.track.link.uri + Fore.RESET)
+            print(str(e))
+            traceback.print_exc()
+            for out_args, audio_file in job.outputs:
+                rm_file(temp_file_path(audio_file))
+            self.post.log_failure(job.track)
+            self.end_pending(job.track, job.outputs)
+        finally:
+            rm_file(job.spool_file)
+
+    def pending_keys(self, track, outputs):
+        return [track.link.uri] + [audio_file for _, audio_file in outputs]
+
+    def begin_pending(self, track, outputs):
+        """the outputs are handed to a background job, the spool file and
+        temp files of the track can't be reused until it is done"""
+        with self.pending_cond:
+            for key in self.pending_keys(track, outputs):
+                self.pending[key] = self.pending.get(key, 0) + 1
+
+    def end_pending(self, track, outputs):
+        with self.pending_cond:
+            for key in self.pending_keys(track, outputs):
+                self.pending[key] -= 1
+                if self.pending[key] == 0:
+                    del self.pending[key]
+            self.pending_cond.notify_all()
+
+    def wait_for_pending(self, entry):
+        """waits for background jobs still writing the entry's track or
+        outputs, returns whether there were any"""
+        keys = self.pending_keys(entry.track, self.get_outputs(
+            entry.track_context, entry.audio_file))
+
+        def is_pending():
+            with self.pending_cond:
+                return any(key in self.pending for key in keys)
+
+        if not is_pending():
+            return False
+
+        print(Fore.YELLOW + "Waiting for the previous rip of this track "
+              "to finish..." + Fore.RESET)
+        while is_pending() and not self.abort.is_set():
+            # finished transcodes are handed back on this thread
+            self.transcoder.process_finished()
+            with self.pending_cond:
+                if any(key in self.pending for key in keys):
+                    self.pending_cond.wait(0.5)
+        return True
+
     def check_stop_time(self):
         args = self.args
 
@@ -411,7 +600,35 @@ class Ripper(threading.Thread):
             wait_for_resume(resume_time)
             self.play_token_resume.clear()
 
-    def load_link(self, uri):
+    def get_tracks_from_uri(self, uri, group):
+        """resolves a URI to its tracks, the playlist, album or chart they
+        come from is stored on the plan group"""
+        args = self.args
+
+        if isinstance(uri, list):
+            return uri
+        else:
+            if (uri.startswith("spotify:artist:") and
+                    (args.artist_album_type is not None or
+                     args.artist_album_market is not None)):
+                album_uris = self.web.get_albums_with_filter(uri)
+                return itertools.chain(
+                    *[self.load_link(album_uri, group) for
+                      album_uri in album_uris])
+            elif uri.startswith("spotify:charts:"):
+                charts = self.web.get_charts(uri)
+                if charts is not None:
+                    group.chart = charts
+                    chart_uris = charts["tracks"]
+                    return itertools.chain(
+                        *[self.load_link(chart_uri, group) for
+                          chart_uri in chart_uris])
+                else:
+                    return iter([])
+            else:
+                return self.load_link(uri, group)
+
+    def load_link(self, uri, group):
         # ignore if the uri is just blank (e.g. from a file)
         if not uri:
             return iter([])
@@ -422,9 +639,9 @@ class Ripper(threading.Thread):
             track = link.as_track()
             return iter([track])
         elif link.type == spotify.LinkType.PLAYLIST:
-            self.current_playlist = link.as_playlist()
+            playlist = link.as_playlist()
             attempt_count = 1
-            while self.current_playlist is None:
+            while playlist is None:
                 if attempt_count > 3:
                     print(Fore.RED + "Could not load playlist..." +
                           Fore.RESET)
@@ -433,12 +650,13 @@ class Ripper(threading.Thread):
                       "returned None for playlist, trying again in 5 " +
                       "seconds...")
                 time.sleep(5.0)
-                self.current_playlist = link.as_playlist()
+                playlist = link.as_playlist()
                 attempt_count += 1
 
             print('Loading playlist...')
-            self.current_playlist.load(args.timeout)
-            return iter(self.current_playlist.tracks)
+            playlist.load(args.timeout)
+            group.playlist = playlist
+            return iter(playlist.tracks)
         elif link.type == spotify.LinkType.STARRED:
             link_user = link.as_user()
 
@@ -467,10 +685,9 @@ class Ripper(threading.Thread):
             return iter(starred.tracks)
         elif link.type == spotify.LinkType.ALBUM:
             album = link.as_album()
-            album_browser = album.browse()
             print('Loading album browser...')
-            album_browser.load(args.timeout)
-            self.current_album = album
+            album_browser = get_album_browser(album, args.timeout)
+            group.album = album
             return iter(album_browser.tracks)
         elif link.type == spotify.LinkType.ARTIST:
             artist = link.as_artist()
@@ -534,12 +751,12 @@ class Ripper(threading.Thread):
 
     def on_music_delivery(self, session, audio_format,
                           frame_bytes, num_frames):
-        try:
-            self.rip_queue.put_nowait((audio_format.sample_rate,
-                                       frame_bytes, num_frames))
-        except queue.Full:
-            print(Fore.RED + "rip_queue is full. dropped music data" +
-                  Fore.RESET)
+        # if the buffer is full, consume nothing so libspotify
+        # delivers the same frames again instead of us dropping them
+        if not self.rip_queue.put((audio_format.sample_rate,
+                                   frame_bytes, num_frames),
+                                  len(frame_bytes)):
+            return 0
         return num_frames
 
     def on_connection_state_changed(self, session):
@@ -606,16 +823,21 @@ class Ripper(threading.Thread):
             self.session.logout()
             self.logged_out.wait()
 
-    def format_track_path(self, idx, track, use_cache=True):
+    def format_track_path(self, track_context, use_cache=True,
+                          out_args=None):
         args = self.args
+        track = track_context.track
+        if out_args is None:
+            out_args = args
 
         # check if we cached the result already
         track.load(args.timeout)
         if use_cache and track.link.uri in self.track_path_cache:
             return self.track_path_cache[track.link.uri]
 
-        audio_file = \
-            format_track_string(self, args.format.strip(), idx, track)
+        audio_file = format_track_string(
+            track_context, out_args.format.strip(),
+            ext=out_args.output_type)
 
         # replace filename
         if args.replace is not None:
@@ -634,7 +856,12 @@ class Ripper(threading.Thread):
         # create directory if it doesn't exist
         audio_path = os.path.dirname(audio_file)
         if not path_exists(audio_path):
-            os.makedirs(enc_str(audio_path))
+            try:
+                os.makedirs(enc_str(audio_path))
+            except OSError as e:
+                # the plan thread may have just created it
+                if e.errno != errno.EEXIST:
+                    raise
 
         if use_cache:
             self.track_path_cache[track.link.uri] = audio_file
@@ -646,164 +873,104 @@ class Ripper(threading.Thread):
             filename = re.sub(repl[0], repl[1], filename)
         return filename
 
-    def prepare_rip(self, idx, track):
+    def prepare_rip(self, track_context):
         args = self.args
+        track = track_context.track
 
         # reset progress
         self.progress.prepare_track(track)
+        self.rip_queue.reset_stats()
 
-        if self.progress.total_tracks > 1:
+        if self.progress.show_total:
+            total_str = "?" if self.progress.estimating else \
+                str(self.progress.total_tracks +
+                    self.progress.skipped_tracks)
             print(Fore.GREEN + "[ " + str(self.progress.track_idx) + " / " +
-                  str(self.progress.total_tracks +
-                      self.progress.skipped_tracks) + " ] Ripping " +
+                  total_str + " ] Ripping " +
                   track.link.uri + Fore.WHITE +
                   "\t(ESC to skip)" + Fore.RESET)
         else:
             print(Fore.GREEN + "Ripping " + track.link.uri + Fore.RESET)
         print(Fore.CYAN + self.audio_file + Fore.RESET)
 
+        # the totals are printed once the plan thread has them
+        if self.progress.show_total_size():
+            print("Total Download Size: " +
+                  format_size(self.progress.total_size))
+
         file_size = calc_file_size(track)
         print("Track Download Size: " + format_size(file_size))
 
-        def get_extra_audio_file(ext):
-            orig_output_type = args.output_type
-            args.output_type = ext
-            audio_file = self.format_track_path(idx, track, False)
-            args.output_type = orig_output_type
-            return audio_file
-
-        if args.output_type == "wav" or args.plus_wav:
-            audio_file = get_extra_audio_file("wav")
-            wav_file = audio_file if sys.version_info >= (3, 0) \
-                else enc_str(audio_file)
-            self.wav_file = wave.open(wav_file, "wb")
-            self.wav_file.setparams((2, 2, 44100, 0, 'NONE', 'not compressed'))
-
-        if args.output_type == "pcm" or args.plus_pcm:
-            audio_file = get_extra_audio_file("pcm")
-            self.pcm_file = open(enc_str(audio_file), 'wb')
-
-        audio_file_enc = enc_str(self.audio_file)
-
-        if args.output_type == "flac":
-            self.rip_proc = Popen(
-                ["flac", "-f", ("-" + str(args.comp)), "--silent", "--endian",
-                 "little", "--channels", "2", "--bps", "16", "--sample-rate",
-                 "44100", "--sign", "signed", "-o", audio_file_enc, "-"],
-                stdin=PIPE)
-        elif args.output_type == "aiff":
-            self.rip_proc = Popen(
-                ["sox", "-q", "--endian",
-                 "little", "--channels", "2", "--bits", "16", "--rate",
-                 "44100", "--encoding", "unsigned-integer", "-t", "raw",
-                 "-", audio_file_enc],
-                stdin=PIPE)
-        elif args.output_type == "alac.m4a":
-            self.rip_proc = Popen(
-                ["avconv", "-nostats", "-loglevel", "0", "-f", "s16le", "-ar",
-                 "44100", "-ac", "2", "-channel_layout", "stereo", "-i", "-",
-                 "-acodec", "alac", audio_file_enc],
-                stdin=PIPE)
-        elif args.output_type == "ogg":
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["oggenc", "--quiet", "--raw", "-b", args.bitrate, "-o",
-                     audio_file_enc, "-"], stdin=PIPE)
-            else:
-                self.rip_proc = Popen(
-                    ["oggenc", "--quiet", "--raw", "-q", args.vbr, "-o",
-                     audio_file_enc, "-"], stdin=PIPE)
-        elif args.output_type == "opus":
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["opusenc", "--quiet", "--comp", args.comp, "--cvbr",
-                     "--bitrate", str(int(args.bitrate) / 2), "--raw",
-                     "--raw-rate", "44100", "-", audio_file_enc], stdin=PIPE)
-            else:
-                self.rip_proc = Popen(
-                    ["opusenc", "--quiet", "--comp", args.comp, "--vbr",
-                     "--bitrate", args.vbr, "--raw", "--raw-rate", "44100",
-                     "-", audio_file_enc], stdin=PIPE)
-        elif args.output_type == "aac":
-            if self.dev_null is None:
-                self.dev_null = open(os.devnull, 'wb')
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["faac", "-P", "-X", "-b", args.bitrate, "-o",
-                     audio_file_enc, "-"], stdin=PIPE,
-                    stdout=self.dev_null, stderr=self.dev_null)
-            else:
-                self.rip_proc = Popen(
-                    ["faac", "-P", "-X", "-q", args.vbr, "-o",
-                     audio_file_enc, "-"], stdin=PIPE,
-                    stdout=self.dev_null, stderr=self.dev_null)
-        elif args.output_type == "m4a":
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["fdkaac", "-S", "-R", "-b",
-                     args.bitrate, "-o", audio_file_enc, "-"], stdin=PIPE)
-            else:
-                self.rip_proc = Popen(
-                    ["fdkaac", "-S", "-R", "-m", args.vbr,
-                     "-o", audio_file_enc, "-"], stdin=PIPE)
-        elif args.output_type == "mp3":
-            lame_args = ["lame", "--silent"]
-
-            if args.stereo_mode is not None:
-                lame_args.extend(["-m", args.stereo_mode])
-
-            if args.cbr:
-                lame_args.extend(["-cbr", "-b", args.bitrate])
+        # when spooling, only raw PCM is written during the capture
+        # and the spooled outputs are encoded after the rip
+        self.outputs = self.get_outputs(track_context, self.audio_file)
+        self.spooled_outputs = []
+        self.encoders = []
+        for out_args, audio_file in self.outputs:
+            if out_args.is_extra_output:
+                print(Fore.CYAN + audio_file + Fore.RESET)
+
+            if self.transcoder.should_spool(out_args):
+                self.spooled_outputs.append((out_args, audio_file))
             else:
-                lame_args.extend(["-V", args.vbr])
+                self.encoders.append(create_encoder(
+                    out_args, out_args.output_type,
+                    temp_file_path(audio_file)))
 
-            lame_args.extend(["-h", "-r", "-", audio_file_enc])
-            self.rip_proc = Popen(lame_args, stdin=PIPE)
+        if self.spooled_outputs:
+            self.spool_file = self.transcoder.spool_path(track)
+            self.encoders.append(
+                create_encoder(args, "pcm", self.spool_file))
 
-        if self.rip_proc is not None:
-            self.pipe = self.rip_proc.stdin
+        # frames are written to the encoders on the writer thread
+        self.writer.begin_track(
+            [encoder.write for encoder in self.encoders])
 
         self.ripping.set()
 
     def finish_rip(self, track):
+        """returns whether every encoder finished its output"""
         self.progress.end_track()
-        if self.pipe is not None:
-            print(Fore.GREEN + 'Rip complete' + Fore.RESET)
-            self.pipe.flush()
-            self.pipe.close()
 
-            # wait for process to end before continuing
-            ret_code = self.rip_proc.wait()
+        # wait for the writer to drain before closing the encoders
+        writer_stats = self.writer.end_track()
+
+        print(Fore.GREEN + 'Rip complete' + Fore.RESET)
+        success = True
+        for encoder in self.encoders:
+            ret_code = encoder.close()
             if ret_code != 0:
-                print(
-                    Fore.YELLOW + "Warning: encoder returned non-zero "
-                                  "error code " + str(ret_code) + Fore.RESET)
-            self.rip_proc = None
-            self.pipe = None
-
-        if self.wav_file is not None:
-            self.wav_file.close()
-            self.wav_file = None
-
-        if self.pcm_file is not None:
-            self.pcm_file.flush()
-            os.fsync(self.pcm_file.fileno())
-            self.pcm_file.close()
-            self.pcm_file = None
+                print(Fore.RED + "Encoder returned non-zero error code " +
+                      str(ret_code) + Fore.RESET)
+                success = False
+        self.encoders = []
 
+        # 16-bit stereo frames
+        self.samples_captured = writer_stats.bytes_written // 4
+
+        writer_stats.log()
+        self.rip_queue.log_stats()
         self.ripping.clear()
+        return success
+
+    def get_outputs(self, track_context, audio_file):
+        """returns (args, audio_file) pairs for the main output and any
+        extra outputs encoded from the same rip"""
+        outputs = [(self.args, audio_file)]
+        for out_args in self.args.extra_outputs:
+            outputs.append((out_args, self.format_track_path(
+                track_context, use_cache=False, out_args=out_args)))
+        return outputs
+
+    def abort_encoders(self):
+        for encoder in self.encoders:
+            encoder.abort()
+        self.encoders = []
 
     def rip(self, session, sample_rate, frame_bytes, num_frames):
         if self.ripping.is_set():
             self.progress.update_progress(num_frames, sample_rate)
-            if self.pipe is not None:
-                self.pipe.write(frame_bytes)
-
-            if self.wav_file is not None:
-                self.wav_file.writeframes(frame_bytes)
-
-            if self.pcm_file is not None:
-                self.pcm_file.write(frame_bytes)
+            self.writer.write(frame_bytes)
 
     def abort_rip(self):
         self.ripping.clear()
@@ -57,7 +57,7 @@ class Sync(object):
         else:
             return {}
 
-    def sync_playlist(self, playlist):
+    def sync_playlist(self, playlist, entries):
         args = self.args
         playlist.load(args.timeout)
         lib = self.load_sync_library(playlist)
@@ -65,18 +65,11 @@ class Sync(object):
 
         print("Syncing playlist " + to_ascii(playlist.name))
 
-        # create new lib
-        for idx, track in enumerate(playlist.tracks):
-            try:
-                track.load(args.timeout)
-                if track.availability != 1 or track.is_local:
-                    continue
-
-                audio_file = self.ripper.format_track_path(idx, track)
-                new_lib[track.link.uri] = audio_file
-
-            except spotify.Error as e:
+        # create new lib from the planned tracks
+        for entry in entries:
+            if entry.status in {None, "unavailable", "error"}:
                 continue
+            new_lib[entry.track.link.uri] = entry.audio_file
 
         # check what items are missing or renamed in the new_lib vs lib
         for uri, file_path in lib.items():
@@ -90,6 +83,8 @@ class Sync(object):
                               "\n  From: " + file_path + "\n  To:   " +
                               new_file_path)
                         os.rename(enc_file_path, enc_str(new_file_path))
+                        self.ripper.manifest.rename(file_path,
+                                                    new_file_path)
                 else:
                     print(Fore.YELLOW + "Removing file: " + Fore.RESET +
                           "\n " + file_path)
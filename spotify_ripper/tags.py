@@ -6,24 +6,76 @@ from colorama import Fore, Style
 from mutagen import mp3, id3, flac, aiff, oggvorbis, oggopus, aac, mp4
 from stat import ST_SIZE
 from spotify_ripper.utils import *
+from spotify_ripper.template import format_track_string
+from spotify_ripper.covers import write_cover_file
 import os
 import sys
 import base64
+import hashlib
+import json
+import threading
+import mutagen
 
 if sys.version_info < (3, 0):
     from mutagen import m4a
 
 
+def padding_kwargs(args):
+    # mutagen 1.31 and later trim large padding unless told otherwise,
+    # older versions always reuse the existing space
+    if mutagen.version < (1, 31):
+        return {}
+
+    def padding(info):
+        # use all the space the encoder reserved instead of trimming it
+        if info.padding >= 0:
+            return info.padding
+
+        # the audio is moved anyway (in-process FLAC reserves no space),
+        # so leave room for the next save
+        if args.tag_padding is None:
+            return info.get_default_padding()
+        return args.tag_padding * KB_BYTES
+
+    return {"padding": padding}
+
+
+class TagStats(object):
+    """Counts tag saves that fit in the space reserved in the file and
+    those that had to move the audio data to make room"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_place = 0
+        self.rewritten = 0
+        self.bytes_rewritten = 0
+
+    def record(self, size_before, size_after):
+        with self.lock:
+            if size_before == size_after:
+                self.in_place += 1
+            else:
+                self.rewritten += 1
+                self.bytes_rewritten += size_after
+
+    def stats_str(self):
+        return (str(self.in_place) + " in place, " + str(self.rewritten) +
+                " rewritten (" + format_size(self.bytes_rewritten) + ")")
+
+
+tag_stats = TagStats()
+
+
 class Tags(object):
 
-    def __init__(self, args, audio_file, idx, track, ripper):
+    def __init__(self, args, audio_file, track_context):
         self.args = args
         self.audio_file = audio_file
         self.on_error = 'replace' if args.ascii_path_only else 'ignore'
 
         self.tags = {}
-        self.populate_tags(track, ripper)
-        self.override_tags(idx, track, ripper)
+        self.populate_tags(track_context)
+        self.override_tags(track_context)
 
     def create_pair(self, _str):
         return (_str, to_ascii(_str, self.on_error))
@@ -34,55 +86,34 @@ class Tags(object):
         else:
             return "%d" % (_idx)
 
-    def populate_tags(self, track, ripper):
+    def populate_tags(self, track_context):
         args = self.args
+        metadata = track_context.tag_metadata()
 
-        album_browser = track.album.browse()
-        album_browser.load(args.timeout)
-
-        self.tags['album'] = self.create_pair(track.album.name)
-        artists = ", ".join([artist.name for artist in track.artists]) \
-            if args.all_artists else track.artists[0].name
+        self.tags['album'] = self.create_pair(metadata["album"])
+        artists = ", ".join(metadata["artists"]) \
+            if args.all_artists else metadata["artists"][0]
         self.tags['artists'] = self.create_pair(artists)
-        self.tags['album_artist'] = self.create_pair(track.album.artist.name)
-        self.tags['title'] = self.create_pair(track.name)
-        self.tags['year'] = track.album.year
-        self.tags['disc_idx'] = track.disc
-        self.tags['track_idx'] = track.index
-
-        # calculate num of tracks on disc and num of dics
-        num_discs = 0
-        num_tracks = 0
-        for track_browse in album_browser.tracks:
-            if (track_browse.disc == track.disc and
-                    track_browse.index > track.index):
-                num_tracks = track_browse.index
-            if track_browse.disc > num_discs:
-                num_discs = track_browse.disc
-
-        self.tags['num_discs'] = num_discs
-        self.tags['num_tracks'] = num_tracks
+        self.tags['album_artist'] = self.create_pair(metadata["album_artist"])
+        self.tags['title'] = self.create_pair(metadata["title"])
+        self.tags['year'] = metadata["year"]
+        self.tags['disc_idx'] = metadata["disc"]
+        self.tags['track_idx'] = metadata["index"]
+        self.tags['num_discs'] = metadata["num_discs"]
+        self.tags['num_tracks'] = metadata["num_tracks"]
 
         if args.genres is not None:
-            genres = ripper.web.get_genres(args.genres, track)
+            genres = track_context.genres(args.genres)
             if genres is not None and genres:
                 self.tags['genres'] = (genres, [to_ascii(genre) for genre in genres])
 
-        # cover art image
-        self.image = None
-        if args.large_cover_art:
-            self.image = ripper.web.get_large_coverart(track.link.uri)
-
-        # if we fail, use regular cover size
-        if self.image is None:
-            self.image = track.album.cover()
-            if self.image is not None:
-                self.image.load(args.timeout)
-                self.image = self.image.data
+        # cover art image, shared by every track on the album
+        self.image = track_context.cover_image()
 
-    def override_tags(self, idx, track, ripper):
+    def override_tags(self, track_context):
         args = self.args
-        tag_overrides = args.tag_override if args.tag_override is not None else []
+        tag_overrides = list(args.tag_override) \
+            if args.tag_override is not None else []
 
         if args.comment is not None:
             tag_overrides.append("comment=" + args.comment)
@@ -106,13 +137,29 @@ class Tags(object):
                 continue
 
             override_str = \
-                format_track_string(ripper, tokens[1], idx, track)
+                format_track_string(track_context, tokens[1])
 
             if tokens[0] == "genres":
                 self.tags[tokens[0]] = ([override_str], [to_ascii(override_str, self.on_error)])
             else:
                 self.tags[tokens[0]] = (override_str, to_ascii(override_str, self.on_error))
 
+    def tag_hash(self):
+        """hash of everything written into the file, a retag only
+        rewrites files whose hash changed"""
+        args = self.args
+        embeds_cover = args.cover_file is None and self.image is not None
+        state = {
+            "output_type": args.output_type,
+            "id3_v23": args.id3_v23,
+            "ascii_path_only": args.ascii_path_only,
+            "tags": self.tags,
+            "cover": hashlib.sha1(self.image).hexdigest()
+                if embeds_cover else None,
+        }
+        return hashlib.sha1(json.dumps(
+            state, sort_keys=True).encode("utf-8")).hexdigest()
+
     def get_field(self, field, use_ascii):
         pair = self.tags.get(field)
         if pair is not None:
@@ -125,10 +172,8 @@ class Tags(object):
         if self.image is not None:
             def write_image(file_name):
                 cover_path = os.path.dirname(self.audio_file)
-                cover_file = os.path.join(cover_path, file_name)
-                if not path_exists(cover_file):
-                    with open(enc_str(cover_file), "wb") as f:
-                        f.write(self.image)
+                write_cover_file(os.path.join(cover_path, file_name),
+                                 self.image)
 
             if args.cover_file is not None:
                 write_image(args.cover_file)
@@ -191,12 +236,13 @@ class Tags(object):
 
 class Id3Tags(Tags):
 
-    def __init__(self, args, audio_file, idx, track, ripper):
-        super(Id3Tags, self).__init__(args, audio_file, idx, track, ripper)
+    def __init__(self, args, audio_file, track_context):
+        super(Id3Tags, self).__init__(args, audio_file, track_context)
 
     def set_tags(self, audio):
-        # add ID3 tag if it doesn't exist
-        audio.add_tags()
+        # add ID3 tag if it doesn't exist (lame writes a padded one)
+        if audio.tags is None:
+            audio.add_tags()
 
         def embed_image(data):
             audio.tags.add(
@@ -235,19 +281,21 @@ class Id3Tags(Tags):
             tcon_tag.genres = self.genres()
             audio.tags.add(tcon_tag)
 
+        save_kwargs = padding_kwargs(self.args) \
+            if self.args.output_type == "mp3" else {}
         if self.args.id3_v23:
             audio.tags.update_to_v23()
-            audio.save(v2_version=3, v23_sep='/')
+            audio.save(v2_version=3, v23_sep='/', **save_kwargs)
             audio.tags.version = (2, 3, 0)
         else:
-            audio.save()
+            audio.save(**save_kwargs)
 
 
 # AAC is not well supported
 class RawId3Tags(Tags):
 
-    def __init__(self, args, audio_file, idx, track, ripper):
-        super(RawId3Tags, self).__init__(args, audio_file, idx, track, ripper)
+    def __init__(self, args, audio_file, track_context):
+        super(RawId3Tags, self).__init__(args, audio_file, track_context)
 
     def set_tags(self, audio):
         try:
@@ -303,8 +351,8 @@ class RawId3Tags(Tags):
 
 class VorbisTags(Tags):
 
-    def __init__(self, args, audio_file, idx, track, ripper):
-        super(VorbisTags, self).__init__(args, audio_file, idx, track, ripper)
+    def __init__(self, args, audio_file, track_context):
+        super(VorbisTags, self).__init__(args, audio_file, track_context)
 
     def set_tags(self, audio):
         # add Vorbis comment block if it doesn't exist
@@ -350,14 +398,23 @@ class VorbisTags(Tags):
         if self.genres() is not None:
             audio.tags["GENRE"] = ", ".join(self.genres())
 
-        audio.save()
+        if self.args.output_type == "flac":
+            # older mutagen only grows padding that is already there
+            if mutagen.version < (1, 31) and self.args.tag_padding and \
+                    not any(isinstance(block, flac.Padding)
+                            for block in audio.metadata_blocks):
+                audio.metadata_blocks.append(flac.Padding(
+                    b"\x00" * (self.args.tag_padding * KB_BYTES)))
+            audio.save(**padding_kwargs(self.args))
+        else:
+            audio.save()
 
 
 # only called by Python 3
 class MP4Tags(Tags):
 
-    def __init__(self, args, audio_file, idx, track, ripper):
-        super(MP4Tags, self).__init__(args, audio_file, idx, track, ripper)
+    def __init__(self, args, audio_file, track_context):
+        super(MP4Tags, self).__init__(args, audio_file, track_context)
 
     def set_tags(self, audio):
         # add MP4 tags if it doesn't exist
@@ -396,8 +453,8 @@ class MP4Tags(Tags):
 
 class M4ATags(Tags):
 
-    def __init__(self, args, audio_file, idx, track, ripper):
-        super(M4ATags, self).__init__(args, audio_file, idx, track, ripper)
+    def __init__(self, args, audio_file, track_context):
+        super(M4ATags, self).__init__(args, audio_file, track_context)
 
     def set_tags(self, audio):
         # add M4A tags if it doesn't exist
@@ -433,69 +490,75 @@ class M4ATags(Tags):
         audio.save()
 
 
-def set_metadata_tags(args, audio_file, idx, track, ripper):
+def new_tags(args, audio_file, track_context):
+    if args.output_type in {"flac", "ogg", "opus"}:
+        return VorbisTags(args, audio_file, track_context)
+    elif args.output_type in {"aiff", "mp3"}:
+        return Id3Tags(args, audio_file, track_context)
+    elif args.output_type == "aac":
+        return RawId3Tags(args, audio_file, track_context)
+    elif args.output_type in {"m4a", "alac.m4a"}:
+        if sys.version_info >= (3, 0):
+            return MP4Tags(args, audio_file, track_context)
+        else:
+            return M4ATags(args, audio_file, track_context)
+    return None
+
+
+def write_tags(args, audio_file, tags, replace=False):
+    """saves the tags into the file and returns it opened with mutagen,
+    replace drops the tags already in the file first"""
+    if args.output_type == "flac":
+        audio = flac.FLAC(audio_file)
+    elif args.output_type == "aiff":
+        audio = aiff.AIFF(audio_file)
+    elif args.output_type == "ogg":
+        audio = oggvorbis.OggVorbis(audio_file)
+    elif args.output_type == "opus":
+        audio = oggopus.OggOpus(audio_file)
+    elif args.output_type == "aac":
+        audio = aac.AAC(audio_file)
+    elif args.output_type == "m4a" or args.output_type == "alac.m4a":
+        if sys.version_info >= (3, 0):
+            audio = mp4.MP4(audio_file)
+        else:
+            tags.set_tags(m4a.M4A(audio_file))
+            return mp4.MP4(audio_file)
+    elif args.output_type == "mp3":
+        audio = mp3.MP3(audio_file, ID3=id3.ID3)
+
+    if replace and audio.tags is not None:
+        audio.tags.clear()
+        if args.output_type == "flac":
+            audio.clear_pictures()
+    tags.set_tags(audio)
+    return audio
+
+
+def set_metadata_tags(args, audio_file, track_context, final_file=None):
+    """tags the file and returns the hash of its tags"""
     # log completed file
-    print(Fore.GREEN + Style.BRIGHT + os.path.basename(audio_file) +
-          Style.NORMAL + "\t[ " +
-          format_size(os.stat(enc_str(audio_file))[ST_SIZE]) + " ]" +
+    size_before = os.stat(enc_str(audio_file))[ST_SIZE]
+    print(Fore.GREEN + Style.BRIGHT +
+          os.path.basename(final_file if final_file is not None
+                           else audio_file) +
+          Style.NORMAL + "\t[ " + format_size(size_before) + " ]" +
           Fore.RESET)
 
     if args.output_type == "wav" or args.output_type == "pcm":
         print_yellow("Skipping metadata tagging for " + args.output_type +
             " encoding...")
-        return
+        return None
 
     # ensure everything is loaded still
-    if not track.is_loaded:
-        track.load(args.timeout)
-    if not track.album.is_loaded:
-        track.album.load(args.timeout)
+    track_context.load()
 
     # use mutagen to update audio file tags
     try:
-        audio = None
-        tags = None
+        tags = new_tags(args, audio_file, track_context)
+        audio = write_tags(args, audio_file, tags)
 
-        if args.output_type == "flac":
-            audio = flac.FLAC(audio_file)
-            tags = VorbisTags(args, audio_file, idx, track, ripper)
-            tags.set_tags(audio)
-
-        elif args.output_type == "aiff":
-            audio = aiff.AIFF(audio_file)
-            tags = Id3Tags(args, audio_file, idx, track, ripper)
-            tags.set_tags(audio)
-
-        elif args.output_type == "ogg":
-            audio = oggvorbis.OggVorbis(audio_file)
-            tags = VorbisTags(args, audio_file, idx, track, ripper)
-            tags.set_tags(audio)
-
-        elif args.output_type == "opus":
-            audio = oggopus.OggOpus(audio_file)
-            tags = VorbisTags(args, audio_file, idx, track, ripper)
-            tags.set_tags(audio)
-
-        elif args.output_type == "aac":
-            audio = aac.AAC(audio_file)
-            tags = RawId3Tags(args, audio_file, idx, track, ripper)
-            tags.set_tags(audio)
-
-        elif args.output_type == "m4a" or args.output_type == "alac.m4a":
-            if sys.version_info >= (3, 0):
-                audio = mp4.MP4(audio_file)
-                tags = MP4Tags(args, audio_file, idx, track, ripper)
-                tags.set_tags(audio)
-            else:
-                audio = m4a.M4A(audio_file)
-                tags = M4ATags(args, audio_file, idx, track, ripper)
-                tags.set_tags(audio)
-                audio = mp4.MP4(audio_file)
-
-        elif args.output_type == "mp3":
-            audio = mp3.MP3(audio_file, ID3=id3.ID3)
-            tags = Id3Tags(args, audio_file, idx, track, ripper)
-            tags.set_tags(audio)
+        tag_stats.record(size_before, os.stat(enc_str(audio_file))[ST_SIZE])
 
         # utility functions
         def bit_rate_str(bit_rate):
@@ -647,6 +710,9 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
                   str(audio.info.codec))
             print_line()
 
+        return tags.tag_hash()
+
     except id3.error:
         print_yellow("Warning: exception while saving id3 tag: " +
               str(id3.error))
+        return None
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from spotify_ripper.utils import *
+import re
+
+# format variables mapped to the field they are an alias of
+field_aliases = {
+    "track_artist": "artist",
+    "artist": "artist",
+    "track_artists": "artists",
+    "artists": "artists",
+    "album_artist": "album_artist",
+    "album_artists_web": "album_artists_web",
+    "album": "album",
+    "track_name": "track_name",
+    "track": "track_name",
+    "year": "year",
+    "ext": "ext",
+    "extension": "ext",
+    "idx": "idx",
+    "index": "idx",
+    "track_num": "track_num",
+    "track_idx": "track_num",
+    "track_index": "track_num",
+    "disc_num": "disc_num",
+    "disc_idx": "disc_num",
+    "disc_index": "disc_num",
+    "smart_track_num": "smart_track_num",
+    "smart_track_idx": "smart_track_num",
+    "smart_track_index": "smart_track_num",
+    "playlist": "playlist",
+    "playlist_name": "playlist",
+    "playlist_owner": "playlist_owner",
+    "playlist_user": "playlist_owner",
+    "playlist_username": "playlist_owner",
+    "user": "user",
+    "username": "user",
+    "feat_artists": "feat_artists",
+    "featuring_artists": "feat_artists",
+    "copyright": "copyright",
+    "label": "label",
+    "copyright_holder": "label",
+    "playlist_track_add_time": "track_add_time",
+    "track_add_time": "track_add_time",
+    "playlist_track_add_user": "track_add_user",
+    "track_add_user": "track_add_user",
+    "track_uri": "uri",
+    "uri": "uri",
+}
+
+# fields that take a modifier, e.g. {idx:3}, {feat_artists:feat.}
+# and {track_name:paren}
+fill_fields = {"idx", "track_num", "disc_num", "smart_track_num"}
+prefix_fields = {"feat_artists"}
+paren_fields = {"track_name"}
+
+field_regex = re.compile(r"\{([^{}:]+)(?::([^{}]+))?\}")
+fill_regex = re.compile(r"^\d+$")
+paren_regex = re.compile(r"(.*)\s+-\s+([^-]+)")
+
+
+class Template(object):
+    """A format string parsed once into literal text and the fields it
+    references"""
+
+    def __init__(self, format_string):
+        self.format_string = format_string
+        self.parts = []
+        self.fields = set()
+
+        pos = 0
+        for match in field_regex.finditer(format_string):
+            name, modifier = match.group(1), match.group(2)
+            field = field_aliases.get(name)
+
+            # unknown variables and modifiers are left as they are
+            if field is None or (modifier is not None and
+                                 self.modifier_kind(field, modifier) is None):
+                continue
+
+            kind = self.modifier_kind(field, modifier) \
+                if modifier is not None else None
+            self.parts.append(
+                (format_string[pos:match.start()], field, kind, modifier))
+            self.fields.add(field)
+            pos = match.end()
+
+        self.tail = format_string[pos:]
+
+    def modifier_kind(self, field, modifier):
+        if field in fill_fields and fill_regex.match(modifier):
+            return "fill"
+        elif field in prefix_fields:
+            return "prefix"
+        elif field in paren_fields and modifier == "paren":
+            return "paren"
+        return None
+
+    def render(self, track_context, ext):
+        result = ""
+        for literal, field, kind, modifier in self.parts:
+            result += literal
+            value = ext if field == "ext" else track_context.get(field)
+
+            if kind is None:
+                result += value
+            elif kind == "fill":
+                result += value.zfill(int(modifier))
+            elif kind == "prefix":
+                # don't print prefix if there are no values
+                if len(value) > 0:
+                    result += modifier + " " + value
+                else:
+                    result = result.rstrip()
+            elif kind == "paren":
+                match = paren_regex.search(value)
+                if match:
+                    result += match.group(1) + " (" + match.group(2) + ")"
+                else:
+                    result += value
+        return result + self.tail
+
+
+template_cache = {}
+
+
+def compile_template(format_string):
+    template = template_cache.get(format_string)
+    if template is None:
+        template = Template(format_string)
+        template_cache[format_string] = template
+    return template
+
+
+def format_track_string(track_context, format_string, ext=None):
+    args = get_args()
+    template = compile_template(format_string)
+    format_string = template.render(
+        track_context, ext if ext is not None else args.output_type)
+
+    if args.format_case is not None:
+        if args.format_case == "upper":
+            format_string = format_string.upper()
+        elif args.format_case == "lower":
+            format_string = format_string.lower()
+        elif args.format_case == "capitalize":
+            format_string = ' '.join(word[0].upper() + word[1:] for \
+                word in format_string.split())
+
+    return format_string
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.encoders import new_encoder
+import argparse
+import multiprocessing
+import os
+import signal
+
+
+def init_worker():
+    # let the main process handle ctrl-c
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# executes in a worker process
+def transcode_spool_file(args, output_type, spool_file, audio_file):
+    init_util_globals(args)
+    encoder = new_encoder(args, output_type, audio_file)
+    return encoder.encode_file(spool_file)
+
+
+class TranscodeJob(object):
+
+    def __init__(self, track_context, outputs, spool_file, samples,
+                 results):
+        self.track_context = track_context
+        self.track = track_context.track
+        self.outputs = outputs
+        self.spool_file = spool_file
+        self.samples = samples
+        self.results = results
+
+    def ready(self):
+        return all(result.ready() for result in self.results)
+
+    def wait(self):
+        for result in self.results:
+            result.wait()
+
+
+class Transcoder(object):
+    """Encodes spooled raw PCM files on a pool of worker processes so
+    slow encoder settings never hold up the capture loop"""
+
+    pool = None
+
+    def __init__(self, args, ripper):
+        self.args = args
+        self.ripper = ripper
+        self.jobs = []
+
+        if args.spool and any(
+                self.should_spool(out_args)
+                for out_args in [args] + args.extra_outputs):
+            # create the pool before libspotify starts any threads
+            self.pool = multiprocessing.Pool(
+                args.transcode_workers, init_worker)
+
+    def should_spool(self, out_args):
+        return self.args.spool and \
+            out_args.output_type not in {"wav", "pcm"}
+
+    def spool_dir(self):
+        args = self.args
+        if args.spool_dir is not None:
+            return norm_path(args.spool_dir)
+        return os.path.join(settings_dir(), "Spool")
+
+    def spool_path(self, track):
+        _spool_dir = self.spool_dir()
+        if not path_exists(_spool_dir):
+            os.makedirs(enc_str(_spool_dir))
+        return os.path.join(
+            _spool_dir, track.link.uri.replace(":", "_") + ".pcm")
+
+    def worker_args(self, out_args):
+        # the uri list can hold unpicklable track objects from a search
+        job_args = argparse.Namespace(**vars(out_args))
+        job_args.uri = None
+        job_args.extra_outputs = []
+        return job_args
+
+    def submit(self, track_context, outputs, spool_file, samples):
+        # each output of the track is encoded on its own worker
+        results = [self.pool.apply_async(
+            transcode_spool_file,
+            (self.worker_args(out_args), out_args.output_type,
+             spool_file, temp_file_path(audio_file)))
+            for out_args, audio_file in outputs]
+        self.jobs.append(TranscodeJob(
+            track_context, outputs, spool_file, samples, results))
+        print(Fore.GREEN + "Queued for transcoding (" + str(len(self.jobs)) +
+              " pending)" + Fore.RESET)
+
+    def process_finished(self, wait=False):
+        """hands finished jobs back to the ripper thread for tagging"""
+        if wait and self.jobs:
+            print(Fore.GREEN + "Waiting for " + str(len(self.jobs)) +
+                  " transcode(s) to finish..." + Fore.RESET)
+
+        for job in list(self.jobs):
+            if wait:
+                job.wait()
+            if job.ready():
+                self.jobs.remove(job)
+                self.ripper.finish_transcode(job)
+
+    def wait_all(self):
+        self.process_finished(wait=True)
+
+    def stop(self, abort=False):
+        if self.pool is None:
+            return
+
+        if abort:
+            self.pool.terminate()
+            for job in self.jobs:
+                for out_args, audio_file in job.outputs:
+                    rm_file(temp_file_path(audio_file))
+                rm_file(job.spool_file)
+                self.ripper.post.log_failure(job.track)
+            self.jobs = []
+        else:
+            self.wait_all()
+            self.pool.close()
+        self.pool.join()
+        self.pool = None
@@ -8,6 +8,7 @@ import mutagen
 import os
 import sys
 import errno
+import hashlib
 import re
 import math
 import unicodedata
@@ -117,6 +118,34 @@ def rm_file(file_name):
             print(str(e))
 
 
+TEMP_FILE_PREFIX = ".spotify-ripper-tmp-"
+'''Prefix of the file an output is written to until it is complete'''
+
+
+def temp_file_path(audio_file):
+    """the file name an output is encoded and tagged under, it lives in
+    the same directory so the final rename is atomic"""
+    file_name = os.path.basename(audio_file)
+
+    # a fixed length name, the file name may already be as long as the
+    # file system allows.  encoders and mutagen go by the extension
+    digest = hashlib.sha1(enc_str(file_name)).hexdigest()[:16]
+    return os.path.join(os.path.dirname(audio_file), TEMP_FILE_PREFIX +
+                        digest + os.path.splitext(file_name)[1])
+
+
+def finalize_file(temp_file, audio_file):
+    """move a completed temp file to its final name, replacing any
+    existing file"""
+    if sys.version_info >= (3, 3):
+        os.replace(enc_str(temp_file), enc_str(audio_file))
+    else:
+        # rename won't replace an existing file on windows
+        if os.name == "nt" and path_exists(audio_file):
+            rm_file(audio_file)
+        os.rename(enc_str(temp_file), enc_str(audio_file))
+
+
 def default_settings_dir():
     return norm_path(os.path.join(os.path.expanduser("~"), ".spotify-ripper"))
 
@@ -166,15 +195,6 @@ def parse_time_str(time_str):
     return None
 
 
-def get_playlist_track(track, playlist):
-    if playlist is not None:
-        pl_tracks = playlist.tracks_with_metadata
-        for pl_track in pl_tracks:
-            if pl_track.track == track:
-                return pl_track
-    return None
-
-
 def change_file_extension(file_name, ext):
     return os.path.splitext(file_name)[0] + "." + ext
 
@@ -211,193 +231,6 @@ def make_windows_safe(file_name):
     return file_name
 
 
-def format_track_string(ripper, format_string, idx, track):
-    args = get_args()
-    current_album = ripper.current_album
-    current_playlist = ripper.current_playlist
-
-    # this fixes the track.disc
-    if not track.is_loaded:
-        track.load(args.timeout)
-    if not track.album.is_loaded:
-        track.album.load(args.timeout)
-    if current_album is None:
-        current_album = track.album
-    album_browser = track.album.browse()
-    album_browser.load(args.timeout)
-
-    track_artist = to_ascii(
-        escape_filename_part(track.artists[0].name))
-    track_artists = to_ascii(
-        escape_filename_part(", ".join(
-            [artist.name for artist in track.artists])))
-    if len(track.artists) > 1:
-        featuring_artists = to_ascii(
-            escape_filename_part(", ".join(
-                [artist.name for artist in track.artists[1:]])))
-    else:
-        featuring_artists = ""
-
-    album_artist = to_ascii(
-        escape_filename_part(current_album.artist.name))
-    album_artists_web = track_artists
-
-    # only retrieve album_artist_web if it exists in the format string
-    if format_string.find("{album_artists_web}") >= 0:
-        artist_array = \
-            ripper.web.get_artists_on_album(current_album.link.uri)
-        if artist_array is not None:
-            album_artists_web = to_ascii(
-                escape_filename_part(", ".join(artist_array)))
-
-    album = to_ascii(escape_filename_part(track.album.name))
-    track_name = to_ascii(escape_filename_part(track.name))
-    year = str(track.album.year)
-    extension = args.output_type
-    idx_str = str(idx + 1)
-    track_num = str(track.index)
-    disc_num = str(track.disc)
-    track_uri = track.link.uri
-
-    # calculate num of discs on the album
-    num_discs = 0
-    for track_browse in album_browser.tracks:
-        if track_browse.disc > num_discs:
-            num_discs = track_browse.disc
-
-    if num_discs >= 2:
-        smart_num = str((int(disc_num) * 100) + int(track_num))
-    else:
-        smart_num = track_num
-
-    if current_playlist is not None:
-        playlist_name = to_ascii(
-            sanitize_playlist_name(current_playlist.name))
-        playlist_owner = to_ascii(
-            current_playlist.owner.display_name)
-    else:
-        playlist_name = "No Playlist"
-        playlist_owner = "No Playlist Owner"
-    user = ripper.session.user.display_name
-
-    # load copyright only if needed
-    copyright = label = ""
-    if (format_string.find("{copyright}") >= 0 or
-            format_string.find("{label}") >= 0):
-        album_browser = track.album.browse()
-        album_browser.load(args.timeout)
-        if len(album_browser.copyrights) > 0:
-            copyright = escape_filename_part(album_browser.copyrights[0])
-            label = re.sub(r"^[0-9]+\s+", "", copyright)
-
-    # load playlist create time or creator only if needed
-    create_time = creator = ""
-    if format_string.find("{create_time}") >= 0 or \
-            format_string.find("{creator}") >= 0:
-        pl_track = get_playlist_track(track, current_playlist)
-        if pl_track is not None:
-            create_time = datetime.fromtimestamp(
-                    pl_track.create_time).strftime('%Y-%m-%d %H:%M:%S')
-            creator = pl_track.creator.display_name
-
-    tags = {
-        "track_artist": track_artist,
-        "track_artists": track_artists,
-        "album_artist": album_artist,
-        "album_artists_web": album_artists_web,
-        "artist": track_artist,
-        "artists": track_artists,
-        "album": album,
-        "track_name": track_name,
-        "track": track_name,
-        "year": year,
-        "ext": extension,
-        "extension": extension,
-        "idx": idx_str,
-        "index": idx_str,
-        "track_num": track_num,
-        "track_idx": track_num,
-        "track_index": track_num,
-        "disc_num": disc_num,
-        "disc_idx": disc_num,
-        "disc_index": disc_num,
-        "smart_track_num": smart_num,
-        "smart_track_idx": smart_num,
-        "smart_track_index": smart_num,
-        "playlist": playlist_name,
-        "playlist_name": playlist_name,
-        "playlist_owner": playlist_owner,
-        "playlist_user": playlist_owner,
-        "playlist_username": playlist_owner,
-        "user": user,
-        "username": user,
-        "feat_artists": featuring_artists,
-        "featuring_artists": featuring_artists,
-        "copyright": copyright,
-        "label": label,
-        "copyright_holder": label,
-        "playlist_track_add_time": create_time,
-        "track_add_time": create_time,
-        "playlist_track_add_user": creator,
-        "track_add_user": creator,
-        "track_uri": track_uri,
-        "uri": track_uri
-    }
-    fill_tags = {"idx", "index", "track_num", "track_idx",
-                 "track_index", "disc_num", "disc_idx", "disc_index",
-                 "smart_track_num", "smart_track_idx", "smart_track_index"}
-    prefix_tags = {"feat_artists", "featuring_artists"}
-    paren_tags = {"track_name", "track"}
-    for tag in tags.keys():
-        format_string = format_string.replace("{" + tag + "}", tags[tag])
-        if tag in fill_tags:
-            match = re.search(r"\{" + tag + r":\d+\}", format_string)
-            if match:
-                tokens = format_string[match.start():match.end()]\
-                    .strip("{}").split(":")
-                tag_filled = tags[tag].zfill(int(tokens[1]))
-                format_string = format_string[:match.start()] + tag_filled + \
-                    format_string[match.end():]
-        if tag in prefix_tags:
-            # don't print prefix if there are no values
-            if len(tags[tag]) > 0:
-                match = re.search(r"\{" + tag + r":[^\}]+\}", format_string)
-                if match:
-                    tokens = format_string[match.start():match.end()]\
-                        .strip("{}").split(":")
-                    format_string = format_string[:match.start()] + tokens[1] + \
-                        " " + tags[tag] + format_string[match.end():]
-            else:
-                match = re.search(r"\s*\{" + tag +
-                                  r":[^\}]+\}", format_string)
-                if match:
-                    format_string = format_string[:match.start()] + \
-                                 format_string[match.end():]
-        if tag in paren_tags:
-            match = re.search(r"\{" + tag + r":paren\}", format_string)
-            if match:
-                match_tag = re.search(r"(.*)\s+-\s+([^-]+)", tags[tag])
-                if match_tag:
-                    format_string = format_string[:match.start()] + \
-                                 match_tag.group(1) + " (" + \
-                                 match_tag.group(2) + ")" + \
-                                 format_string[match.end():]
-                else:
-                    format_string = format_string[:match.start()] + tags[tag] + \
-                                 format_string[match.end():]
-
-    if args.format_case is not None:
-        if args.format_case == "upper":
-            format_string = format_string.upper()
-        elif args.format_case == "lower":
-            format_string = format_string.lower()
-        elif args.format_case == "capitalize":
-            format_string = ' '.join(word[0].upper() + word[1:] for \
-                word in format_string.split())
-
-    return format_string
-
-
 # returns path of executable
 def which(program):
     def is_exe(fpath):
@@ -476,20 +309,27 @@ def format_size(size, short=False):
             str_value = str_value[:3]
         return "{0:>3s}{1}".format(str_value, suffix)
 
+# returns the length in seconds of the audio in audio_file
+def audio_file_duration(audio_file, track, manifest=None):
+    # only parse the file if the manifest doesn't know about it
+    if manifest is not None:
+        duration = manifest.captured_duration(audio_file, track)
+        if duration is not None:
+            return duration
+    if (path_exists(audio_file)):
+        _file = mutagen.File(audio_file)
+        if _file is not None and _file.info is not None:
+            return _file.info.length
+    return None
+
+
 # returns true if audio_file is a partial of track
-def is_partial(audio_file, track):
+def is_partial(audio_file, track, manifest=None):
     args = get_args()
     if args.partial_check == "none":
         return False
 
-    def audio_file_duration(audio_file):
-        if (path_exists(audio_file)):
-            _file = mutagen.File(audio_file)
-            if _file is not None and _file.info is not None:
-                return _file.info.length
-        return None
-
-    audio_file_dur = audio_file_duration(audio_file)
+    audio_file_dur = audio_file_duration(audio_file, track, manifest)
 
     # for 'weak', give a ~1.5 second wiggle-room
     if args.partial_check == "strict":
@@ -4,10 +4,13 @@ from __future__ import unicode_literals
 
 from colorama import Fore
 from spotify_ripper.utils import *
+from spotify_ripper.webcache import WebCache, CachedResponse, web_cache_path
+from spotify_ripper.httpclient import HttpClient
+from spotify_ripper.template import compile_template
 import os
-import time
-import spotify
+import json
 import requests
+import spotify
 import csv
 import re
 
@@ -25,22 +28,60 @@ class WebAPI(object):
             "large_coverart": {}
         }
 
+        self.http = HttpClient(args)
+
+        # responses are also kept on disk between runs
+        self.disk_cache = WebCache(web_cache_path()) \
+            if args.web_cache_size > 0 else None
+
+    def close(self):
+        self.http.close()
+        if self.disk_cache is not None:
+            self.disk_cache.prune(self.args.web_cache_size * MB_BYTES)
+            self.disk_cache.close()
+            self.disk_cache = None
+
     def cache_result(self, name, uri, result):
         self.cache[name][uri] = result
 
     def get_cached_result(self, name, uri):
         return self.cache[name].get(uri)
 
-    def request_json(self, url, msg):
-        res = self.request_url(url, msg)
+    def request_json(self, url, msg, endpoint, use_cache=True):
+        res = self.request_url(url, msg, endpoint, use_cache)
         return res.json() if res is not None else res
 
-    def request_url(self, url, msg):
+    def request_url(self, url, msg, endpoint, use_cache=True):
+        headers = {}
+        disk_cache = self.disk_cache if use_cache else None
+        cached = disk_cache.get(url) if disk_cache is not None else None
+        if cached is not None:
+            content, etag, last_modified, is_fresh = cached
+            if is_fresh:
+                return CachedResponse(content)
+
+            # ask if our copy is still good
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+
         print(Fore.GREEN + "Attempting to retrieve " + msg +
               " from Spotify's Web API" + Fore.RESET)
         print(Fore.CYAN + url + Fore.RESET)
-        res = requests.get(url)
-        if res.status_code == 200:
+        try:
+            res = self.http.get(url, endpoint, headers=headers)
+        except requests.RequestException as e:
+            print(Fore.RED + "Web API request failed: " + str(e) +
+                  Fore.RESET)
+            return None
+
+        if res.status_code == 304 and cached is not None:
+            disk_cache.refresh(url, endpoint)
+            return CachedResponse(cached[0])
+        elif res.status_code == 200:
+            if disk_cache is not None:
+                disk_cache.put(url, endpoint, res)
             return res
         else:
             print(Fore.YELLOW + "URL returned non-200 HTTP code: " +
@@ -53,6 +94,95 @@ class WebAPI(object):
     def charts_url(self, url_path):
         return 'https://spotifycharts.com/' + url_path
 
+    def uses_album_artists_web(self):
+        args = self.args
+        format_strings = [args.format] + \
+            [out_args.format for out_args in args.extra_outputs]
+        if args.tag_override is not None:
+            format_strings += [tag_override.split("=", 1)[-1]
+                               for tag_override in args.tag_override]
+        return any("album_artists_web" in compile_template(f).fields
+                   for f in format_strings)
+
+    def request_batch(self, name, endpoint, uris, batch_size):
+        """yields the objects for the uris, those not already cached on
+        disk are asked for batch_size at a time"""
+        to_fetch = []
+        for uri in uris:
+            spotify_id = uri.split(':')[-1]
+            cached = self.disk_cache.get(
+                self.api_url(name + '/' + spotify_id)) \
+                if self.disk_cache is not None else None
+            if cached is not None and cached[3]:
+                yield CachedResponse(cached[0]).json()
+            else:
+                to_fetch.append(spotify_id)
+
+        for i in range(0, len(to_fetch), batch_size):
+            batch = to_fetch[i:i + batch_size]
+            url = self.api_url(name + '?ids=' + ",".join(batch))
+            json_obj = self.request_json(url, name, name, use_cache=False)
+            if json_obj is None:
+                continue
+            for spotify_id, item in zip(batch, json_obj.get(name, [])):
+                if item is None:
+                    continue
+
+                # keep each object as if it was asked for on its own
+                if self.disk_cache is not None:
+                    self.disk_cache.put_content(
+                        self.api_url(name + '/' + spotify_id), endpoint,
+                        json.dumps(item).encode("utf-8"))
+                yield item
+
+    def prefetch(self, tracks):
+        """fills the caches with batched requests for the artists, albums
+        and cover art of the tracks, instead of one request per track,
+        artist and album while they are tagged"""
+        args = self.args
+        need_album_artists = self.uses_album_artists_web()
+        if not (args.large_cover_art or args.genres is not None or
+                need_album_artists):
+            return
+
+        track_uris = []
+        for track in tracks:
+            uri = track.link.uri
+            if uri.startswith("spotify:track:") and uri not in track_uris:
+                track_uris.append(uri)
+
+        # tracks tell us the artist and album IDs along with the album's
+        # artists and cover art
+        artist_uris = []
+        album_uris = []
+        for item in self.request_batch("tracks", "track", track_uris, 50):
+            album = item.get("album", {})
+            if args.large_cover_art:
+                for image in album.get("images", []):
+                    if image["width"] == 640:
+                        self.cache_result(
+                            "large_coverart", item["uri"], image["url"])
+                        break
+            if "uri" in album and "artists" in album:
+                self.cache_result(
+                    "artists_on_album", album["uri"],
+                    [artist['name'] for artist in album['artists']])
+                if album["uri"] not in album_uris:
+                    album_uris.append(album["uri"])
+            artists = item.get("artists", [])
+            if len(artists) > 0 and artists[0]["uri"] not in artist_uris:
+                artist_uris.append(artists[0]["uri"])
+
+        if args.genres is not None:
+            name = args.genres + "s"
+            uris = artist_uris if args.genres == "artist" else album_uris
+            uris = [uri for uri in uris
+                    if self.get_cached_result("genres", uri) is None]
+            batch_size = 50 if args.genres == "artist" else 20
+            for item in self.request_batch(name, args.genres, uris,
+                                           batch_size):
+                self.cache_result("genres", item["uri"], item["genres"])
+
     # excludes 'appears on' albums for artist
     def get_albums_with_filter(self, uri):
         args = self.args
@@ -68,7 +198,7 @@ class WebAPI(object):
                     'artists/' + uri_tokens[2] +
                     '/albums/?=' + album_type + market +
                     '&limit=50&offset=' + str(offset))
-            return self.request_json(url, "albums")
+            return self.request_json(url, "albums", "artist_albums")
 
         # check for cached result
         cached_result = self.get_cached_result("albums_with_filter", uri)
@@ -86,9 +216,6 @@ class WebAPI(object):
         total = None
         while total is None or offset < total:
             try:
-                # rate limit if not first request
-                if total is None:
-                    time.sleep(1.0)
                 albums = get_albums_json(offset)
                 if albums is None:
                     break
@@ -107,7 +234,7 @@ class WebAPI(object):
     def get_artists_on_album(self, uri):
         def get_album_json(album_id):
             url = self.api_url('albums/' + album_id)
-            return self.request_json(url, "album")
+            return self.request_json(url, "album", "album")
 
         # check for cached result
         cached_result = self.get_cached_result("artists_on_album", uri)
@@ -131,7 +258,7 @@ class WebAPI(object):
     def get_genres(self, genre_type, track):
         def get_genre_json(spotify_id):
             url = self.api_url(genre_type + 's/' + spotify_id)
-            return self.request_json(url, "genres")
+            return self.request_json(url, "genres", genre_type)
 
         # extract album id from uri
         item = track.artists[0] if genre_type == "artist" else track.album
@@ -160,7 +287,8 @@ class WebAPI(object):
             url = self.charts_url(metrics + "/" + region + "/" + time_window +
                 "/" + from_date + "/download")
 
-            res = self.request_url(url, region + " " + metrics + " charts")
+            res = self.request_url(url, region + " " + metrics + " charts",
+                                   "charts")
             if res is not None:
                 csv_items = [enc_str(to_ascii(r)) for r in res.text.split("\n")]
                 reader = csv.DictReader(csv_items)
@@ -237,11 +365,13 @@ class WebAPI(object):
     def get_large_coverart(self, uri):
         def get_track_json(track_id):
             url = self.api_url('tracks/' + track_id)
-            return self.request_json(url, "track")
+            return self.request_json(url, "track", "track")
 
         def get_image_data(url):
-            response = self.request_url(url, "cover art")
-            return response.content
+            # the cover store keeps the image itself
+            response = self.request_url(url, "cover art", "image",
+                                        use_cache=False)
+            return response.content if response is not None else None
 
         # check for cached result
         cached_result = self.get_cached_result("large_coverart", uri)
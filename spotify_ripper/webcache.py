@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.covers import cover_store_command
+import json
+import os
+import sqlite3
+import threading
+import time
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+# how long a response is used without asking Spotify again, the
+# endpoints are named by WebAPI
+endpoint_ttls = {
+    "album": 30 * DAY,
+    "artist": 7 * DAY,
+    "artist_albums": DAY,
+    "track": 30 * DAY,
+    "charts": 6 * HOUR,
+}
+DEFAULT_TTL = DAY
+
+
+def web_cache_path():
+    return os.path.join(settings_dir(), "web_cache.db")
+
+
+class CachedResponse(object):
+    """Stands in for a requests response that came from the cache"""
+
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class WebCache(object):
+    """On-disk cache of Web API responses so separate runs don't ask
+    Spotify for the same albums, artists and cover art again.  Expired
+    responses are revalidated with their ETag/Last-Modified headers"""
+
+    schema = ("CREATE TABLE IF NOT EXISTS responses ("
+              "url TEXT PRIMARY KEY, "
+              "endpoint TEXT, "
+              "content BLOB, "
+              "etag TEXT, "
+              "last_modified TEXT, "
+              "fetched REAL, "
+              "expires REAL, "
+              "size INTEGER)")
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+        cache_dir = os.path.dirname(path)
+        if not path_exists(cache_dir):
+            os.makedirs(enc_str(cache_dir))
+
+        # shared between the ripper and plan threads
+        self.conn = sqlite3.connect(enc_str(path), check_same_thread=False)
+        with self.lock:
+            self.conn.execute(self.schema)
+            self.conn.commit()
+
+    def get(self, url):
+        """returns (content, etag, last_modified, is_fresh) or None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT content, etag, last_modified, expires "
+                "FROM responses WHERE url = ?", (url, )).fetchone()
+        if row is None:
+            return None
+        content, etag, last_modified, expires = row
+        return (bytes(content), etag, last_modified, expires > time.time())
+
+    def put(self, url, endpoint, res):
+        self.put_content(url, endpoint, res.content,
+                         res.headers.get("ETag"),
+                         res.headers.get("Last-Modified"))
+
+    def put_content(self, url, endpoint, content, etag=None,
+                    last_modified=None):
+        now = time.time()
+        ttl = endpoint_ttls.get(endpoint, DEFAULT_TTL)
+        try:
+            with self.lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?)",
+                    (url, endpoint, sqlite3.Binary(content),
+                     etag, last_modified, now, now + ttl, len(content)))
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(Fore.YELLOW + "Warning: could not update web cache: " +
+                  str(e) + Fore.RESET)
+
+    def is_fresh(self, url):
+        cached = self.get(url)
+        return cached is not None and cached[3]
+
+    def refresh(self, url, endpoint):
+        """the server said our copy is still good (304)"""
+        now = time.time()
+        ttl = endpoint_ttls.get(endpoint, DEFAULT_TTL)
+        with self.lock:
+            self.conn.execute(
+                "UPDATE responses SET fetched = ?, expires = ? "
+                "WHERE url = ?", (now, now + ttl, url))
+            self.conn.commit()
+
+    def info(self):
+        """returns (endpoint, count, size, expired) rows"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT endpoint, COUNT(*), SUM(size), "
+                "SUM(CASE WHEN expires <= ? THEN 1 ELSE 0 END) "
+                "FROM responses GROUP BY endpoint ORDER BY endpoint",
+                (time.time(), )).fetchall()
+
+    def total_size(self):
+        with self.lock:
+            size = self.conn.execute(
+                "SELECT SUM(size) FROM responses").fetchone()[0]
+        return size or 0
+
+    def prune(self, max_bytes=None):
+        """removes expired responses that can't be revalidated and then
+        the oldest responses until the cache fits in max_bytes, returns
+        the number of responses removed"""
+        with self.lock:
+            cursor = self.conn.execute(
+                "DELETE FROM responses WHERE expires <= ? AND "
+                "etag IS NULL AND last_modified IS NULL", (time.time(), ))
+            removed = cursor.rowcount
+
+            if max_bytes is not None:
+                size = self.conn.execute(
+                    "SELECT SUM(size) FROM responses").fetchone()[0] or 0
+                if size > max_bytes:
+                    rows = self.conn.execute(
+                        "SELECT url, size FROM responses "
+                        "ORDER BY fetched").fetchall()
+                    for url, url_size in rows:
+                        if size <= max_bytes:
+                            break
+                        self.conn.execute(
+                            "DELETE FROM responses WHERE url = ?", (url, ))
+                        size -= url_size
+                        removed += 1
+            self.conn.commit()
+        return removed
+
+    def clear(self):
+        with self.lock:
+            cursor = self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+            removed = cursor.rowcount
+            self.conn.execute("VACUUM")
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def cache_command(args):
+    """handles 'spotify-ripper cache {info,prune,clear}'"""
+    web_cache_command(args)
+    cover_store_command(args)
+
+
+def web_cache_command(args):
+    path = web_cache_path()
+    if not path_exists(path):
+        print("Web API cache is empty (" + path + ")")
+        return
+
+    cache = WebCache(path)
+    try:
+        if args.cache_command == "info":
+            print("Web API cache: " + path)
+            total_count = 0
+            for endpoint, count, size, expired in cache.info():
+                print("  " + Fore.YELLOW + endpoint.ljust(16) + Fore.RESET +
+                      str(count).rjust(8) + " responses " +
+                      format_size(size or 0).rjust(10) + "  (" +
+                      str(expired) + " expired)")
+                total_count += count
+            print("Total: " + str(total_count) + " responses, " +
+                  format_size(cache.total_size()) + " (max " +
+                  format_size(args.web_cache_size * MB_BYTES) + ")")
+        elif args.cache_command == "prune":
+            removed = cache.prune(args.web_cache_size * MB_BYTES)
+            print("Removed " + str(removed) + " responses, " +
+                  format_size(cache.total_size()) + " left")
+        elif args.cache_command == "clear":
+            removed = cache.clear()
+            print("Removed " + str(removed) + " responses")
+    finally:
+        cache.close()
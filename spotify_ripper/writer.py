@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.buffer import BufferPool
+import sys
+import threading
+import time
+
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+
+class WriterStats(object):
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.max_depth = 0
+        self.stall_time = 0.0
+        self.write_time = 0.0
+        self.bytes_written = 0
+        self.chunks_received = 0
+        self.writes = 0
+
+    def log(self):
+        print("Writer: " + format_size(self.bytes_written) + " from " +
+              str(self.chunks_received) + " chunks in " + str(self.writes) +
+              " writes per output, max buffer depth " +
+              str(self.max_depth) + "/" + str(self.capacity) +
+              ", stalled %.2fs, writing %.2fs" %
+              (self.stall_time, self.write_time))
+
+
+class EncoderWriter(threading.Thread):
+    """Streams captured frames to the encoder and any extra output files
+    so that the ripper thread never waits on disk or encoder latency.
+    Frames are coalesced into large pooled buffers so each output gets
+    one write per buffer instead of one per delivered chunk"""
+
+    name = 'SpotifyRipperWriterThread'
+
+    def __init__(self, args, ripper):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.args = args
+        self.ripper = ripper
+        self.capacity = args.writer_buffer
+        self.write_queue = queue.Queue(maxsize=self.capacity)
+
+        # one buffer being filled and one being written on top of
+        # the ones waiting in the queue
+        self.pool = BufferPool(self.capacity + 2,
+                               args.write_buffer_size * KB_BYTES)
+        self.buf = None
+        self.buf_len = 0
+
+        self.write_funcs = []
+        self.discarding = False
+        self.error = None
+        self.stats = WriterStats(self.capacity)
+
+    def begin_track(self, write_funcs):
+        self.write_funcs = write_funcs
+        self.discarding = False
+        self.error = None
+        self.stats = WriterStats(self.capacity)
+
+    # executes on the ripper thread
+    def write(self, frame_bytes):
+        num_bytes = len(frame_bytes)
+        self.stats.chunks_received += 1
+
+        if self.buf is not None and \
+                self.buf_len + num_bytes > self.pool.buffer_size:
+            self.flush()
+
+        # shouldn't happen, but don't split up an oversized chunk
+        if num_bytes > self.pool.buffer_size:
+            self.enqueue((frame_bytes, num_bytes, False))
+            return
+
+        if self.buf is None:
+            self.buf = self.acquire_buffer()
+            self.buf_len = 0
+
+        self.buf[self.buf_len:self.buf_len + num_bytes] = frame_bytes
+        self.buf_len += num_bytes
+
+    def acquire_buffer(self):
+        buf = self.pool.acquire(block=False)
+        if buf is None:
+            stall_start = time.time()
+            buf = self.pool.acquire()
+            self.stats.stall_time += time.time() - stall_start
+        return buf
+
+    def enqueue(self, item):
+        self.write_queue.put(item)
+        self.stats.max_depth = max(self.stats.max_depth,
+                                   self.write_queue.qsize())
+
+    def flush(self):
+        if self.buf is not None:
+            self.enqueue((self.buf, self.buf_len, True))
+            self.buf = None
+            self.buf_len = 0
+
+    def end_track(self):
+        """wait for all buffered frames to be written, raising any
+        error that the writer thread ran into"""
+        self.flush()
+        self.write_queue.join()
+        self.write_funcs = []
+
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+        return self.stats
+
+    def discard(self):
+        """drop any buffered frames (e.g. the track was skipped)"""
+        self.discarding = True
+        if self.buf is not None:
+            self.pool.release(self.buf)
+            self.buf = None
+            self.buf_len = 0
+        self.write_queue.join()
+        self.write_funcs = []
+        self.error = None
+
+    def stop(self):
+        self.discard()
+        self.write_queue.put(None)
+
+    def run(self):
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                self.write_queue.task_done()
+                break
+
+            buf, buf_len, pooled = item
+            try:
+                if self.discarding or self.error is not None:
+                    continue
+
+                if sys.version_info >= (3, 0):
+                    frame_bytes = memoryview(buf)[:buf_len]
+                else:
+                    frame_bytes = bytes(buf[:buf_len])
+
+                write_start = time.time()
+                for write_func in self.write_funcs:
+                    write_func(frame_bytes)
+                self.stats.write_time += time.time() - write_start
+                self.stats.bytes_written += buf_len
+                self.stats.writes += 1
+            except Exception as e:
+                print(Fore.RED + "Error while writing audio data: " +
+                      str(e) + Fore.RESET)
+                self.error = e
+            finally:
+                if pooled:
+                    self.pool.release(buf)
+                self.write_queue.task_done()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from spotify_ripper.httpclient import HttpClient
+import argparse
+import threading
+import time
+import unittest
+import requests
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers each request with the next (status, headers, delay) of the
+    server's script, the last entry is repeated"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            idx = min(server.requests, len(server.script)) - 1
+        status, headers, delay = server.script[idx]
+
+        if delay > 0:
+            time.sleep(delay)
+        body = b'{}'
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (IOError, OSError):
+            # the client gave up waiting
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, script):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StubHandler)
+        self.script = script
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1]) + "/v1/x"
+
+
+class NoBackoffClient(HttpClient):
+
+    def backoff(self, attempt):
+        return 0.01
+
+
+class HttpClientTest(unittest.TestCase):
+
+    def serve(self, script):
+        server = StubServer(script)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def client(self, web_retries=3, web_timeout=5.0,
+               client_class=NoBackoffClient):
+        args = argparse.Namespace(web_retries=web_retries,
+                                  web_timeout=web_timeout)
+        client = client_class(args)
+        client.session.trust_env = False
+        self.addCleanup(client.close)
+        return client
+
+    def test_retry_after_pauses_requests(self):
+        server = self.serve([(429, {"Retry-After": "0.5"}, 0),
+                             (200, {}, 0)])
+        # the wait comes from Retry-After, not from the backoff
+        client = self.client(client_class=HttpClient)
+
+        start = time.time()
+        res = client.get(server.url, "test")
+        self.assertEqual(res.status_code, 200)
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        self.assertGreater(client.bucket.paused_until, start)
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(client.stats["test"].retries, 1)
+        self.assertEqual(client.stats["test"].failures, 0)
+
+    def test_server_errors_then_success(self):
+        server = self.serve([(503, {}, 0), (500, {}, 0), (200, {}, 0)])
+        client = self.client()
+
+        res = client.get(server.url, "test")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(client.stats["test"].retries, 2)
+        self.assertEqual(client.stats["test"].failures, 0)
+
+    def test_client_errors_are_not_retried(self):
+        server = self.serve([(404, {}, 0)])
+        client = self.client()
+
+        res = client.get(server.url, "test")
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(server.requests, 1)
+
+    def test_timeout_retried_then_raised(self):
+        server = self.serve([(200, {}, 1.0)])
+        client = self.client(web_retries=2, web_timeout=0.2)
+
+        self.assertRaises(requests.Timeout, client.get, server.url, "test")
+        self.assertEqual(client.stats["test"].requests, 3)
+        self.assertEqual(client.stats["test"].retries, 2)
+        self.assertEqual(client.stats["test"].failures, 1)
+
+    def test_retries_stop_at_web_retries(self):
+        server = self.serve([(503, {}, 0)])
+        client = self.client(web_retries=2)
+
+        res = client.get(server.url, "test")
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(client.stats["test"].retries, 2)
+        self.assertEqual(client.stats["test"].failures, 1)
+
+    def test_no_retries(self):
+        server = self.serve([(503, {}, 0), (200, {}, 0)])
+        client = self.client(web_retries=0)
+
+        res = client.get(server.url, "test")
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(server.requests, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from spotify_ripper.tags import new_tags, padding_kwargs, write_tags
+from spotify_ripper.utils import KB_BYTES, init_util_globals
+from mutagen import flac
+from mutagen._tags import PaddingInfo
+import argparse
+import mutagen
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def tag_args(**kwargs):
+    args = argparse.Namespace(
+        all_artists=False, ascii=False, ascii_path_only=False, cbr=False,
+        comment=None, cover_file=None, cover_file_and_embed=None,
+        genres=None, grouping=None, id3_v23=False, output_type="flac",
+        tag_override=None, tag_padding=None)
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    init_util_globals(args)
+    return args
+
+
+def write_flac(path):
+    """a FLAC file with only a STREAMINFO block and no padding"""
+    stream_info = struct.pack(">HH", 4096, 4096) + b"\x00" * 6 + \
+        struct.pack(">Q", (44100 << 44) | (1 << 41) | (15 << 36)) + \
+        b"\x00" * 16
+    with open(path, "wb") as f:
+        f.write(b"fLaC" + struct.pack(">I", 0x80000000 | len(stream_info)))
+        f.write(stream_info)
+        f.write(b"\xff\xf8" + b"\x00" * 4094)
+
+
+class StubContext(object):
+
+    def load(self):
+        pass
+
+    def tag_metadata(self):
+        return {
+            "album": "Album", "artists": ["Artist"],
+            "album_artist": "Artist", "title": "Title", "year": 2001,
+            "disc": 1, "index": 3, "num_discs": 1, "num_tracks": 10,
+        }
+
+    def genres(self, genre_type):
+        return None
+
+    def cover_image(self):
+        return None
+
+
+def padding_blocks(path):
+    return [block.length for block in flac.FLAC(path).metadata_blocks
+            if isinstance(block, flac.Padding)]
+
+
+class PaddingTest(unittest.TestCase):
+
+    def padding_func(self, **kwargs):
+        with mock.patch.object(mutagen, "version", (1, 31, 0)):
+            return padding_kwargs(tag_args(**kwargs))["padding"]
+
+    def test_reserves_tag_padding(self):
+        padding = self.padding_func(tag_padding=64)
+        self.assertEqual(padding(PaddingInfo(-200, 100000)), 64 * KB_BYTES)
+
+    def test_keeps_existing_padding(self):
+        padding = self.padding_func(tag_padding=64)
+        self.assertEqual(padding(PaddingInfo(300000, 100000)), 300000)
+
+    def test_default_padding(self):
+        info = PaddingInfo(-200, 100000)
+        padding = self.padding_func()
+        self.assertEqual(padding(info), info.get_default_padding())
+
+    def test_old_mutagen_has_no_padding_argument(self):
+        with mock.patch.object(mutagen, "version", (1, 30, 0)):
+            self.assertEqual(padding_kwargs(tag_args(tag_padding=64)), {})
+
+
+class FlacPaddingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.audio_file = os.path.join(self.temp_dir, "track.flac")
+        write_flac(self.audio_file)
+
+    def write_tags(self, args):
+        tags = new_tags(args, self.audio_file, StubContext())
+        write_tags(args, self.audio_file, tags)
+
+    def test_reserves_tag_padding(self):
+        self.write_tags(tag_args(tag_padding=8))
+        self.assertEqual(padding_blocks(self.audio_file), [8 * KB_BYTES])
+
+    def saved_padding_blocks(self, args):
+        """the Padding blocks handed to FLAC.save by an old mutagen"""
+        saved = []
+
+        def save(audio, **kwargs):
+            self.assertEqual(kwargs, {})
+            saved.extend(block.length for block in audio.metadata_blocks
+                         if isinstance(block, flac.Padding))
+
+        with mock.patch.object(mutagen, "version", (1, 30, 0)), \
+                mock.patch.object(flac.FLAC, "save", autospec=True,
+                                  side_effect=save):
+            self.write_tags(args)
+        return saved
+
+    def test_old_mutagen_adds_padding_block(self):
+        # mutagen < 1.31 can't be asked for padding, a Padding block of
+        # the configured size is added before saving instead
+        self.assertEqual(self.saved_padding_blocks(tag_args(tag_padding=8)),
+                         [8 * KB_BYTES])
+
+    def test_old_mutagen_keeps_existing_padding(self):
+        audio = flac.FLAC(self.audio_file)
+        audio.save(padding=lambda info: 2048)
+
+        self.assertEqual(self.saved_padding_blocks(tag_args(tag_padding=8)),
+                         [2048])
+
+    def test_old_mutagen_no_tag_padding(self):
+        self.assertEqual(self.saved_padding_blocks(tag_args()), [])
+
+if __name__ == '__main__':
+    unittest.main()